@@ -0,0 +1,183 @@
+"""
+Compares the threaded WSGI server of `flask run` to the ASGI mode served by
+uvicorn while many idle connections are open.
+
+Usage:
+    python benchmarks/asgi_connections.py [idle connections] [clients] \
+        [requests per client] [cores]
+
+Both servers run in a subprocess limited to the same number of cores. The
+script first opens the idle connections, which send the start of a request
+and then wait like a slow client or a kept-alive connection between its
+requests, and then measures GET /api/mokkis/ from the active clients.
+It prints the throughput, the 99th percentile latency and the number of
+threads and the memory of the server process. The ASGI mode is skipped if
+uvicorn is not installed.
+"""
+import asyncio
+import importlib.util
+import logging
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from mokkigo import create_app, db  # noqa: E402
+from mokkigo.models import Mokki  # noqa: E402
+
+REQUEST = (b"GET /api/mokkis/ HTTP/1.1\r\n"
+           b"Host: localhost\r\n"
+           b"Accept: application/json\r\n\r\n")
+
+# Start of a request that is never finished
+IDLE_REQUEST = b"GET /api/mokkis/ HTTP/1.1\r\n"
+
+
+def serve(mode, port, db_fname, cores):
+    os.sched_setaffinity(0, range(cores))
+    config = {
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "SQLITE_PROFILE": "production",
+    }
+    if mode == "wsgi":
+        from werkzeug.serving import make_server
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)
+        make_server("127.0.0.1", port, create_app(config),
+                    threaded=True).serve_forever()
+    else:
+        import uvicorn
+        from mokkigo.asgi import create_asgi_app
+        uvicorn.run(create_asgi_app(config), host="127.0.0.1", port=port,
+                    log_level="warning", backlog=4096)
+
+
+def populate(db_fname):
+    app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname})
+    with app.app_context():
+        db.create_all()
+        for i in range(20):
+            db.session.add(Mokki(name="mokki-{}".format(i),
+                                 location="location-{}".format(i)))
+        db.session.commit()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def fetch(reader, writer):
+    """
+    Makes one request and returns the status and whether the server keeps
+    the connection open
+    """
+    writer.write(REQUEST)
+    await writer.drain()
+    head = await reader.readuntil(b"\r\n\r\n")
+    length = 0
+    keep_alive = True
+    for line in head.lower().split(b"\r\n"):
+        if line.startswith(b"content-length:"):
+            length = int(line.split(b":", 1)[1])
+        elif line == b"connection: close":
+            keep_alive = False
+    await reader.readexactly(length)
+    return head.split(b" ", 2)[1], keep_alive
+
+
+async def connect(port):
+    while True:
+        try:
+            return await asyncio.open_connection("127.0.0.1", port)
+        except OSError:
+            await asyncio.sleep(0.05)
+
+
+async def measure(port, idle, clients, requests):
+    idle_connections = []
+    for i in range(idle):
+        reader, writer = await connect(port)
+        writer.write(IDLE_REQUEST)
+        await writer.drain()
+        idle_connections.append(writer)
+
+    latencies = []
+
+    async def client():
+        reader, writer = await connect(port)
+        for i in range(requests):
+            start = time.perf_counter()
+            status, keep_alive = await fetch(reader, writer)
+            if not keep_alive:
+                # The development server closes every connection
+                writer.close()
+                reader, writer = await connect(port)
+            latencies.append(time.perf_counter() - start)
+            assert status == b"200", status
+        writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for i in range(clients)])
+    elapsed = time.perf_counter() - start
+    for writer in idle_connections:
+        writer.close()
+    latencies.sort()
+    return (clients * requests / elapsed,
+            latencies[int(len(latencies) * 0.99) - 1])
+
+
+def server_stats(pid):
+    stats = {}
+    with open("/proc/{}/status".format(pid)) as status:
+        for line in status:
+            key, value = line.split(":", 1)
+            stats[key] = value.strip()
+    return stats["Threads"], stats["VmRSS"]
+
+
+def run(mode, db_fname, idle, clients, requests, cores):
+    port = free_port()
+    server = subprocess.Popen([sys.executable, __file__, "--serve", mode,
+                               str(port), db_fname, str(cores)])
+    try:
+        throughput, p99 = asyncio.run(measure(port, idle, clients,
+                                              requests))
+        threads, rss = server_stats(server.pid)
+        print("{:<5} {:8.0f} req/s  p99 {:7.1f} ms  {:>5} threads  {}".format(
+            mode, throughput, p99 * 1000, threads, rss))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    if sys.argv[1:2] == ["--serve"]:
+        mode, port, db_fname, cores = sys.argv[2:]
+        serve(mode, int(port), db_fname, int(cores))
+        return
+
+    args = [int(arg) for arg in sys.argv[1:]]
+    idle, clients, requests, cores = args + [1000, 32, 100, 2][len(args):]
+    db_fd, db_fname = tempfile.mkstemp()
+    try:
+        populate(db_fname)
+        print("{} idle connections, {} clients, {} cores".format(
+            idle, clients, cores))
+        run("wsgi", db_fname, idle, clients, requests, cores)
+        if importlib.util.find_spec("uvicorn") is None:
+            print("asgi  skipped, install uvicorn: pip install .[asgi]")
+        else:
+            run("asgi", db_fname, idle, clients, requests, cores)
+    finally:
+        os.close(db_fd)
+        os.unlink(db_fname)
+
+
+if __name__ == "__main__":
+    main()
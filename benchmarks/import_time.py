@@ -0,0 +1,76 @@
+"""
+Measures the cold start of the app: importing mokkigo and creating the app
+in a new interpreter, and the first request to the API docs with and
+without the cached spec.
+
+Usage:
+    python benchmarks/import_time.py [runs]
+
+Every measurement is the median of the runs, each in a new process so no
+module is imported yet. The script also lists the heavy optional modules
+that were imported by create_app().
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+HEAVY_MODULES = ["flasgger", "jsonschema", "yaml", "dateutil.parser", "numpy"]
+
+STARTUP = """
+import json, sys, time
+start = time.perf_counter()
+from mokkigo import create_app
+imported = time.perf_counter()
+app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite://"})
+created = time.perf_counter()
+loaded = [name for name in %r if name in sys.modules]
+app.instance_path = sys.argv[1]
+r = app.test_client().get("/apispec_1.json")
+assert r.status_code == 200, r.status_code
+docs = time.perf_counter()
+print(json.dumps({
+    "import": imported - start,
+    "create_app": created - imported,
+    "docs": docs - created,
+    "loaded": loaded,
+}))
+""" % HEAVY_MODULES
+
+
+def run_once(instance_path):
+    result = subprocess.run([sys.executable, "-c", STARTUP, instance_path],
+                            cwd=ROOT, check=True, capture_output=True)
+    return json.loads(result.stdout)
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    with tempfile.TemporaryDirectory() as cold_dir, \
+            tempfile.TemporaryDirectory() as warm_dir:
+        cold = []
+        for i in range(runs):
+            # A fresh instance folder has no cached spec
+            path = os.path.join(cold_dir, str(i))
+            os.mkdir(path)
+            cold.append(run_once(path))
+        run_once(warm_dir)
+        warm = [run_once(warm_dir) for i in range(runs)]
+
+    def median(results, key):
+        return statistics.median(r[key] for r in results) * 1000
+
+    print("import mokkigo      {:7.1f} ms".format(median(cold, "import")))
+    print("create_app()        {:7.1f} ms".format(median(cold, "create_app")))
+    print("first docs request  {:7.1f} ms without cache, {:.1f} ms "
+          "cached".format(median(cold, "docs"), median(warm, "docs")))
+    print("heavy modules at startup: {}".format(
+        ", ".join(cold[0]["loaded"]) or "none"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Compares the ORM read path (Model.query.all()) to the column tuple read path
+used by the collection GETs.
+
+Usage:
+    python benchmarks/read_path.py [number of visits]
+
+For each path the script prints the time per row and the peak memory
+allocated per row, measured with tracemalloc.
+"""
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload, selectinload
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from mokkigo import create_app, db  # noqa: E402
+from mokkigo.models import (Mokki, Participant, Visit,  # noqa: E402
+                            participant_visit)
+from mokkigo.resources.visit import NAME_SEPARATOR  # noqa: E402
+
+
+def populate(count):
+    mokki = Mokki(name="bench-mokki", location="bench")
+    parts = [Participant(name="participant-{}".format(i)) for i in range(10)]
+    db.session.add(mokki)
+    db.session.add_all(parts)
+    start = datetime(2000, 1, 1)
+    for i in range(count):
+        db.session.add(Visit(
+            visit_name="visit-{:08d}".format(i),
+            mokki=mokki,
+            time_start=start + timedelta(days=i),
+            time_end=start + timedelta(days=i, hours=12),
+            participants=parts[i % 10:i % 10 + 2]
+        ))
+    db.session.commit()
+
+
+def orm_path():
+    visits = Visit.query.options(joinedload(Visit.mokki),
+                                 selectinload(Visit.participants)).all()
+    return [
+        (v.visit_name, v.mokki_name, v.time_start.isoformat(),
+         v.time_end.isoformat(), [p.name for p in v.participants])
+        for v in visits
+    ]
+
+
+def row_path():
+    rows = db.session.query(
+            Visit.visit_name,
+            Mokki.name,
+            Visit.time_start,
+            Visit.time_end,
+            func.group_concat(Participant.name, NAME_SEPARATOR)
+    ).select_from(Visit) \
+     .outerjoin(Mokki, Mokki.id == Visit.mokki_id) \
+     .outerjoin(participant_visit,
+                participant_visit.c.visit_id == Visit.id) \
+     .outerjoin(Participant,
+                Participant.id == participant_visit.c.participant_id) \
+     .group_by(Visit.id).all()
+    return [
+        (r[0], r[1], r[2].isoformat(), r[3].isoformat(),
+         r[4].split(NAME_SEPARATOR) if r[4] else [])
+        for r in rows
+    ]
+
+
+def normalize(rows):
+    return sorted(row[:4] + (sorted(row[4]),) for row in rows)
+
+
+def measure(name, func, count):
+    db.session.expunge_all()
+    t = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - t
+
+    db.session.expunge_all()
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    print("{:<6} {:8.1f} ms {:8.1f} us/row {:8.0f} peak bytes/row".format(
+        name, elapsed * 1000, elapsed * 1e6 / count, peak / count))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    db_fd, db_fname = tempfile.mkstemp()
+    app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname})
+    try:
+        with app.app_context():
+            db.create_all()
+            populate(count)
+            assert normalize(orm_path()) == normalize(row_path())
+            print("{} visits".format(count))
+            measure("orm", orm_path, count)
+            measure("rows", row_path, count)
+    finally:
+        os.close(db_fd)
+        os.unlink(db_fname)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Measures the overhead of the Server-Timing instrumentation.
+
+Usage:
+    python benchmarks/server_timing.py [requests]
+
+A few requests of the API are sent with the test client with SERVER_TIMING
+disabled and enabled in alternating rounds, and the script prints the best
+median time per request of both along with the header of the last request.
+"""
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from mokkigo import create_app, db  # noqa: E402
+
+REQUESTS = [
+    ("GET", "/api/visits/?limit=100", None),
+    ("GET", "/api/visits/visit-00000010/", None),
+    ("GET", "/api/mokkis/bench-mokki/calendar/?from=2022-01-01&to=2022-03-01",
+     None),
+    ("PUT", "/api/mokkis/bench-mokki/", {"name": "bench-mokki",
+                                        "location": "bench"}),
+]
+
+ROUNDS = 5
+
+
+def populate(client):
+    client.post("/api/mokkis/", json={"name": "bench-mokki",
+                                      "location": "bench"})
+    client.post("/api/visits/", json=[
+        {"visit_name": "visit-{:08d}".format(i), "mokki_name": "bench-mokki",
+         "time_start": "2022-01-{:02d}T12:00:00".format(i % 28 + 1),
+         "time_end": "2022-01-{:02d}T12:00:00".format(i % 28 + 1),
+         "participants": []}
+        for i in range(500)
+    ])
+
+
+def measure(client, method, url, doc, count):
+    times = []
+    for i in range(count):
+        start = time.perf_counter()
+        resp = client.open(url, method=method, json=doc)
+        times.append(time.perf_counter() - start)
+        assert resp.status_code < 300, resp.status_code
+    return statistics.median(times), resp.headers.get("Server-Timing")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_app({
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///" + os.path.join(
+                tmp, "bench.db"),
+            "SQLITE_PROFILE": "production",
+        })
+        with app.app_context():
+            db.create_all()
+        client = app.test_client()
+        populate(client)
+
+        for method, url, doc in REQUESTS:
+            # Alternate the settings so drift affects both the same way
+            offs, ons = [], []
+            for i in range(ROUNDS):
+                app.config["SERVER_TIMING"] = False
+                offs.append(measure(client, method, url, doc,
+                                    count // ROUNDS)[0])
+                app.config["SERVER_TIMING"] = True
+                on, header = measure(client, method, url, doc,
+                                     count // ROUNDS)
+                ons.append(on)
+            off, on = min(offs), min(ons)
+            print("{} {}".format(method, url))
+            print("    off {:.1f} us, on {:.1f} us ({:+.1f} us)".format(
+                off * 1e6, on * 1e6, (on - off) * 1e6))
+            print("    {}".format(header))
+
+
+if __name__ == "__main__":
+    main()
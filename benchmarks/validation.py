@@ -0,0 +1,72 @@
+"""
+Measures the cost of validating the JSON document of one request.
+
+Usage:
+    python benchmarks/validation.py [repeats]
+
+For a valid document of every model the script prints the time per
+validation of jsonschema.validate() with a newly built schema, as the
+resources did before the validator registry, of the compiled validator of
+the registry and of the generated fast path.
+"""
+import os
+import sys
+import timeit
+import warnings
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import jsonschema  # noqa: E402
+
+from mokkigo import create_app  # noqa: E402
+from mokkigo.models import Item, Mokki, Participant, Visit  # noqa: E402
+from mokkigo.validation import validation_error  # noqa: E402
+
+DOCS = [
+    (Mokki, {"name": "Ii-mokki", "location": "Ii"}),
+    (Item, {"name": "Sauna beer", "amount": "24"}),
+    (Participant, {"name": "Laura", "allergies": "nuts"}),
+    (Visit, {"visit_name": "Weekend", "mokki_name": "Ii-mokki",
+             "time_start": "2022-06-03T16:00:00+03:00",
+             "time_end": "2022-06-05T12:00:00+03:00",
+             "participants": ["Laura", "Nuutti"]}),
+]
+
+
+def per_call(function, repeats):
+    number = max(1, repeats // 10)
+    return min(timeit.repeat(function, number=number, repeat=10)) / number
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    warnings.simplefilter("ignore", DeprecationWarning)
+    app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite://"})
+    format_checker = jsonschema.draft7_format_checker
+
+    print("{:<12} {:>12} {:>12} {:>12}".format(
+        "model", "validate()", "compiled", "fast path"))
+    with app.app_context():
+        for model, doc in DOCS:
+            check_formats = model is Visit
+
+            def before():
+                jsonschema.validate(
+                    doc, model.json_schema(),
+                    format_checker=format_checker if check_formats else None
+                )
+
+            def compiled():
+                assert validation_error(doc, model, check_formats) is None
+
+            app.config["VALIDATION_FAST_PATH"] = False
+            slow = per_call(compiled, repeats)
+            app.config["VALIDATION_FAST_PATH"] = True
+            fast = per_call(compiled, repeats)
+            print("{:<12} {:>9.1f} us {:>9.1f} us {:>9.1f} us".format(
+                model.__name__, per_call(before, repeats) * 1e6, slow * 1e6,
+                fast * 1e6))
+
+
+if __name__ == "__main__":
+    main()
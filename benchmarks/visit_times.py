@@ -0,0 +1,58 @@
+"""
+Measures parsing the date-times of a visit document and serializing the
+stored ones.
+
+Usage:
+    python benchmarks/visit_times.py [repeats]
+
+For a few forms of date-time the script prints the time per call of
+dateutil.parser.parse(), which the resources used before, and of
+timeutils.parse_datetime(). It then compares serializing a stored value as
+before, by converting the text of the column to a datetime and calling
+isoformat(), with timeutils.stored_isoformat().
+"""
+import os
+import sys
+import timeit
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from dateutil import parser  # noqa: E402
+
+from mokkigo.timeutils import parse_datetime, stored_isoformat  # noqa: E402
+
+VALUES = [
+    "2022-06-03T16:00:00",
+    "2022-06-03T16:00:00+03:00",
+    "2022-06-03T16:00:00.123456Z",
+    "20220603T160000",
+]
+
+STORED = "2022-06-03 16:00:00.000000"
+
+
+def per_call(function, repeats):
+    number = max(1, repeats // 10)
+    return min(timeit.repeat(function, number=number, repeat=10)) / number
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    print("{:<30} {:>12} {:>12}".format("value", "dateutil", "fast path"))
+    for value in VALUES:
+        before = per_call(lambda: parser.parse(value), repeats)
+        after = per_call(lambda: parse_datetime(value), repeats)
+        print("{:<30} {:>9.2f} us {:>9.2f} us".format(
+            value, before * 1e6, after * 1e6))
+
+    before = per_call(
+        lambda: datetime.fromisoformat(STORED).isoformat(), repeats)
+    after = per_call(lambda: stored_isoformat(STORED), repeats)
+    print("{:<30} {:>9.2f} us {:>9.2f} us".format(
+        "serialize " + STORED[:10], before * 1e6, after * 1e6))
+
+
+if __name__ == "__main__":
+    main()
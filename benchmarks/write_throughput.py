@@ -0,0 +1,74 @@
+"""
+Measures the throughput of concurrent participant POSTs with and without
+GROUP_COMMIT.
+
+Usage:
+    python benchmarks/write_throughput.py [threads] [posts per thread]
+
+The requests are sent through the Flask test client from several threads,
+so the numbers include the request handling but not a real server.
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from mokkigo import create_app, db  # noqa: E402
+
+
+def run(group_commit, threads, posts):
+    db_fd, db_fname = tempfile.mkstemp()
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "SQLITE_PROFILE": "production",
+        # Every commit waits for the disk, like the default journal mode
+        "SQLITE_PRAGMAS": {"synchronous": "FULL"},
+        "GROUP_COMMIT": group_commit,
+        "WRITE_RETRY_DEADLINE": 30,
+    })
+    try:
+        with app.app_context():
+            db.create_all()
+
+        failed = []
+
+        def post(thread):
+            client = app.test_client()
+            for i in range(posts):
+                r = client.post("/api/participants/", json={
+                    "name": "participant-{}-{}".format(thread, i)
+                })
+                if r.status_code != 201:
+                    failed.append(r.status_code)
+
+        workers = [threading.Thread(target=post, args=(i,))
+                   for i in range(threads)]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+
+        print("group commit {:<5} {:8.0f} posts/s {} failed".format(
+            str(group_commit), threads * posts / elapsed, len(failed)))
+        with app.app_context():
+            db.session.remove()
+            db.get_engine().dispose()
+    finally:
+        os.close(db_fd)
+        os.unlink(db_fname)
+
+
+def main():
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    posts = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    run(False, threads, posts)
+    run(True, threads, posts)
+
+
+if __name__ == "__main__":
+    main()
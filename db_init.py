@@ -1,3 +1,5 @@
+from datetime import datetime
+
 from mokkigo.models import Mokki, Visit, Item, Participant
 from mokkigo import create_app, db
 
@@ -17,8 +19,8 @@ for idx, letter in enumerate("ABC", start=1):
             location="Area{}-{}".format(letter, idx)
     )
     v = Visit(
-            time_start="2022-01-0{}".format(idx),
-            time_end="2022-01-0{}".format(idx+5),
+            time_start=datetime(2022, 1, idx),
+            time_end=datetime(2022, 1, idx + 5),
             visit_name="visit-{}".format(letter)
     )
     item = []
@@ -26,7 +28,7 @@ for idx, letter in enumerate("ABC", start=1):
         item.append(Item(name="item-{}".format(letter),
                          amount="{}".format(idx)))
 
-    v.mokki_name = m.name
+    v.mokki = m
     v.participants.append(p[0])
     v.participants.append(p[1])
     v.participants.append(p[2])
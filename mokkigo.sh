@@ -6,6 +6,8 @@ if [ "$#" -eq 0 ]; then
 	echo "Usage:"
 	echo "    init"
 	echo "    run"
+	echo "    asgi"
+	echo "    serve [options of python3 -m mokkigo.server]"
 	exit 1
 fi
 
@@ -19,6 +21,15 @@ while [[ $# -gt 0 ]]; do
 			flask run
 			shift
 			;;
+		asgi)
+			uvicorn --factory mokkigo.asgi:create_asgi_app
+			shift
+			;;
+		serve)
+			shift
+			FLASK_DEBUG=0 python3 -m mokkigo.server "$@"
+			exit
+			;;
 		*)
 			exit
 			shift
@@ -5,7 +5,6 @@ import json
 
 from flask import Flask, url_for, Response
 from flask_sqlalchemy import SQLAlchemy
-from flasgger import Swagger
 
 from mokkigo.constants import LINK_RELATIONS_URL, MASON
 
@@ -24,6 +23,27 @@ def create_app(test_config=None):
         SQLALCHEMY_DATABASE_URI="sqlite:///" + os.path.join(app.instance_path,
                                                             "development.db"),
         SQLALCHEMY_TRACK_MODIFICATIONS=False,
+        PAGE_SIZE=100,
+        MAX_PAGE_SIZE=1000,
+        STREAM_MAX_PAGE_SIZE=1000000,
+        STREAM_BATCH_SIZE=500,
+        IDENTITY_CACHE_SIZE=1024,
+        IDENTITY_CACHE_TTL=30,
+        BOOKING_CONFLICTS="reject",
+        CALENDAR_MAX_DAYS=732,
+        SQLITE_PROFILE="default",
+        SQLITE_PRAGMAS={},
+        WRITE_RETRY_DEADLINE=2.0,
+        WRITE_RETRY_DELAY=0.01,
+        GROUP_COMMIT=False,
+        GROUP_COMMIT_WINDOW=0.002,
+        GROUP_COMMIT_MAX_BATCH=64,
+        GROUP_COMMIT_TIMEOUT=10.0,
+        ASGI_THREADS=16,
+        API_DOCS=True,
+        VALIDATION_FAST_PATH=True,
+        SERVER_TIMING=True,
+        SERVER_TIMING_LOG=False,
     )
 
     app.config["SWAGGER"] = {
@@ -31,7 +51,6 @@ def create_app(test_config=None):
             "openapi": "3.0.3",
             "uiversion": 3,
     }
-    Swagger(app, template_file="doc/mokkigo.yml")
 
     if test_config is None:
         app.config.from_pyfile("config.py", silent=True)  # pragma: no coverity
@@ -45,6 +64,20 @@ def create_app(test_config=None):
 
     db.init_app(app)
 
+    from mokkigo import apidocs
+    apidocs.init_app(app)
+
+    from mokkigo import storage
+    storage.init_app(app)
+
+    from mokkigo import metrics  # noqa: F401 registers the query counter
+
+    from mokkigo.cache import IdentityCache
+    app.extensions["mokkigo_identity_cache"] = IdentityCache(
+            size=app.config["IDENTITY_CACHE_SIZE"],
+            ttl=app.config["IDENTITY_CACHE_TTL"]
+    )
+
     from mokkigo.resources.item import ItemConverter
     from mokkigo.resources.visit import VisitConverter
     from mokkigo.resources.mokki import MokkiConverter
@@ -60,6 +93,9 @@ def create_app(test_config=None):
 
     from . import models
     app.cli.add_command(models.init_db_command)
+    app.cli.add_command(models.export_db_command)
+    app.cli.add_command(models.import_db_command)
+    app.cli.add_command(models.migrate_db_command)
 
     # @app.route("/profiles/<profile>/")
     # def send_profile(profile):
@@ -1,13 +1,20 @@
 from flask import Blueprint
 from flask_restful import Api
 
+from mokkigo import metrics
 from mokkigo.resources.mokki import MokkiCollection, MokkiItem
 from mokkigo.resources.item import ItemCollection, ItemItem
-from mokkigo.resources.visit import VisitCollection, VisitItem
+from mokkigo.resources.calendar import MokkiCalendar
+from mokkigo.resources.search import Search
+from mokkigo.resources.visit import (VisitCollection, VisitItem,
+                                     MokkiVisitCollection,
+                                     ParticipantVisitCollection)
 from mokkigo.resources.participant import (ParticipantCollection,
                                            ParticipantItem)
 
 api_bp = Blueprint("api", __name__, url_prefix="/api")
+api_bp.before_request(metrics.start_timing)
+api_bp.after_request(metrics.add_server_timing)
 api = Api(api_bp)
 
 
@@ -16,9 +23,15 @@ api.add_resource(MokkiItem, "/mokkis/<mokki:mokki>/")
 
 api.add_resource(ItemCollection, "/mokkis/<mokki:mokki>/items/")
 api.add_resource(ItemItem, "/mokkis/<mokki:mokki>/items/<item:item>/")
+api.add_resource(MokkiVisitCollection, "/mokkis/<mokki:mokki>/visits/")
+api.add_resource(MokkiCalendar, "/mokkis/<mokki:mokki>/calendar/")
 
 api.add_resource(ParticipantCollection, "/participants/")
 api.add_resource(ParticipantItem, "/participants/<participant:participant>/")
+api.add_resource(ParticipantVisitCollection,
+                 "/participants/<participant:participant>/visits/")
 
 api.add_resource(VisitCollection, "/visits/")
 api.add_resource(VisitItem, "/visits/<visit:visit>/")
+
+api.add_resource(Search, "/search/")
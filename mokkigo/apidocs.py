@@ -0,0 +1,139 @@
+"""
+Lazily built API documentation.
+
+With API_DOCS enabled, the Swagger UI is served at /apidocs/ and the OpenAPI
+spec at /apispec_1.json. Creating the app does not import flasgger nor read
+any YAML: the first request to one of the documentation paths builds the
+spec from doc/mokkigo.yml and the docstrings of the resources, and creates a
+small Flask app that serves it with flasgger.
+
+The built spec is cached in the instance folder under a hash of its
+sources, so the other processes and later starts only read the JSON file.
+"""
+import glob
+import hashlib
+import json
+import os
+import threading
+
+from flask import Flask
+
+TEMPLATE_FILE = "doc/mokkigo.yml"
+
+# Paths served by the documentation app
+DOCS_PATHS = ("/apidocs", "/apispec_1.json", "/flasgger_static/")
+
+
+def source_hash(app):
+    """
+    Returns a hash of everything the spec is built from: the template, the
+    modules with the docstrings, the flasgger version and the SWAGGER config
+    """
+    from importlib.metadata import version
+
+    digest = hashlib.sha256()
+    digest.update(version("flasgger").encode("utf-8"))
+    digest.update(json.dumps(app.config["SWAGGER"], sort_keys=True,
+                             default=str).encode("utf-8"))
+    sources = [os.path.join(app.root_path, TEMPLATE_FILE)]
+    sources += sorted(glob.glob(os.path.join(app.root_path, "**", "*.py"),
+                                recursive=True))
+    for path in sources:
+        digest.update(os.path.relpath(path, app.root_path).encode("utf-8"))
+        with open(path, "rb") as source:
+            digest.update(source.read())
+    return digest.hexdigest()[:16]
+
+
+def build_spec(app):
+    """Builds the OpenAPI spec of the app with flasgger"""
+    from flasgger import Swagger
+
+    swagger = Swagger(template_file=TEMPLATE_FILE)
+    swagger.app = app
+    swagger.load_config(app)
+    swagger.template = swagger.load_swagger_file(TEMPLATE_FILE)
+    with app.app_context():
+        return swagger.get_apispecs("apispec_1")
+
+
+def get_spec(app):
+    """
+    Returns the OpenAPI spec of the app, from the cache file if its sources
+    have not changed since it was written
+    """
+    cache_file = os.path.join(app.instance_path,
+                              "apispec-{}.json".format(source_hash(app)))
+    try:
+        with open(cache_file) as cached:
+            return json.load(cached)
+    except (OSError, ValueError):
+        pass
+
+    spec = build_spec(app)
+    # Round trip through JSON so the spec is the same as a cached one, the
+    # examples of the YAML may contain e.g. datetimes
+    data = app.json.dumps(spec, sort_keys=True)
+    try:
+        for stale in glob.glob(os.path.join(app.instance_path,
+                                            "apispec-*.json")):
+            if stale != cache_file:
+                os.remove(stale)
+        temp_file = "{}.{}".format(cache_file, os.getpid())
+        with open(temp_file, "w") as cache:
+            cache.write(data)
+        os.replace(temp_file, cache_file)
+    except OSError:
+        pass
+    return json.loads(data)
+
+
+def create_docs_app(app):
+    """
+    Returns the Flask app serving the Swagger UI and the spec of app. The
+    spec is given to flasgger as a complete template, so the docs app does
+    not need the routes of app.
+    """
+    from flasgger import Swagger
+
+    docs = Flask(app.import_name, root_path=app.root_path,
+                 static_folder=None)
+    docs.config["SWAGGER"] = app.config["SWAGGER"]
+    config = Swagger.DEFAULT_CONFIG.copy()
+    config["specs"] = [{
+        "endpoint": "apispec_1",
+        "route": "/apispec_1.json",
+        "rule_filter": lambda rule: False,
+        "model_filter": lambda tag: False,
+    }]
+    Swagger(docs, config=config, template=get_spec(app))
+    return docs
+
+
+class LazyApiDocs(object):
+    """
+    WSGI middleware passing the documentation requests to the docs app,
+    which is created on the first of them
+    """
+
+    def __init__(self, app, wsgi_app):
+        self.app = app
+        self.wsgi_app = wsgi_app
+        self.docs = None
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        if environ.get("PATH_INFO", "").startswith(DOCS_PATHS):
+            return self.get_docs()(environ, start_response)
+        return self.wsgi_app(environ, start_response)
+
+    def get_docs(self):
+        with self._lock:
+            if self.docs is None:
+                self.docs = create_docs_app(self.app)
+            return self.docs
+
+
+def init_app(app):
+    if app.config["API_DOCS"]:
+        app.wsgi_app = LazyApiDocs(app, app.wsgi_app)
@@ -0,0 +1,225 @@
+"""
+ASGI serving mode.
+
+The Flask app is wrapped in an ASGI application, so it can be served by an
+asyncio server such as uvicorn:
+
+    uvicorn --factory mokkigo.asgi:create_asgi_app
+
+The server holds the connections on its event loop, and the adapter reads
+the request body there too, so idle keep-alive connections and slow clients
+do not tie up threads. Only a request with its whole body received is
+handed to the app, which runs in a bounded pool of ASGI_THREADS threads
+together with its database work. A response is sent from the event loop
+chunk by chunk while the thread of the request produces the next chunk of
+a streamed body.
+"""
+import asyncio
+import io
+import sys
+
+from concurrent.futures import ThreadPoolExecutor
+
+from mokkigo import create_app
+
+
+def build_environ(scope, body):
+    """Returns the WSGI environ of an ASGI HTTP scope and request body"""
+    root_path = scope.get("root_path", "")
+    path = scope["path"]
+    if path.startswith(root_path):
+        path = path[len(root_path):]
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        # WSGI strings are bytes decoded as latin-1, ASGI paths are unicode
+        "SCRIPT_NAME": root_path.encode("utf-8").decode("latin-1"),
+        "PATH_INFO": path.encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1] or 80),
+        "SERVER_PROTOCOL": "HTTP/{}".format(scope.get("http_version",
+                                                      "1.1")),
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    if scope.get("client"):
+        environ["REMOTE_ADDR"] = scope["client"][0]
+        environ["REMOTE_PORT"] = str(scope["client"][1])
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+            continue
+        if name == "CONTENT_LENGTH":
+            continue
+        key = "HTTP_" + name
+        if key in environ:
+            value = environ[key] + "," + value
+        environ[key] = value
+    return environ
+
+
+# Marks the end of the body in the queue of a _WsgiCall
+_END = object()
+
+
+class _WsgiCall(object):
+    """
+    One call of the WSGI app. The app and the iteration of its body run in
+    one thread of the pool, since the request context of Flask and the
+    cursor of a streamed query belong to the thread that made them. The
+    chunks are handed to the event loop through a queue of one chunk, so
+    the thread makes the next chunk while the previous one is sent.
+    """
+
+    def __init__(self, app, environ, loop):
+        self.app = app
+        self.environ = environ
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=1)
+        self.status = None
+        self.headers = None
+        self.cancelled = False
+        self.ended = False
+
+    def start_response(self, status, headers, exc_info=None):
+        if exc_info is not None and self.status is not None:
+            raise exc_info[1].with_traceback(exc_info[2])
+        self.status = status
+        self.headers = headers
+
+    def _put(self, item):
+        asyncio.run_coroutine_threadsafe(self.queue.put(item),
+                                         self.loop).result()
+
+    def run(self):
+        """Calls the app and puts the non-empty chunks of the body"""
+        try:
+            result = self.app(self.environ, self.start_response)
+            try:
+                for chunk in result:
+                    if self.cancelled:
+                        break
+                    if chunk:
+                        self._put(chunk)
+            finally:
+                if hasattr(result, "close"):
+                    result.close()
+        except Exception as e:
+            self._put(e)
+        finally:
+            self._put(_END)
+
+    async def next(self):
+        """Returns the next chunk of the body or None at the end"""
+        item = await self.queue.get()
+        if item is _END:
+            self.ended = True
+            return None
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    async def finish(self):
+        """Stops the body early if it was not sent to the end"""
+        self.cancelled = True
+        while not self.ended:
+            try:
+                await self.next()
+            except Exception:
+                pass
+
+
+class AsgiAdapter(object):
+    """
+    ASGI application running a WSGI app in a bounded thread pool.
+
+    : param app: the WSGI app, usually a Flask app
+    : param int threads: size of the pool
+    """
+
+    def __init__(self, app, threads):
+        self.app = app
+        self.executor = ThreadPoolExecutor(max_workers=threads,
+                                           thread_name_prefix="mokkigo-asgi")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self._http(scope, receive, send)
+        else:
+            raise ValueError("Unsupported ASGI scope {}".format(scope["type"]))
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.executor.shutdown(wait=True)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _read_body(self, receive):
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return None
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                return b"".join(chunks)
+
+    async def _http(self, scope, receive, send):
+        body = await self._read_body(receive)
+        if body is None:
+            return
+        loop = asyncio.get_running_loop()
+        call = _WsgiCall(self.app, build_environ(scope, body), loop)
+        running = loop.run_in_executor(self.executor, call.run)
+        try:
+            # A streamed body may call start_response only when its first
+            # chunk is made
+            chunk = await call.next()
+            following = None
+            if chunk is not None:
+                following = await call.next()
+            await send({
+                "type": "http.response.start",
+                "status": int(call.status.split(" ", 1)[0]),
+                "headers": [
+                    (name.lower().encode("latin-1"), value.encode("latin-1"))
+                    for name, value in call.headers
+                ],
+            })
+            await send({
+                "type": "http.response.body",
+                "body": chunk or b"",
+                "more_body": following is not None,
+            })
+            while following is not None:
+                chunk = following
+                following = await call.next()
+                await send({
+                    "type": "http.response.body",
+                    "body": chunk,
+                    "more_body": following is not None,
+                })
+        finally:
+            await call.finish()
+            await running
+
+
+def create_asgi_app(test_config=None):
+    """Creates the Flask app and wraps it in an AsgiAdapter"""
+    app = create_app(test_config)
+    return AsgiAdapter(app, app.config["ASGI_THREADS"])
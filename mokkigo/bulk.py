@@ -0,0 +1,151 @@
+"""
+Bulk creation of rows from a JSON array posted to a collection resource.
+
+All the entries are validated first, conflicting names are found with a few
+IN queries and the remaining rows are inserted in one transaction with a
+single executemany. The response lists the result of every entry in the
+order they were posted.
+"""
+from flask import Response, current_app
+from sqlalchemy.exc import IntegrityError
+
+from mokkigo import db
+from mokkigo.constants import MASON
+from mokkigo.metrics import timed
+from mokkigo.models import bump_versions
+from mokkigo.storage import begin_immediate, write_transaction
+from mokkigo.utils import MokkigoBuilder, create_error_response, json_dumps
+from mokkigo.validation import get_validator
+
+CREATED = "created"
+CONFLICT = "conflict"
+INVALID = "invalid"
+
+# Maximum number of bound parameters in one IN query, SQLite allows 999
+IN_CHUNK_SIZE = 500
+
+
+def find_existing(column, names):
+    """Returns the subset of names that already exist in column"""
+    names = list(names)
+    existing = set()
+    for i in range(0, len(names), IN_CHUNK_SIZE):
+        chunk = names[i:i + IN_CHUNK_SIZE]
+        rows = db.session.query(column).filter(column.in_(chunk))
+        existing.update(row[0] for row in rows)
+    return existing
+
+
+def find_ids(column, id_column, names):
+    """Returns a name -> id dictionary of the rows with the given names"""
+    names = list(names)
+    ids = {}
+    for i in range(0, len(names), IN_CHUNK_SIZE):
+        chunk = names[i:i + IN_CHUNK_SIZE]
+        rows = db.session.query(column, id_column).filter(column.in_(chunk))
+        ids.update(rows)
+    return ids
+
+
+def bulk_create(docs, model, key, to_row, href, after_insert=None,
+                find_conflicts=None, reject_conflicts=True):
+    """
+    Creates one row of model for every valid and non-conflicting document.
+
+    : param list docs: JSON documents of the new rows
+    : param Model model: model of the rows
+    : param str key: name of the unique field, same in documents and table
+    : param function to_row: returns the column values of a valid document,
+        may raise ValueError for values the schema cannot check
+    : param function href: returns the URL of the row created from a document
+    : param function after_insert: optional, called with the created documents
+        after the rows are inserted but before the commit
+    : param function find_conflicts: optional, given the rows about to be
+        created returns a conflict message or None for each of them
+    : param bool reject_conflicts: whether rows with a message from
+        find_conflicts are left out or created with the message as a warning
+    """
+    validator = get_validator(model, check_formats=True)
+    fast = current_app.config["VALIDATION_FAST_PATH"]
+    results = [None] * len(docs)
+    rows = []
+    created = []
+    seen = set()
+
+    for idx, doc in enumerate(docs):
+        with timed("validate"):
+            error = None
+            if not validator.is_valid(doc, fast):
+                error = validator.first_error(doc)
+        if error is not None:
+            results[idx] = (INVALID, error.message)
+            continue
+        try:
+            row = to_row(doc)
+        except (ValueError, OverflowError) as e:
+            results[idx] = (INVALID, str(e))
+            continue
+        if doc[key] in seen:
+            results[idx] = (CONFLICT, "Duplicate name in the request")
+            continue
+        seen.add(doc[key])
+        rows.append((idx, doc, row))
+
+    column = getattr(model, key)
+    existing = find_existing(column, seen)
+    new_rows = []
+    for idx, doc, row in rows:
+        if doc[key] in existing:
+            results[idx] = (CONFLICT, "Already exists")
+        else:
+            new_rows.append((idx, doc, row))
+    rows = new_rows
+
+    def insert():
+        # Repeated on retries, so the results of a failed try are replaced
+        del created[:]
+        messages = [None] * len(rows)
+        if find_conflicts is not None:
+            # The conflicts are checked under the write lock, like a single
+            # POST does, so concurrent writers cannot create any between the
+            # check and the insert
+            begin_immediate()
+            messages = find_conflicts([row for idx, doc, row in rows])
+        for (idx, doc, row), message in zip(rows, messages):
+            if message is not None and reject_conflicts:
+                results[idx] = (CONFLICT, message)
+            else:
+                results[idx] = (CREATED, message)
+                created.append((doc, row))
+        if not created:
+            return
+        db.session.execute(model.__table__.insert(),
+                           [row for doc, row in created])
+        if after_insert is not None:
+            after_insert([doc for doc, row in created])
+        bump_versions(db.session.connection(), [model.__tablename__])
+
+    if rows:
+        try:
+            write_transaction(insert)
+        except IntegrityError:
+            return create_error_response(
+                    status_code=409,
+                    title="Conflicting concurrent write",
+                    message="Some of the rows were created by another "
+                            "request, nothing was created"
+            )
+
+    with timed("mason"):
+        body = MokkigoBuilder(items=[])
+        for doc, (status, message) in zip(docs, results):
+            entry = MokkigoBuilder(status=status)
+            if message is not None:
+                entry["message"] = message
+            if status == CREATED:
+                entry.add_control("self", href(doc))
+            body["items"].append(entry)
+
+    with timed("encode"):
+        data = json_dumps(body)
+    return Response(data, 200, mimetype=MASON)
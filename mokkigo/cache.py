@@ -0,0 +1,161 @@
+"""
+Cross-request name -> row cache used by the URL converters.
+
+The cache stores plain column snapshots instead of ORM instances, because
+instances are bound to the session of the request that loaded them. A cache
+hit is turned back into a persistent instance of the current session without
+running a SELECT. Entries are evicted by LRU order, by age (TTL) and by the
+mapper events of the models whenever a row is inserted, updated or deleted.
+
+The mapper events only see the writes of this process. Every entry also
+keeps the change counter (see models.TableVersion) its table had when the
+row was read, and a hit is used only if the counter has not changed since,
+so writes of other processes are seen too. The counters are read once per
+request and shared with the ETag, so a hit still needs no query of its own.
+"""
+import threading
+import time
+
+from collections import OrderedDict
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, make_transient_to_detached
+
+from mokkigo import db
+from mokkigo.models import Mokki, Item, Participant, Visit, get_versions
+
+# Column used in the URLs of each model
+NAME_COLUMNS = {
+    Mokki: "name",
+    Item: "name",
+    Participant: "name",
+    Visit: "visit_name",
+}
+
+
+class IdentityCache(object):
+    """
+    Thread safe LRU cache with a time to live. Keys are (model, name) tuples
+    and values are dictionaries of column values, stored with the version
+    of the table they were read at.
+    """
+
+    def __init__(self, size=1024, ttl=30):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, model, name, version=None):
+        """
+        Returns the values of the entry, or None if there is no entry, it
+        has expired or was stored at another version than the given one
+        """
+        key = (model, name)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, stored_version, values = entry
+            if expires < time.monotonic() or stored_version != version:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return values
+
+    def put(self, model, name, values, version=None):
+        if self.size <= 0:
+            return
+        key = (model, name)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, version,
+                                  values)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def evict(self, model, name):
+        with self._lock:
+            self._entries.pop((model, name), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def get_cache():
+    return current_app.extensions["mokkigo_identity_cache"]
+
+
+def get_by_name(model, name):
+    """
+    Returns the row of model with the given URL name or None. Cache hits do
+    not query the database other than for the change counters.
+    """
+    cache = get_cache()
+    # Read before the row, so a write in between leaves a stale version
+    version = get_versions((model.__tablename__,))[0]
+    values = cache.get(model, name, version)
+    if values is not None:
+        obj = model(**values)
+        make_transient_to_detached(obj)
+        return db.session.merge(obj, load=False)
+
+    column = getattr(model, NAME_COLUMNS[model])
+    obj = model.query.filter(column == name).first()
+    if obj is not None:
+        cache.put(model, name, _snapshot(obj), version)
+    return obj
+
+
+def _snapshot(obj):
+    return {
+        attr.key: getattr(obj, attr.key)
+        for attr in inspect(obj).mapper.column_attrs
+    }
+
+
+def _names(target):
+    """Current and previous (if changed) URL names of target"""
+    history = inspect(target).attrs[NAME_COLUMNS[type(target)]].history
+    return set(name for name in history.sum() if name is not None)
+
+
+def _evict(mapper, connection, target):
+    if not has_app_context():
+        return
+    cache = get_cache()
+    names = _names(target)
+    if not names:
+        # Name was not loaded, so we cannot know which entry to evict
+        cache.clear()
+    for name in names:
+        cache.evict(type(target), name)
+
+    # Evict again after commit so that a concurrent request that read the
+    # old committed row between the flush and the commit cannot keep it
+    session = inspect(target).session
+    if session is not None:
+        pending = session.info.setdefault("evicted", set())
+        pending.update((type(target), name) for name in names)
+
+
+@event.listens_for(Session, "after_commit")
+def _evict_committed(session):
+    pending = session.info.pop("evicted", None)
+    if pending and has_app_context():
+        cache = get_cache()
+        for model, name in pending:
+            cache.evict(model, name)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_evicted(session):
+    session.info.pop("evicted", None)
+
+
+for _model in NAME_COLUMNS:
+    event.listen(_model, "after_insert", _evict)
+    event.listen(_model, "after_update", _evict)
+    event.listen(_model, "after_delete", _evict)
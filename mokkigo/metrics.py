@@ -0,0 +1,192 @@
+"""
+Lightweight per-request instrumentation of the API.
+
+Every SQL statement executed by SQLAlchemy while an app context is active is
+counted into flask.g, so tests and debugging tools can check how many queries
+a single request needed. Other events (e.g. retried writes) are counted both
+for the current request and for the whole process.
+
+With SERVER_TIMING enabled the requests of the API are also timed by part:
+URL converters, JSON schema validation, SQL execution, building the Mason
+documents and encoding them to JSON. The times are sent in the
+Server-Timing header of the response and, with SERVER_TIMING_LOG, logged as
+one JSON line per request together with the counters of the request. Timing
+a part costs two perf_counter() calls, so it can be left on in production.
+"""
+import json
+import threading
+import time
+
+from collections import Counter
+
+from flask import current_app, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_app_context():
+        g.query_count = g.get("query_count", 0) + 1
+
+
+def get_query_count():
+    """
+    Returns the number of SQL statements executed in the current app context
+    """
+    return g.get("query_count", 0)
+
+
+def reset_query_count():
+    g.query_count = 0
+
+
+_counters = Counter()
+_counters_lock = threading.Lock()
+
+
+def count(name, amount=1):
+    """Adds amount to the counter name of the request and of the process"""
+    with _counters_lock:
+        _counters[name] += amount
+    if has_app_context():
+        counters = g.setdefault("counters", Counter())
+        counters[name] += amount
+
+
+def get_counters(process=False):
+    """
+    Returns the counters of the current request, or of the whole process if
+    process is True, as a dictionary
+    """
+    if process:
+        with _counters_lock:
+            return dict(_counters)
+    return dict(g.get("counters", {}))
+
+
+# Parts of a request timed separately, in the order of the Server-Timing
+# header. "app" is the rest of the time spent in the API, e.g. in the
+# resource methods.
+TIMING_METRICS = ("convert", "validate", "db", "mason", "encode", "app")
+
+
+class Timings(object):
+    """
+    Times spent in the parts of the current request, in seconds. The times
+    are exclusive: a part timed inside another, like the queries of a URL
+    converter, is left out of the outer one, so the times add up to at most
+    the total.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.recorded = 0.0
+        self.times = {}
+
+    def add(self, name, seconds):
+        self.times[name] = self.times.get(name, 0.0) + seconds
+        self.recorded += seconds
+
+
+def get_timings():
+    """
+    Returns the Timings of the current app context, or None if SERVER_TIMING
+    is disabled or there is no app context
+    """
+    if not has_app_context():
+        return None
+    timings = g.get("timings")
+    if timings is None:
+        if current_app.config["SERVER_TIMING"]:
+            timings = Timings()
+        else:
+            timings = False
+        g.timings = timings
+    return timings or None
+
+
+class _Timer(object):
+    __slots__ = ("name", "timings", "recorded", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.timings = get_timings()
+        if self.timings is not None:
+            self.recorded = self.timings.recorded
+            self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        if self.timings is not None:
+            elapsed = time.perf_counter() - self.start
+            nested = self.timings.recorded - self.recorded
+            self.timings.add(self.name, elapsed - nested)
+
+
+def timed(name):
+    """
+    Returns a context manager that adds the time spent in its block to the
+    part name of the current request
+    """
+    return _Timer(name)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_query_timer(conn, cursor, statement, parameters, context,
+                      executemany):
+    if context is not None:
+        context.timer = timed("db")
+        context.timer.__enter__()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def stop_query_timer(conn, cursor, statement, parameters, context,
+                     executemany):
+    if context is not None and hasattr(context, "timer"):
+        context.timer.__exit__(None, None, None)
+
+
+def start_timing():
+    """Starts timing a request of the API, before_request of api_bp"""
+    get_timings()
+
+
+def add_server_timing(response):
+    """
+    Adds the Server-Timing header to a response of the API and logs the
+    times if SERVER_TIMING_LOG is enabled, after_request of api_bp.
+
+    The body of a streamed response is written after the header, so only
+    the work done before it is included.
+    """
+    timings = get_timings()
+    # The app context, and g, may be shared by several requests
+    g.pop("timings", None)
+    if timings is None:
+        return response
+    total = time.perf_counter() - timings.start
+    times = dict(timings.times)
+    times["app"] = max(0.0, total - timings.recorded)
+    parts = ["{};dur={:.3f}".format(name, times[name] * 1000)
+             for name in TIMING_METRICS if name in times]
+    parts.append("total;dur={:.3f}".format(total * 1000))
+    response.headers["Server-Timing"] = ", ".join(parts)
+
+    if current_app.config["SERVER_TIMING_LOG"]:
+        record = {
+            "method": request.method,
+            "path": request.path,
+            "status": response.status_code,
+            "queries": get_query_count(),
+            "total_ms": round(total * 1000, 3),
+        }
+        for name in TIMING_METRICS:
+            if name in times:
+                record[name + "_ms"] = round(times[name] * 1000, 3)
+        # Events of the request, e.g. write_retries and
+        # write_retry_failures of storage.retry_transaction()
+        record.update(get_counters())
+        current_app.logger.info("server-timing %s", json.dumps(record))
+    return response
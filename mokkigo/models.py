@@ -1,12 +1,19 @@
+import json
+
 import click
 
+from datetime import datetime
+
+from flask import g, has_app_context
 from flask.cli import with_appcontext
 from sqlalchemy.engine import Engine
-from sqlalchemy import event
-
-from dateutil import parser
+from sqlalchemy import event, inspect, select, text, DateTime
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateTable
 
 from mokkigo import db
+from mokkigo.timeutils import parse_datetime, to_epoch
 
 
 @event.listens_for(Engine, "connect")
@@ -23,11 +30,15 @@ def set_sqlite_pragma(dbapi_connection, connection_record):
 #     db.Column("participant_id", db.ForeignKey("participant.id"),
 #               primary_key=True)
 # )
+# The primary key also serves the visits of a participant and the reverse
+# index the participants of a visit
 participant_visit = db.Table(
         'participant_visit',
         db.Column('participant_id', db.Integer,
-                  db.ForeignKey('participant.id')),
-        db.Column('visit_id', db.Integer, db.ForeignKey('visit.id'))
+                  db.ForeignKey('participant.id'), primary_key=True),
+        db.Column('visit_id', db.Integer, db.ForeignKey('visit.id'),
+                  primary_key=True),
+        db.Index('ix_participant_visit_visit_id', 'visit_id')
         )
 
 
@@ -37,12 +48,15 @@ class Mokki(db.Model):
     name            String, unique
     location        String
     items           table of Item objects
+    visits          table of Visit objects, deleted with the mokki
     """
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(128), nullable=False, unique=True)
     location = db.Column(db.String(128), nullable=False)
     items = db.relationship("Item")
+    visits = db.relationship("Visit", back_populates="mokki",
+                             cascade="all, delete-orphan")
 
     def json_schema():
         schema = {
@@ -155,27 +169,67 @@ class Participant(db.Model):
         self.allergies = doc.get("allergies")
 
 
+def _epoch_default(column):
+    """
+    Column default computing an epoch column from the value of the DateTime
+    column in the same insert, before the UTC offset is dropped
+    """
+    def default(context):
+        return to_epoch(context.get_current_parameters()[column])
+    return default
+
+
 class Visit(db.Model):
     """
     Visit table
     visit_name       String
     time_start       String in format of date-time (ISO8601)
     time_end         String in format of date-time (ISO8601)
-    mokki_name       String name reference to mokki where this visit occurred
+    time_start_epoch Integer, time_start in UTC as microseconds since epoch
+    time_end_epoch   Integer, time_end in UTC as microseconds since epoch
+    mokki            Mokki object where this visit occurs
     participants     table of Participant objects
+
+    The representation refers to the mokki by its name (mokki_name). The
+    DateTime columns keep the date-times as given without their UTC offset,
+    the range queries compare the epoch columns (see mokkigo.timeutils).
     """
     __tablename__ = "visit"
+    __table_args__ = (
+        # Visits of one mokki in the order of their URL names
+        db.Index("ix_visit_mokki_id_visit_name", "mokki_id", "visit_name"),
+        # Range scans of the ?from=&to= filters, with and without a mokki.
+        # time_end comes first because the visits ending after ?from= are
+        # few compared to the visits starting before ?to=
+        db.Index("ix_visit_mokki_id_time_end_epoch", "mokki_id",
+                 "time_end_epoch", "time_start_epoch"),
+        db.Index("ix_visit_time_end_epoch", "time_end_epoch",
+                 "time_start_epoch"),
+    )
     id = db.Column(db.Integer, primary_key=True)
     visit_name = db.Column(db.String(128), nullable=False, unique=True)
-    mokki_name = db.Column(db.String(128), nullable=False)
+    mokki_id = db.Column(db.Integer, db.ForeignKey("mokki.id"))
     time_start = db.Column(db.DateTime, nullable=False)
     time_end = db.Column(db.DateTime, nullable=False)
-
+    # Filled from the DateTime values of every insert, also of the inserts
+    # that bypass the ORM, and by update_visit_epochs() on updates
+    time_start_epoch = db.Column(db.Integer, nullable=False,
+                                 default=_epoch_default("time_start"))
+    time_end_epoch = db.Column(db.Integer, nullable=False,
+                               default=_epoch_default("time_end"))
+
+    mokki = db.relationship("Mokki", back_populates="visits")
     participants = db.relationship('Participant',
                                    secondary=participant_visit,
                                    backref='visit'
                                    )
 
+    @property
+    def mokki_name(self):
+        if self.mokki is None:
+            return None
+        return self.mokki.name
+
     def json_schema():
         schema = {
                 "type": "object",
@@ -220,13 +274,425 @@ class Visit(db.Model):
     #     }
 
     def deserialize(self, doc):
+        """
+        Sets the attributes of the visit from the document, except the
+        mokki which must be looked up by mokki_name by the caller.
+        """
         self.visit_name = doc["visit_name"]
-        self.mokki_name = doc["mokki_name"]
-        self.time_start = parser.parse(doc["time_start"])
-        self.time_end = parser.parse(doc["time_end"])
+        self.time_start = parse_datetime(doc["time_start"])
+        self.time_end = parse_datetime(doc["time_end"])
+
+
+@event.listens_for(Visit, "before_update")
+def update_visit_epochs(mapper, connection, target):
+    """
+    Updates the epoch columns of a visit whose date-times were changed. The
+    unchanged values are loaded without their UTC offset, so they must not
+    be converted again.
+    """
+    state = inspect(target)
+    if state.attrs.time_start.history.has_changes():
+        target.time_start_epoch = to_epoch(target.time_start)
+    if state.attrs.time_end.history.has_changes():
+        target.time_end_epoch = to_epoch(target.time_end)
+
+
+class TableVersion(db.Model):
+    """
+    Change counter of each table, bumped in the same transaction as every
+    write to the table. Used for computing ETags without reading the rows.
+    table_name      String, name of the counted table
+    version         Integer
+    """
+    __tablename__ = "table_version"
+    table_name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
+def bump_versions(connection, table_names):
+    """
+    Increments the change counters of the given tables. Must be called for
+    writes that do not go through the ORM session (e.g. Core inserts).
+    """
+    for name in table_names:
+        stmt = insert(TableVersion.__table__).values(table_name=name,
+                                                     version=1)
+        stmt = stmt.on_conflict_do_update(
+                index_elements=["table_name"],
+                set_={"version": TableVersion.__table__.c.version + 1}
+        )
+        connection.execute(stmt)
+    forget_versions()
+
+
+def get_versions(table_names):
+    """
+    Returns the change counters of the given tables as a tuple, in the same
+    order as table_names. The counters of all the tables are read with one
+    query and kept in the app context until it writes, so the URL
+    converters and the ETag of a request share them.
+    """
+    versions = g.get("table_versions") if has_app_context() else None
+    if versions is None:
+        versions = dict(db.session.query(TableVersion.table_name,
+                                         TableVersion.version))
+        if has_app_context():
+            g.table_versions = versions
+    return tuple(versions.get(name, 0) for name in table_names)
+
+
+def forget_versions():
+    """Makes the next get_versions() of the app context read the counters"""
+    if has_app_context():
+        g.pop("table_versions", None)
+
+
+@event.listens_for(Session, "after_flush")
+def bump_flushed_versions(session, flush_context):
+    # Assigning the participants of a visit also makes the participants
+    # dirty through the backref, so a dirty object only counts if its
+    # columns changed. The links are part of the representation of a visit
+    # only, so its collections count too.
+    changed = [obj for obj in session.dirty if session.is_modified(
+        obj, include_collections=isinstance(obj, Visit))]
+    table_names = set()
+    for obj in list(session.new) + changed + list(session.deleted):
+        table = getattr(obj, "__table__", None)
+        if table is not None and table.name != TableVersion.__tablename__:
+            table_names.add(table.name)
+    if table_names:
+        bump_versions(session.connection(), sorted(table_names))
+
+
+# Searchable tables as (table, name column, text column). The FTS5 table
+# search_index is kept in sync by triggers, so writes that bypass the ORM
+# (bulk creation, import-db) are indexed too. The rowid of an index row is
+# the id of the source row times len(SEARCH_SOURCES) plus the position of
+# its table in this list, so the triggers find the row by rowid.
+SEARCH_SOURCES = [
+    ("mokki", "name", "location"),
+    ("item", "name", None),
+    ("participant", "name", "allergies"),
+    ("visit", "visit_name", None),
+]
+
+SEARCH_INDEX_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5("
+    "name, body, tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+)
+
+SEARCH_TRIGGER_DDL = """
+CREATE TRIGGER IF NOT EXISTS {table}_search_{event} AFTER {event} ON {table}
+BEGIN
+    {statements}
+END
+"""
+
+
+def _search_values(table, name, text_column, prefix):
+    rowid = "{}.id * {} + {}".format(
+        prefix, len(SEARCH_SOURCES),
+        [source[0] for source in SEARCH_SOURCES].index(table))
+    body = "NULL" if text_column is None else prefix + "." + text_column
+    return rowid, prefix + "." + name, body
+
+
+def _search_statements(table, name, text_column, event_name):
+    statements = []
+    if event_name in ("update", "delete"):
+        rowid = _search_values(table, name, text_column, "old")[0]
+        statements.append(
+            "DELETE FROM search_index WHERE rowid = {};".format(rowid))
+    if event_name in ("insert", "update"):
+        statements.append(
+            "INSERT INTO search_index (rowid, name, body) "
+            "VALUES ({}, {}, {});".format(
+                *_search_values(table, name, text_column, "new")))
+    return "\n    ".join(statements)
+
+
+def create_search_triggers(connection, table):
+    """Creates the triggers keeping search_index in sync with table"""
+    for source, name, text_column in SEARCH_SOURCES:
+        if source != table:
+            continue
+        for event_name in ("insert", "update", "delete"):
+            connection.execute(text(SEARCH_TRIGGER_DDL.format(
+                table=table,
+                event=event_name,
+                statements=_search_statements(table, name, text_column,
+                                              event_name)
+            )))
+
+
+@event.listens_for(db.metadata, "after_create")
+def create_search_index(target, connection, **kw):
+    if connection.dialect.name != "sqlite":
+        return
+    connection.execute(text(SEARCH_INDEX_DDL))
+    for source in SEARCH_SOURCES:
+        create_search_triggers(connection, source[0])
+
+
+@event.listens_for(db.metadata, "after_drop")
+def drop_search_index(target, connection, **kw):
+    if connection.dialect.name == "sqlite":
+        connection.execute(text("DROP TABLE IF EXISTS search_index"))
+
+
+def rebuild_search_index(conn):
+    """Fills search_index from the source tables"""
+    conn.execute(text("DELETE FROM search_index"))
+    for table, name, text_column in SEARCH_SOURCES:
+        conn.execute(text(
+            "INSERT INTO search_index (rowid, name, body) "
+            "SELECT {}, {}, {} FROM {} AS src".format(
+                *_search_values(table, name, text_column, "src"), table)
+        ))
 
 
 @click.command("init-db")
 @with_appcontext
 def init_db_command():
     db.create_all()  # pragma: no coverity
+
+
+# Tables of export-db and import-db, referenced tables before referencing
+EXPORT_TABLES = ["mokki", "participant", "visit", "item", "participant_visit"]
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError("Cannot serialize {!r}".format(value))
+
+
+@click.command("export-db")
+@click.argument("output", type=click.File("w"), default="-")
+@click.option("--batch-size", default=1000, show_default=True,
+              help="Number of rows fetched from the database at a time")
+@with_appcontext
+def export_db_command(output, batch_size):
+    """
+    Writes all the rows to OUTPUT (default stdout) as newline delimited JSON,
+    one {"table": ..., "row": {...}} object per line. Rows are streamed from
+    the database in batches, so memory use does not grow with the data.
+    """
+    conn = db.session.connection().execution_options(stream_results=True)
+    for name in EXPORT_TABLES:
+        table = db.metadata.tables[name]
+        result = conn.execute(select(table))
+        for rows in result.partitions(batch_size):
+            output.write("".join(
+                json.dumps({"table": name, "row": dict(row._mapping)},
+                           default=_json_default) + "\n"
+                for row in rows
+            ))
+    db.session.rollback()
+
+
+@click.command("import-db")
+@click.argument("source", type=click.File("r"), default="-")
+@click.option("--commit-size", default=10000, show_default=True,
+              help="Number of rows inserted in one transaction")
+@with_appcontext
+def import_db_command(source, commit_size):
+    """
+    Inserts the rows of an export-db file read from SOURCE (default stdin).
+    Consecutive rows of the same table are inserted with executemany and the
+    transaction is committed every --commit-size rows.
+    """
+    batch = []
+    batch_table = None
+    pending = 0
+    count = 0
+
+    def flush():
+        if batch:
+            db.session.execute(batch_table.insert(), batch)
+
+    for line in source:
+        if not line.strip():
+            continue
+        doc = json.loads(line)
+        table = db.metadata.tables[doc["table"]]
+        if table is not batch_table:
+            flush()
+            batch = []
+            batch_table = table
+        row = doc["row"]
+        for column in table.columns:
+            if isinstance(column.type, DateTime) and row.get(column.name):
+                row[column.name] = datetime.fromisoformat(row[column.name])
+        batch.append(row)
+        pending += 1
+        count += 1
+        if pending >= commit_size:
+            flush()
+            batch = []
+            db.session.commit()
+            pending = 0
+
+    flush()
+    bump_versions(db.session.connection(), EXPORT_TABLES)
+    db.session.commit()
+    click.echo("Imported {} rows".format(count), err=True)
+
+
+def _migrate_visit_mokki_id(conn):
+    """Replaces the free text visit.mokki_name with the mokki_id foreign key"""
+    columns = [column["name"] for column in inspect(conn).get_columns("visit")]
+    if "mokki_id" in columns or "mokki_name" not in columns:
+        return
+    conn.execute(text(
+        "ALTER TABLE visit ADD COLUMN mokki_id INTEGER REFERENCES mokki(id)"
+    ))
+    conn.execute(text(
+        "UPDATE visit SET mokki_id = "
+        "(SELECT mokki.id FROM mokki WHERE mokki.name = visit.mokki_name)"
+    ))
+    orphans = conn.execute(text(
+        "SELECT visit_name, mokki_name FROM visit WHERE mokki_id IS NULL"
+    )).all()
+    for visit_name, mokki_name in orphans:
+        click.echo("Visit {} refers to unknown mokki {}".format(
+            visit_name, mokki_name), err=True)
+    # Needs SQLite 3.35 or newer
+    conn.execute(text("ALTER TABLE visit DROP COLUMN mokki_name"))
+    click.echo("Migrated visit.mokki_name to visit.mokki_id", err=True)
+
+
+def _migrate_participant_visit_pk(conn):
+    """
+    Rebuilds participant_visit with the (participant_id, visit_id) primary
+    key, dropping duplicate and incomplete links
+    """
+    pk = inspect(conn).get_pk_constraint("participant_visit")
+    if pk["constrained_columns"]:
+        return
+    before = conn.execute(text(
+        "SELECT COUNT(*) FROM participant_visit"
+    )).scalar()
+    conn.execute(text(
+        "ALTER TABLE participant_visit RENAME TO participant_visit_old"
+    ))
+    participant_visit.create(conn)
+    conn.execute(text(
+        "INSERT OR IGNORE INTO participant_visit (participant_id, visit_id) "
+        "SELECT participant_id, visit_id FROM participant_visit_old "
+        "WHERE participant_id IS NOT NULL AND visit_id IS NOT NULL"
+    ))
+    conn.execute(text("DROP TABLE participant_visit_old"))
+    after = conn.execute(text(
+        "SELECT COUNT(*) FROM participant_visit"
+    )).scalar()
+    click.echo("Added the primary key of participant_visit, removed {} "
+               "duplicate links".format(before - after), err=True)
+
+
+def _migrate_search_index(conn):
+    """Indexes the rows written before search_index existed"""
+    indexed = conn.execute(text("SELECT COUNT(*) FROM search_index")).scalar()
+    total = sum(
+        conn.execute(text("SELECT COUNT(*) FROM " + table)).scalar()
+        for table, name, text_column in SEARCH_SOURCES
+    )
+    if indexed != total:
+        rebuild_search_index(conn)
+        click.echo("Rebuilt search_index with {} rows".format(total),
+                   err=True)
+
+
+def _migrate_visit_epochs(conn):
+    """
+    Adds the epoch columns of visit and replaces the range indexes on the
+    DateTime columns with indexes on them. The offsets of the stored
+    date-times are not known, so they are taken to be in UTC.
+
+    SQLite cannot add a NOT NULL column without a default, so the columns
+    are added as nullable, filled and then the table is rebuilt with the
+    schema of the model.
+    """
+    columns = {column["name"]: column
+               for column in inspect(conn).get_columns("visit")}
+    if "time_start_epoch" in columns:
+        if columns["time_start_epoch"]["nullable"]:
+            _rebuild_visit_table(conn)
+        return
+    for column in ("time_start", "time_end"):
+        conn.execute(text(
+            "ALTER TABLE visit ADD COLUMN {}_epoch INTEGER".format(column)
+        ))
+        # The DateTime columns are stored as "YYYY-MM-DD HH:MM:SS.ffffff"
+        conn.execute(text(
+            "UPDATE visit SET {0}_epoch = "
+            "CAST(strftime('%s', {0}) AS INTEGER) * 1000000 + "
+            "CAST(substr({0}, 21, 6) AS INTEGER)".format(column)
+        ))
+    conn.execute(text("DROP INDEX IF EXISTS ix_visit_mokki_id_time_end"))
+    conn.execute(text("DROP INDEX IF EXISTS ix_visit_time_end"))
+    _rebuild_visit_table(conn)
+    click.echo("Added the epoch columns of visit", err=True)
+
+
+def _rebuild_visit_table(conn):
+    """
+    Rebuilds visit with the schema of the model, keeping the ids of the
+    rows. The foreign keys cannot be turned off inside the transaction of
+    migrate-db, so the links of participant_visit are set aside while the
+    old table is dropped.
+    """
+    conn.execute(text(
+        "CREATE TEMPORARY TABLE participant_visit_old AS "
+        "SELECT participant_id, visit_id FROM participant_visit"
+    ))
+    conn.execute(text("DELETE FROM participant_visit"))
+
+    metadata = db.MetaData()
+    Mokki.__table__.to_metadata(metadata)
+    new_table = Visit.__table__.to_metadata(metadata, name="visit_new")
+    conn.execute(CreateTable(new_table))
+    columns = ", ".join(column.name for column in Visit.__table__.columns)
+    conn.execute(text("INSERT INTO visit_new ({0}) SELECT {0} FROM visit"
+                      .format(columns)))
+    # Also drops the indexes and the search triggers of the table, the
+    # implicit delete does not run the triggers so search_index is kept
+    conn.execute(text("DROP TABLE visit"))
+    conn.execute(text("ALTER TABLE visit_new RENAME TO visit"))
+    for index in Visit.__table__.indexes:
+        index.create(conn)
+    create_search_triggers(conn, "visit")
+
+    conn.execute(text(
+        "INSERT INTO participant_visit (participant_id, visit_id) "
+        "SELECT participant_id, visit_id FROM participant_visit_old"
+    ))
+    conn.execute(text("DROP TABLE participant_visit_old"))
+
+
+# Schema migrations of migrate-db in the order they were introduced. Every
+# migration checks the schema itself and does nothing if already applied.
+MIGRATIONS = [
+    _migrate_visit_mokki_id,
+    _migrate_participant_visit_pk,
+    _migrate_search_index,
+    _migrate_visit_epochs,
+]
+
+
+@click.command("migrate-db")
+@with_appcontext
+def migrate_db_command():
+    """
+    Upgrades the schema of an existing database to the current models.
+    Missing tables and indexes are created and MIGRATIONS are applied.
+    """
+    db.create_all()
+    conn = db.session.connection()
+    for migration in MIGRATIONS:
+        migration(conn)
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+    bump_versions(conn, EXPORT_TABLES)
+    db.session.commit()
@@ -0,0 +1,289 @@
+"""
+Occupancy calendar of a mokki.
+
+The visits of the requested range are read with one query that uses the
+(mokki_id, time_end_epoch) index of the visits, and are bucketed into days with
+difference arrays: every visit adds +1 at its first day and -1 after its last
+day, and a running sum gives the occupancy of each day. The work is linear in
+the number of visits in the range and the number of days. NumPy is used for
+the bucketing if it is installed.
+"""
+from datetime import date, datetime, time, timedelta
+from functools import lru_cache
+from itertools import accumulate
+
+from flask import current_app, request, Response, url_for
+from flask_restful import Resource
+from sqlalchemy import func, literal_column
+from werkzeug.exceptions import BadRequest
+
+from mokkigo import db
+from mokkigo.constants import JSON, LINK_RELATIONS_URL, MASON
+from mokkigo.metrics import timed
+from mokkigo.models import Visit, participant_visit
+from mokkigo.timeutils import to_epoch
+from mokkigo.utils import (MokkigoBuilder, create_error_response, get_etag,
+                           get_time_arg, is_lean, json_dumps, not_modified,
+                           request_url)
+
+# Length of the calendar when ?to= is not given
+DEFAULT_DAYS = 31
+
+
+def _day_range():
+    """
+    Returns the first day and the day after the last day of the requested
+    calendar as dates.
+    """
+    time_from = get_time_arg("from")
+    time_to = get_time_arg("to")
+    first = date.today() if time_from is None else time_from.date()
+    if time_to is None:
+        end = first + timedelta(days=DEFAULT_DAYS)
+    else:
+        end = time_to.date()
+    max_days = current_app.config["CALENDAR_MAX_DAYS"]
+    if not 0 < (end - first).days <= max_days:
+        raise BadRequest(response=create_error_response(
+                status_code=400,
+                title="Invalid query parameter",
+                message="to must be after from and the calendar can have at "
+                        "most {} days".format(max_days)
+        ))
+    return first, end
+
+
+def _get_stay():
+    stay = request.args.get("stay")
+    if stay is None:
+        return None
+    try:
+        stay = int(stay)
+    except ValueError:
+        stay = 0
+    if stay < 1:
+        raise BadRequest(response=create_error_response(
+                status_code=400,
+                title="Invalid query parameter",
+                message="stay must be a positive integer"
+        ))
+    return stay
+
+
+def _day_span(time_start, time_end, first):
+    """
+    Returns the indexes of the first day of a visit and of the day after its
+    last day, counted from the day first. A visit ending at midnight does not
+    occupy the day that starts then.
+    """
+    start = time_start.date().toordinal() - first.toordinal()
+    end = time_end.date().toordinal() - first.toordinal()
+    if time_end.time() != time.min or time_end == time_start:
+        end += 1
+    return start, end
+
+
+@lru_cache(maxsize=None)
+def _get_numpy():
+    """
+    Returns the numpy module or None if it is not installed. It is imported
+    at the first calendar with visits rather than with the resources, since
+    it is slow to import.
+    """
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def bucket_days(days, spans):
+    """
+    Returns the number of visits and the number of participants on each day.
+
+    : param int days: number of days in the calendar
+    : param list spans: (first day, day after last day, participants) of each
+        visit, already clipped to 0...days
+    """
+    numpy = _get_numpy() if spans else None
+    if numpy is not None:
+        first, end, heads = numpy.array(spans, dtype=numpy.int64).T
+        visits = (numpy.bincount(first, minlength=days + 1) -
+                  numpy.bincount(end, minlength=days + 1))
+        people = (numpy.bincount(first, weights=heads, minlength=days + 1) -
+                  numpy.bincount(end, weights=heads, minlength=days + 1))
+        return (numpy.cumsum(visits[:days]).tolist(),
+                numpy.cumsum(people[:days]).astype(numpy.int64).tolist())
+
+    visits = [0] * (days + 1)
+    people = [0] * (days + 1)
+    for first, end, heads in spans:
+        visits[first] += 1
+        visits[end] -= 1
+        people[first] += heads
+        people[end] -= heads
+    return (list(accumulate(visits[:days])),
+            list(accumulate(people[:days])))
+
+
+def free_slots(first, visits, stay):
+    """
+    Returns the runs of free days of the calendar that are at least stay days
+    long, as dictionaries with the first day and the day after the last day.
+    """
+    slots = []
+    start = None
+    for idx, count in enumerate(visits + [1]):
+        if count == 0 and start is None:
+            start = idx
+        elif count != 0 and start is not None:
+            if idx - start >= stay:
+                slots.append({
+                    "from": (first + timedelta(days=start)).isoformat(),
+                    "to": (first + timedelta(days=idx)).isoformat(),
+                    "days": idx - start
+                })
+            start = None
+    return slots
+
+
+class MokkiCalendar(Resource):
+    def get(self, mokki):
+        """
+        GET method for MokkiCalendar
+        OpenAPI description below:
+        ---
+        description: >
+          Get the occupancy of one mokki for each day of a date range, and
+          optionally the free periods where a stay of the given length fits
+        parameters:
+          - in: path
+            name: mokki
+            schema:
+              type: string
+            required: true
+            description: name of the mokki
+            example:
+              Ii-mokki
+          - in: query
+            name: from
+            schema:
+              type: string
+              format: date
+            required: false
+            description: first day of the calendar, today by default
+          - in: query
+            name: to
+            schema:
+              type: string
+              format: date
+            required: false
+            description: >
+              day after the last day of the calendar, 31 days after from
+              by default
+          - in: query
+            name: stay
+            schema:
+              type: integer
+            required: false
+            description: length in days of the stay to find free slots for
+          - $ref: '#/components/parameters/controls'
+        responses:
+          '200':
+            description: Occupancy of each day
+            content:
+              application/json:
+                example:
+                  from: "2022-06-01"
+                  to: "2022-06-03"
+                  days:
+                  - date: "2022-06-01"
+                    visits: 1
+                    participants: 3
+                  - date: "2022-06-02"
+                    visits: 0
+                    participants: 0
+                  free_slots:
+                  - from: "2022-06-02"
+                    to: "2022-06-03"
+                    days: 1
+          '304':
+            description: Not modified since the ETag in If-None-Match
+          '400':
+            description: The date range or the stay length was not valid
+          '404':
+            description: The mokki was not found
+        """
+        # Without ?from= the calendar starts today, so the range is a part
+        # of the ETag
+        first, end = _day_range()
+        stay = _get_stay()
+        etag = get_etag("visit", "participant", "mokki", extra=(first, end))
+        resp = not_modified(etag)
+        if resp is not None:
+            return resp
+
+        days = (end - first).days
+        # The days are those of the stored wall times, which may have any
+        # UTC offset, so the UTC range is widened by a day on both sides and
+        # _day_span() clips the visits to the days
+        range_start = to_epoch(datetime.combine(first, time.min)
+                               - timedelta(days=1))
+        range_end = to_epoch(datetime.combine(end, time.min)
+                             + timedelta(days=1))
+
+        rows = db.session.query(
+                Visit.time_start,
+                Visit.time_end,
+                func.count(participant_visit.c.participant_id)
+        ).outerjoin(
+                participant_visit,
+                participant_visit.c.visit_id == Visit.id
+        ).filter(
+                Visit.mokki_id == mokki.id,
+                func.likelihood(Visit.time_end_epoch > range_start,
+                                literal_column("0.05")),
+                Visit.time_start_epoch < range_end
+        ).group_by(Visit.id)
+
+        spans = []
+        for time_start, time_end, heads in rows:
+            start, stop = _day_span(time_start, time_end, first)
+            start, stop = max(start, 0), min(stop, days)
+            if start < stop:
+                spans.append((start, stop, heads))
+        visits, people = bucket_days(days, spans)
+
+        body = MokkigoBuilder(
+                name=mokki.name,
+                days=[
+                    {
+                        "date": (first + timedelta(days=idx)).isoformat(),
+                        "visits": visits[idx],
+                        "participants": people[idx]
+                    }
+                    for idx in range(days)
+                ]
+        )
+        body["from"] = first.isoformat()
+        body["to"] = end.isoformat()
+        if stay is not None:
+            body["free_slots"] = free_slots(first, visits, stay)
+
+        mimetype = MASON
+        if is_lean():
+            mimetype = JSON
+        else:
+            body.add_namespace("mokkigo", LINK_RELATIONS_URL)
+            body.add_control("self", request_url(request.args.to_dict()))
+            body.add_control("up", url_for("api.mokkiitem", mokki=mokki))
+            body.add_control(
+                    "mokkigo:visits",
+                    url_for("api.mokkivisitcollection", mokki=mokki)
+            )
+
+        with timed("encode"):
+            data = json_dumps(body)
+        resp = Response(data, 200, mimetype=mimetype)
+        resp.set_etag(etag)
+        return resp
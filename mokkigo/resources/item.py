@@ -1,17 +1,30 @@
-import json
-
 from flask import request, Response, url_for
 from flask_restful import Resource
 
-from jsonschema import validate, ValidationError
+from sqlalchemy.exc import IntegrityError
 
 from werkzeug.routing import BaseConverter
 from werkzeug.exceptions import (NotFound)
 
 from mokkigo import db
-from mokkigo.models import Item, Mokki
+from mokkigo.bulk import bulk_create
+from mokkigo.cache import get_by_name
+from mokkigo.metrics import timed
+from mokkigo.models import Item
+from mokkigo.storage import insert_transaction, write_transaction
+from mokkigo.validation import validation_error
 from mokkigo.constants import JSON, LINK_RELATIONS_URL, ITEM_PROFILE
-from mokkigo.utils import create_error_response, MokkigoBuilder
+from mokkigo.utils import (create_error_response, MokkigoBuilder, paginate,
+                           get_etag, not_modified, resource_url,
+                           collection_response, get_field_names,
+                           select_columns, serialize_fields, item_response,
+                           is_lean)
+
+# Fields of the item representation and their columns
+ITEM_FIELDS = {
+    "name": Item.name,
+    "amount": Item.amount,
+}
 
 
 class ItemCollection(Resource):
@@ -30,6 +43,12 @@ class ItemCollection(Resource):
             description: name of the mokki
             example:
               Ii-mokki
+          - $ref: '#/components/parameters/limit'
+          - $ref: '#/components/parameters/after'
+          - $ref: '#/components/parameters/before'
+          - $ref: '#/components/parameters/count'
+          - $ref: '#/components/parameters/fields'
+          - $ref: '#/components/parameters/controls'
         responses:
           '200':
             description: List of items
@@ -40,38 +59,50 @@ class ItemCollection(Resource):
                   amount: "3"
                 - name: item2
                   amount: "5"
+          '304':
+            description: Not modified since the ETag in If-None-Match
         """
-        db_mokki = Mokki.query.filter_by(name=mokki.name).first()
-
-        is_items = Item.query.filter_by(mokki=db_mokki).first()
-        if not is_items:
+        etag = get_etag("item")
+        resp = not_modified(etag)
+        if resp is not None:
+            return resp
+
+        names = get_field_names(ITEM_FIELDS)
+        query = db.session.query(*select_columns(names, ITEM_FIELDS,
+                                                 Item.name)) \
+                          .filter(Item.mokki_id == mokki.id)
+        page = paginate(query, Item.name)
+        if not page.rows and not request.args:
             return create_error_response(
                     title="Not found",
                     status_code=404,
                     message="Database is empty"
             )
 
-        mokki_items = Item.query.filter_by(mokki=db_mokki)
-
-        body = MokkigoBuilder(items=[])
+        body = MokkigoBuilder()
+        if page.total is not None:
+            body["total"] = page.total
 
         body.add_namespace("mokkigo", LINK_RELATIONS_URL)
         body.add_namespace("self", url_for("api.itemcollection",
-                                           mokki=db_mokki))
+                                           mokki=mokki))
         body.add_control_add_item(mokki)
 
-        for item in mokki_items:
-            i = MokkigoBuilder(
-                    name=item.name,
-                    amount=item.amount
-            )
+        lean = is_lean()
+
+        def serialize(item):
+            i = serialize_fields(item, names)
+            if lean:
+                return i
 
-            i.add_control("self", url_for("api.itemitem",
-                                          mokki=mokki, item=item))
+            i.add_control("self", resource_url("api.itemitem",
+                                               mokki=mokki.name,
+                                               item=item.name))
             i.add_control("profile", ITEM_PROFILE)
-            body["items"].append(i)
+            return i
 
-        return Response(json.dumps(body), 200, mimetype=JSON)
+        return collection_response(body, page, serialize, etag,
+                                   mimetype=JSON)
 
     def post(self, mokki):
         """
@@ -89,7 +120,9 @@ class ItemCollection(Resource):
             example:
               Ii-mokki
         requestBody:
-          description: JSON document that contains basic data for a new item
+          description: >
+            JSON document that contains basic data for a new item, or an
+            array of them to create many items in one transaction
           content:
             application/json:
               schema:
@@ -98,6 +131,10 @@ class ItemCollection(Resource):
                 name: carrot
                 amount: "1.0"
         responses:
+          '200':
+            description: >
+              Results of a bulk creation, one item with status created,
+              conflict or invalid for each posted entry
           '201':
             description: Item was created successfully
           '400':
@@ -108,6 +145,8 @@ class ItemCollection(Resource):
             description: A item with the same name already exists
           '415':
             description: Wrong media type was used
+          '503':
+            description: The database stayed locked by other writes
         """
         if request.mimetype != JSON:
             return create_error_response(
@@ -116,35 +155,41 @@ class ItemCollection(Resource):
                     message="Content type must be JSON"
             )
 
-        try:
-            validate(request.json, Item.json_schema())
-        except ValidationError as e:
+        if isinstance(request.json, list):
+            return bulk_create(
+                    request.json, Item, "name",
+                    to_row=lambda doc: {"name": doc["name"],
+                                        "amount": doc["amount"],
+                                        "mokki_id": mokki.id},
+                    href=lambda doc: resource_url("api.itemitem",
+                                                  mokki=mokki.name,
+                                                  item=doc["name"])
+            )
+
+        error = validation_error(request.json, Item)
+        if error is not None:
             return create_error_response(
                     status_code=400,
                     title="Invalid JSON document",
-                    message=str(e)
+                    message=error
             )
 
-        try:
-            if Item.query.filter_by(name=request.json["name"]).first():
-                raise Exception
+        if Item.query.filter_by(name=request.json["name"]).first():
+            return _item_conflict()
 
-            item = Item(
-                    name=request.json["name"],
-                    amount=request.json["amount"],
-                    mokki=mokki
-            )
-
-            href = url_for("api.itemitem", mokki=mokki, item=item)
+        # Linked by id, setting the relationship would add the item to the
+        # session of the request
+        item = Item(
+                name=request.json["name"],
+                amount=request.json["amount"],
+                mokki_id=mokki.id
+        )
+        href = url_for("api.itemitem", mokki=mokki, item=item)
 
-            db.session.add(item)
-            db.session.commit()
-        except Exception:
-            db.session.rollback()
-            return create_error_response(
-                    status_code=409,
-                    title="Item already exists"
-            )
+        try:
+            insert_transaction(lambda: db.session.add(item))
+        except IntegrityError:
+            return _item_conflict()
 
         return Response(status=201, headers={"Location": href})
 
@@ -173,6 +218,8 @@ class ItemItem(Resource):
             description: name of the item
             example:
               carrot
+          - $ref: '#/components/parameters/fields'
+          - $ref: '#/components/parameters/controls'
         responses:
           '200':
             description: Data of a single item
@@ -183,8 +230,15 @@ class ItemItem(Resource):
                   amount: "3"
           '404':
             description: Item not found
+          '304':
+            description: Not modified since the ETag in If-None-Match
         """
-        m, i = find_mokki_item(mokki, item)
+        i = find_mokki_item(mokki, item)
+
+        etag = get_etag("item")
+        resp = not_modified(etag)
+        if resp is not None:
+            return resp
 
         body = MokkigoBuilder(
                 name=i.name,
@@ -201,7 +255,8 @@ class ItemItem(Resource):
         body.add_control_delete_item(mokki=mokki, item=i)
         body.add_control_edit_item(mokki=mokki, item=i)
 
-        return Response(json.dumps(body), 200, mimetype=JSON)
+        return item_response(body, get_field_names(ITEM_FIELDS), etag,
+                             mimetype=JSON)
 
     def put(self, mokki, item):
         """
@@ -246,6 +301,8 @@ class ItemItem(Resource):
             description: The item the same name already exists
           '415':
             description: Wrong media type was used
+          '503':
+            description: The database stayed locked by other writes
         """
         if request.mimetype != JSON:
             return create_error_response(
@@ -255,28 +312,25 @@ class ItemItem(Resource):
             )
 
         find_mokki_item(mokki, item)
-        try:
-            validate(request.json, Item.json_schema())
-        except ValidationError as e:
+        error = validation_error(request.json, Item)
+        if error is not None:
             return create_error_response(
                     status_code=400,
                     title="Invalid JSON document",
-                    message=str(e)
+                    message=error
             )
 
-        try:
-            if Item.query.filter_by(name=request.json["name"]).first():
-                raise Exception
+        if Item.query.filter_by(name=request.json["name"]).first():
+            return _item_conflict()
 
+        def update():
             item.deserialize(request.json)
             db.session.add(item)
-            db.session.commit()
-        except Exception:
-            db.session.rollback()
-            return create_error_response(
-                    status_code=409,
-                    title="Item already exists"
-            )
+
+        try:
+            write_transaction(update)
+        except IntegrityError:
+            return _item_conflict()
 
         return Response(status=204)
 
@@ -308,20 +362,29 @@ class ItemItem(Resource):
             description: Item deleted successfully
           '404':
             description: Item not found
+          '503':
+            description: The database stayed locked by other writes
         """
         find_mokki_item(mokki, item)
 
-        db.session.delete(item)
-        db.session.commit()
+        write_transaction(lambda: db.session.delete(item))
         return Response(status=204)
 
 
+def _item_conflict():
+    return create_error_response(
+            status_code=409,
+            title="Item already exists"
+    )
+
+
 class ItemConverter(BaseConverter):
     def to_url(self, item):
         return str(item.name)
 
     def to_python(self, item_name):
-        db_i = Item.query.filter_by(name=item_name).first()
+        with timed("convert"):
+            db_i = get_by_name(Item, item_name)
         if db_i is None:
             raise NotFound
         return db_i
@@ -329,10 +392,9 @@ class ItemConverter(BaseConverter):
 
 def find_mokki_item(mokki, item):
     """
-    Checks if there is specified mokki found and if it has specified item
+    Checks that the item found by the converter belongs to the mokki. Both
+    rows are already loaded by the converters, so no queries are needed.
     """
-    m = Mokki.query.filter_by(name=mokki.name).first()
-
-    i = Item.query.filter_by(mokki=mokki, name=item.name).first()
-
-    return m, i
+    if item.mokki_id != mokki.id:
+        raise NotFound
+    return item
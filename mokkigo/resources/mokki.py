@@ -1,19 +1,30 @@
-import json
-
 from flask import request, Response, url_for
 from flask_restful import Resource
 
 from sqlalchemy.exc import IntegrityError
 
-from jsonschema import validate, ValidationError
-
 from werkzeug.routing import BaseConverter
 from werkzeug.exceptions import NotFound
 
 from mokkigo import db
+from mokkigo.bulk import bulk_create
+from mokkigo.cache import get_by_name
+from mokkigo.metrics import timed
 from mokkigo.models import Mokki
-from mokkigo.constants import JSON, MASON, LINK_RELATIONS_URL, MOKKI_PROFILE
-from mokkigo.utils import create_error_response, MokkigoBuilder
+from mokkigo.storage import insert_transaction, write_transaction
+from mokkigo.validation import validation_error
+from mokkigo.constants import JSON, LINK_RELATIONS_URL, MOKKI_PROFILE
+from mokkigo.utils import (create_error_response, MokkigoBuilder, paginate,
+                           get_etag, not_modified, resource_url,
+                           collection_response, get_field_names,
+                           select_columns, serialize_fields, item_response,
+                           is_lean)
+
+# Fields of the mokki representation and their columns
+MOKKI_FIELDS = {
+    "name": Mokki.name,
+    "location": Mokki.location,
+}
 
 
 class MokkiCollection(Resource):
@@ -23,6 +34,13 @@ class MokkiCollection(Resource):
         OpenAPI description below:
         ---
         description: Get the list of all Mokki
+        parameters:
+          - $ref: '#/components/parameters/limit'
+          - $ref: '#/components/parameters/after'
+          - $ref: '#/components/parameters/before'
+          - $ref: '#/components/parameters/count'
+          - $ref: '#/components/parameters/fields'
+          - $ref: '#/components/parameters/controls'
         responses:
           '200':
             description: List of mokkis
@@ -33,32 +51,45 @@ class MokkiCollection(Resource):
                     location: Ii
                   - name: Kemi-mokki
                     location: Kemi
+          '304':
+            description: Not modified since the ETag in If-None-Match
         """
-        mokkis = Mokki.query.all()
-        if not mokkis:
+        etag = get_etag("mokki")
+        resp = not_modified(etag)
+        if resp is not None:
+            return resp
+
+        names = get_field_names(MOKKI_FIELDS)
+        query = db.session.query(
+                *select_columns(names, MOKKI_FIELDS, Mokki.name))
+        page = paginate(query, Mokki.name)
+        if not page.rows and not request.args:
             return create_error_response(
                     title="Not found",
                     status_code=404,
                     message="Database is empty"
             )
-        body = MokkigoBuilder(items=[])
+        body = MokkigoBuilder()
+        if page.total is not None:
+            body["total"] = page.total
 
         body.add_namespace("mokkigo", LINK_RELATIONS_URL)
         body.add_control("self", url_for("api.mokkicollection"))
         body.add_control_add_mokki()
 
-        for mokki in mokkis:
-            m = MokkigoBuilder(
-                name=mokki.name,
-                location=mokki.location
-            )
+        lean = is_lean()
 
-            m.add_control("self", url_for("api.mokkiitem",
-                                          mokki=mokki))
+        def serialize(mokki):
+            m = serialize_fields(mokki, names)
+            if lean:
+                return m
+
+            m.add_control("self", resource_url("api.mokkiitem",
+                                               mokki=mokki.name))
             m.add_control("profile", MOKKI_PROFILE)
-            body["items"].append(m)
+            return m
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return collection_response(body, page, serialize, etag)
 
     def post(self):
         """
@@ -67,7 +98,9 @@ class MokkiCollection(Resource):
         ---
         description: create new mokki
         requestBody:
-          description: JSON document that contains data for a new mokki
+          description: >
+            JSON document that contains data for a new mokki, or an array of
+            them to create many mokkis in one transaction
           content:
             application/json:
               schema:
@@ -76,6 +109,10 @@ class MokkiCollection(Resource):
                 name: Ii-mokki
                 location: Ii
         responses:
+          '200':
+            description: >
+              Results of a bulk creation, one item with status created,
+              conflict or invalid for each posted entry
           '201':
             description: Mokki created successfully
             headers:
@@ -89,6 +126,8 @@ class MokkiCollection(Resource):
             description: Already exists
           '415':
             description: Wrong media type was used
+          '503':
+            description: The database stayed locked by other writes
         """
         if request.mimetype != JSON:
             return create_error_response(
@@ -97,22 +136,27 @@ class MokkiCollection(Resource):
                     message="Content type must be JSON"
             )
 
-        try:
-            validate(request.json, Mokki.json_schema())
-        except ValidationError as e:
+        if isinstance(request.json, list):
+            return bulk_create(
+                    request.json, Mokki, "name",
+                    to_row=_mokki_row,
+                    href=lambda doc: resource_url("api.mokkiitem",
+                                                  mokki=doc["name"])
+            )
+
+        error = validation_error(request.json, Mokki)
+        if error is not None:
             return create_error_response(
                     status_code=400,
                     title="Invalid JSON document",
-                    message=str(e)
+                    message=error
             )
 
         m = Mokki(name=request.json["name"], location=request.json["location"])
         href = url_for("api.mokkiitem", mokki=m)
         try:
-            db.session.add(m)
-            db.session.commit()
+            insert_transaction(lambda: db.session.add(m))
         except IntegrityError:
-            db.session.rollback()
             return create_error_response(
                     status_code=409,
                     title="Mokki already exists"
@@ -137,6 +181,8 @@ class MokkiItem(Resource):
             description: name of the mokki
             example:
               Ii-mokki
+          - $ref: '#/components/parameters/fields'
+          - $ref: '#/components/parameters/controls'
         responses:
           '200':
             description: Data of the single mokki
@@ -147,8 +193,15 @@ class MokkiItem(Resource):
                   location: Ii
           '404':
             description: The mokki was not found
+          '304':
+            description: Not modified since the ETag in If-None-Match
         """
-        m = Mokki.query.filter_by(name=mokki.name).first()
+        etag = get_etag("mokki")
+        resp = not_modified(etag)
+        if resp is not None:
+            return resp
+
+        m = mokki
 
         # Cannot get here because URL does not then exist
 
@@ -173,7 +226,7 @@ class MokkiItem(Resource):
         body.add_control_delete_mokki(mokki=m)
         body.add_control_edit_mokki(mokki=m)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return item_response(body, get_field_names(MOKKI_FIELDS), etag)
 
     def put(self, mokki):
         """
@@ -210,6 +263,8 @@ class MokkiItem(Resource):
             description: A mokki with that name already exists
           '415':
             description: Wrong media type was used
+          '503':
+            description: The database stayed locked by other writes
         """
         if request.mimetype != JSON:
             return create_error_response(
@@ -218,21 +273,21 @@ class MokkiItem(Resource):
                     message="Content type must be JSON"
             )
 
-        try:
-            validate(request.json, Mokki.json_schema())
-        except ValidationError as e:
+        error = validation_error(request.json, Mokki)
+        if error is not None:
             return create_error_response(
                     status_code=400,
                     title="Invalid JSON document",
-                    message=str(e)
+                    message=error
             )
 
-        mokki.deserialize(request.json)
-        try:
+        def update():
+            mokki.deserialize(request.json)
             db.session.add(mokki)
-            db.session.commit()
+
+        try:
+            write_transaction(update)
         except IntegrityError:
-            db.session.rollback()
             return create_error_response(
                     status_code=409,
                     title="Mokki already exists"
@@ -244,7 +299,7 @@ class MokkiItem(Resource):
         DELETE method for MokkiItem
         OpenAPI description below:
         ---
-        description: Delete selected mokki
+        description: Delete selected mokki together with its visits
         parameters:
           - in: path
             name: mokki
@@ -267,6 +322,8 @@ class MokkiItem(Resource):
             description: Mokki deleted successfully
           '404':
             description: Mokki not found
+          '503':
+            description: The database stayed locked by other writes
         """
         # Cannot get here because URL does not exist
 
@@ -276,17 +333,21 @@ class MokkiItem(Resource):
         #             title="Not found",
         #             message="No mokki with name {} found".format(mokki.name)
         #     )
-        db.session.delete(mokki)
-        db.session.commit()
+        write_transaction(lambda: db.session.delete(mokki))
         return Response(status=204)
 
 
+def _mokki_row(doc):
+    return {"name": doc["name"], "location": doc["location"]}
+
+
 class MokkiConverter(BaseConverter):
     def to_url(self, mokki):
         return str(mokki.name)
 
     def to_python(self, mokki_name):
-        db_mokki = Mokki.query.filter_by(name=mokki_name).first()
+        with timed("convert"):
+            db_mokki = get_by_name(Mokki, mokki_name)
         if db_mokki is None:
             raise NotFound
         return db_mokki
@@ -1,20 +1,31 @@
-import json
-
 from flask import request, Response, url_for
 from flask_restful import Resource
 
 from sqlalchemy.exc import IntegrityError
 
-from jsonschema import validate, ValidationError
-
 from werkzeug.routing import BaseConverter
 from werkzeug.exceptions import NotFound
 
 from mokkigo import db
+from mokkigo.bulk import bulk_create
+from mokkigo.cache import get_by_name
+from mokkigo.metrics import timed
 from mokkigo.models import Participant
-from mokkigo.constants import (JSON, MASON, LINK_RELATIONS_URL,
+from mokkigo.storage import insert_transaction, write_transaction
+from mokkigo.validation import validation_error
+from mokkigo.constants import (JSON, LINK_RELATIONS_URL,
                                PARTICIPANT_PROFILE)
-from mokkigo.utils import create_error_response, MokkigoBuilder
+from mokkigo.utils import (create_error_response, MokkigoBuilder, paginate,
+                           get_etag, not_modified, resource_url,
+                           collection_response, get_field_names,
+                           select_columns, serialize_fields, item_response,
+                           is_lean)
+
+# Fields of the participant representation and their columns
+PARTICIPANT_FIELDS = {
+    "name": Participant.name,
+    "allergies": Participant.allergies,
+}
 
 
 class ParticipantCollection(Resource):
@@ -24,6 +35,13 @@ class ParticipantCollection(Resource):
         OpenAPI description below:
         ---
         description: Get the list of participants
+        parameters:
+          - $ref: '#/components/parameters/limit'
+          - $ref: '#/components/parameters/after'
+          - $ref: '#/components/parameters/before'
+          - $ref: '#/components/parameters/count'
+          - $ref: '#/components/parameters/fields'
+          - $ref: '#/components/parameters/controls'
         responses:
           '200':
             description: List of participants
@@ -33,33 +51,45 @@ class ParticipantCollection(Resource):
                 - name: John Doe
                   allergies: Carrots
                 - name: Jane Doe
-
+          '304':
+            description: Not modified since the ETag in If-None-Match
         """
-        participants = Participant.query.all()
-        if not participants:
+        etag = get_etag("participant")
+        resp = not_modified(etag)
+        if resp is not None:
+            return resp
+
+        names = get_field_names(PARTICIPANT_FIELDS)
+        query = db.session.query(
+                *select_columns(names, PARTICIPANT_FIELDS, Participant.name))
+        page = paginate(query, Participant.name)
+        if not page.rows and not request.args:
             return create_error_response(
                 title="Not found",
                 status_code=404,
                 message="Database is empty"
             )
 
-        body = MokkigoBuilder(items=[])
+        body = MokkigoBuilder()
+        if page.total is not None:
+            body["total"] = page.total
         body.add_namespace("mokkigo", LINK_RELATIONS_URL)
         body.add_control("self", url_for("api.participantcollection"))
         body.add_control_add_participant()
 
-        for participant in participants:
-            p = MokkigoBuilder(
-                name=participant.name,
-                allergies=participant.allergies,
-            )
+        lean = is_lean()
+
+        def serialize(participant):
+            p = serialize_fields(participant, names)
+            if lean:
+                return p
 
-            p.add_control("self", url_for("api.participantitem",
-                                          participant=participant))
+            p.add_control("self", resource_url("api.participantitem",
+                                               participant=participant.name))
             p.add_control("profile", PARTICIPANT_PROFILE)
-            body["items"].append(p)
+            return p
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return collection_response(body, page, serialize, etag)
 
     def post(self):
         """
@@ -68,7 +98,9 @@ class ParticipantCollection(Resource):
         ---
         description: create new participant
         requestBody:
-          description: JSON document that contains data for a new participant
+          description: >
+            JSON document that contains data for a new participant, or an
+            array of them to create many participants in one transaction
           content:
             application/json:
               schema:
@@ -77,6 +109,10 @@ class ParticipantCollection(Resource):
                 name: Jane Doe
                 allergies: Carrots
         responses:
+          '200':
+            description: >
+              Results of a bulk creation, one item with status created,
+              conflict or invalid for each posted entry
           '201':
             description: Participant was created successfully
             headers:
@@ -90,6 +126,8 @@ class ParticipantCollection(Resource):
             description: Already exists
           '415':
             description: Wrong media type was used
+          '503':
+            description: The database stayed locked by other writes
         """
         if request.mimetype != JSON:
             return create_error_response(
@@ -98,14 +136,20 @@ class ParticipantCollection(Resource):
                     message="Content type must be JSON"
             )
 
-        try:
-            validate(request.json, Participant.json_schema())
+        if isinstance(request.json, list):
+            return bulk_create(
+                    request.json, Participant, "name",
+                    to_row=_participant_row,
+                    href=lambda doc: resource_url("api.participantitem",
+                                                  participant=doc["name"])
+            )
 
-        except ValidationError as e:
+        error = validation_error(request.json, Participant)
+        if error is not None:
             return create_error_response(
                     status_code=400,
                     title="Invalid JSON document",
-                    message=str(e)
+                    message=error
             )
 
         p = Participant(
@@ -128,10 +172,8 @@ class ParticipantCollection(Resource):
         href = url_for("api.participantitem", participant=p)
 
         try:
-            db.session.add(p)
-            db.session.commit()
+            insert_transaction(lambda: db.session.add(p))
         except IntegrityError:
-            db.session.rollback()
             return create_error_response(
                     status_code=409,
                     title="Participant already exists"
@@ -156,6 +198,8 @@ class ParticipantItem(Resource):
             description: name of the participant
             example:
               "Jane Doe"
+          - $ref: '#/components/parameters/fields'
+          - $ref: '#/components/parameters/controls'
         responses:
           '200':
             description: Data of the single participant
@@ -165,8 +209,15 @@ class ParticipantItem(Resource):
                   name: "Jane Doe"
           '404':
             description: The participant was not found
+          '304':
+            description: Not modified since the ETag in If-None-Match
         """
-        p = Participant.query.filter_by(name=participant.name).first()
+        etag = get_etag("participant")
+        resp = not_modified(etag)
+        if resp is not None:
+            return resp
+
+        p = participant
 
         body = MokkigoBuilder(
                 name=p.name,
@@ -182,7 +233,7 @@ class ParticipantItem(Resource):
         body.add_control_delete_participant(participant=p)
         body.add_control_edit_participant(participant=p)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return item_response(body, get_field_names(PARTICIPANT_FIELDS), etag)
 
     def put(self, participant):
         """
@@ -219,6 +270,8 @@ class ParticipantItem(Resource):
             description: A participant with that name already exists
           '415':
             description: Wrong media type was used
+          '503':
+            description: The database stayed locked by other writes
         """
         if request.mimetype != JSON:
             return create_error_response(
@@ -227,21 +280,21 @@ class ParticipantItem(Resource):
                     message="Content type must be JSON"
             )
 
-        try:
-            validate(request.json, Participant.json_schema())
-        except ValidationError as e:
+        error = validation_error(request.json, Participant)
+        if error is not None:
             return create_error_response(
                     status_code=400,
                     title="Invalid JSON document",
-                    message=str(e)
+                    message=error
             )
 
-        participant.deserialize(request.json)
-        try:
+        def update():
+            participant.deserialize(request.json)
             db.session.add(participant)
-            db.session.commit()
+
+        try:
+            write_transaction(update)
         except IntegrityError:
-            db.session.rollback()
             return create_error_response(
                     status_code=409,
                     title="Participant already exists"
@@ -271,19 +324,25 @@ class ParticipantItem(Resource):
             description: Participant deleted successfully
           '404':
             description: Participant not found
+          '503':
+            description: The database stayed locked by other writes
         """
 
-        db.session.delete(participant)
-        db.session.commit()
+        write_transaction(lambda: db.session.delete(participant))
         return Response(status=204)
 
 
+def _participant_row(doc):
+    return {"name": doc["name"], "allergies": doc.get("allergies")}
+
+
 class ParticipantConverter(BaseConverter):
     def to_url(self, participant):
         return participant.name
 
     def to_python(self, participant_name):
-        db_p = Participant.query.filter_by(name=participant_name).first()
+        with timed("convert"):
+            db_p = get_by_name(Participant, participant_name)
         if db_p is None:
             raise NotFound
         return db_p
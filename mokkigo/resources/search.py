@@ -0,0 +1,208 @@
+"""
+Full-text search over mokkis, items, participants and visits.
+
+The search uses the FTS5 table search_index (see SEARCH_SOURCES in
+mokkigo.models). Every word of ?q= is a prefix query and the results are
+ranked with bm25. Results are paged by their position in the ranking, since
+the rank of a row is not a usable keyset cursor.
+"""
+import re
+
+from flask import request
+from flask_restful import Resource
+from sqlalchemy import text
+from werkzeug.exceptions import BadRequest
+
+from mokkigo import db
+from mokkigo.constants import (LINK_RELATIONS_URL, MOKKI_PROFILE,
+                               ITEM_PROFILE, PARTICIPANT_PROFILE,
+                               VISIT_PROFILE)
+from mokkigo.models import Item, Mokki, SEARCH_SOURCES
+from mokkigo.utils import (MokkigoBuilder, Page, collection_response,
+                           create_error_response, get_etag, get_flag,
+                           get_page_limit, is_lean, not_modified,
+                           request_url, resource_url)
+
+# Type of the results from each table and the endpoint and URL variable of
+# their item resource
+SEARCH_TYPES = {
+    "mokki": ("api.mokkiitem", "mokki", MOKKI_PROFILE),
+    "item": ("api.itemitem", "item", ITEM_PROFILE),
+    "participant": ("api.participantitem", "participant",
+                    PARTICIPANT_PROFILE),
+    "visit": ("api.visititem", "visit", VISIT_PROFILE),
+}
+
+SEARCH_QUERY = text(
+    "SELECT rowid, name FROM search_index WHERE search_index MATCH :q "
+    "ORDER BY rank LIMIT :limit OFFSET :offset"
+)
+
+COUNT_QUERY = text(
+    "SELECT COUNT(*) FROM search_index WHERE search_index MATCH :q"
+)
+
+
+def match_expression(q):
+    """
+    Turns the words of a user query into an FTS5 expression where every word
+    is a quoted prefix query, so FTS5 operators typed by the user are
+    searched as plain words.
+    """
+    words = re.findall(r"\w+", q)
+    if not words:
+        raise BadRequest(response=create_error_response(
+                status_code=400,
+                title="Invalid query parameter",
+                message="q must contain at least one word"
+        ))
+    return " ".join('"{}"*'.format(word) for word in words)
+
+
+def _get_position(name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        value = -1
+    if value < 0:
+        raise BadRequest(response=create_error_response(
+                status_code=400,
+                title="Invalid query parameter",
+                message="{} must be a position in the results".format(name)
+        ))
+    return value
+
+
+def search_page(expression):
+    """
+    Returns a Page of (type, name, id) rows matching the expression. The
+    cursors of the page are positions in the ranking.
+    """
+    limit = get_page_limit()
+    after = _get_position("after")
+    before = _get_position("before")
+    if before is not None:
+        offset = max(0, before - limit)
+        limit = before - offset
+    else:
+        offset = after or 0
+
+    rows = db.session.execute(SEARCH_QUERY, {
+            "q": expression,
+            "limit": limit + 1,
+            "offset": offset
+    }).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = offset + limit
+    prev_cursor = offset if offset > 0 else None
+
+    total = None
+    if get_flag("count"):
+        total = db.session.execute(COUNT_QUERY, {"q": expression}).scalar()
+
+    tables = len(SEARCH_SOURCES)
+    results = [
+        (SEARCH_SOURCES[rowid % tables][0], name, rowid // tables)
+        for rowid, name in rows
+    ]
+    return Page(results, prev_cursor, next_cursor, total)
+
+
+def _item_mokkis(results):
+    """Names of the mokkis of the items in the results, by item id"""
+    ids = [row_id for kind, name, row_id in results if kind == "item"]
+    if not ids:
+        return {}
+    return dict(
+        db.session.query(Item.id, Mokki.name)
+                  .join(Mokki, Mokki.id == Item.mokki_id)
+                  .filter(Item.id.in_(ids))
+    )
+
+
+class Search(Resource):
+    def get(self):
+        """
+        GET method for Search
+        OpenAPI description below:
+        ---
+        description: >
+          Search mokkis, items, participants and visits by name, and mokkis
+          by location and participants by allergies. Every word of the query
+          matches words that start with it and the best matches come first.
+        parameters:
+          - in: query
+            name: q
+            schema:
+              type: string
+            required: true
+            description: words to search for
+            example:
+              ii mok
+          - $ref: '#/components/parameters/limit'
+          - in: query
+            name: after
+            schema:
+              type: integer
+            required: false
+            description: position in the results where the page starts
+          - in: query
+            name: before
+            schema:
+              type: integer
+            required: false
+            description: position in the results where the page ends
+          - $ref: '#/components/parameters/count'
+          - $ref: '#/components/parameters/controls'
+        responses:
+          '200':
+            description: Matching rows, best match first
+            content:
+              application/json:
+                example:
+                - type: mokki
+                  name: Ii-mokki
+                - type: visit
+                  name: Weekend in the Ii-mokki
+          '304':
+            description: Not modified since the ETag in If-None-Match
+          '400':
+            description: The query had no words
+        """
+        etag = get_etag(*[source[0] for source in SEARCH_SOURCES])
+        resp = not_modified(etag)
+        if resp is not None:
+            return resp
+
+        page = search_page(match_expression(request.args.get("q", "")))
+        item_mokkis = _item_mokkis(page.rows)
+
+        body = MokkigoBuilder()
+        if page.total is not None:
+            body["total"] = page.total
+        body.add_namespace("mokkigo", LINK_RELATIONS_URL)
+        body.add_control("self", request_url(request.args.to_dict()))
+
+        lean = is_lean()
+
+        def serialize(row):
+            kind, name, row_id = row
+            result = MokkigoBuilder(type=kind, name=name)
+            if lean:
+                return result
+            endpoint, variable, profile = SEARCH_TYPES[kind]
+            names = {variable: name}
+            if kind == "item":
+                if row_id not in item_mokkis:
+                    return result
+                names["mokki"] = item_mokkis[row_id]
+            result.add_control("self", resource_url(endpoint, **names))
+            result.add_control("profile", profile)
+            return result
+
+        return collection_response(body, page, serialize, etag)
@@ -1,21 +1,175 @@
-import json
-
-from flask import request, Response, url_for
+from flask import current_app, request, Response, url_for
 from flask_restful import Resource
 
 from sqlalchemy.exc import IntegrityError
-
-from jsonschema import validate, ValidationError, draft7_format_checker
+from sqlalchemy import String, func, literal_column, select, type_coerce
 
 from werkzeug.routing import BaseConverter
-from werkzeug.exceptions import (NotFound)
-
-from dateutil import parser
+from werkzeug.exceptions import BadRequest, NotFound
 
 from mokkigo import db
-from mokkigo.models import Participant, Visit
-from mokkigo.constants import JSON, MASON, LINK_RELATIONS_URL, VISIT_PROFILE
-from mokkigo.utils import create_error_response, MokkigoBuilder
+from mokkigo.bulk import bulk_create, find_ids
+from mokkigo.cache import get_by_name
+from mokkigo.metrics import timed
+from mokkigo.models import Mokki, Participant, Visit, participant_visit
+from mokkigo.storage import insert_transaction, write_transaction
+from mokkigo.timeutils import parse_datetime, stored_isoformat, to_epoch
+from mokkigo.validation import validation_error
+from mokkigo.constants import JSON, LINK_RELATIONS_URL, VISIT_PROFILE
+from mokkigo.utils import (create_error_response, MokkigoBuilder, paginate,
+                           get_etag, not_modified, resource_url,
+                           collection_response, get_field_names,
+                           select_columns, serialize_fields, item_response,
+                           is_lean, get_time_arg)
+
+# Separator of the participant names aggregated with group_concat. The ASCII
+# unit separator does not appear in names typed by users.
+NAME_SEPARATOR = "\x1f"
+
+
+def split_names(names):
+    """Splits a group_concat aggregate back into a list of names"""
+    if not names:
+        return []
+    return names.split(NAME_SEPARATOR)
+
+
+# Fields of the visit representation and their columns. Participant names
+# are aggregated, so selecting them needs the joins of _participant_join()
+VISIT_FIELDS = {
+    "visit_name": Visit.visit_name,
+    "mokki_name": select(Mokki.name).where(Mokki.id == Visit.mokki_id)
+                                    .scalar_subquery(),
+    # Read as the stored text, which is turned into ISO 8601 by slicing
+    # instead of parsing it into a datetime and formatting that
+    "time_start": type_coerce(Visit.time_start, String),
+    "time_end": type_coerce(Visit.time_end, String),
+    "participants": func.group_concat(Participant.name, NAME_SEPARATOR),
+}
+
+VISIT_CONVERTERS = {
+    "time_start": stored_isoformat,
+    "time_end": stored_isoformat,
+    "participants": split_names,
+}
+
+
+def _participant_join(query):
+    return query.outerjoin(
+            participant_visit,
+            participant_visit.c.visit_id == Visit.id
+    ).outerjoin(
+            Participant,
+            Participant.id == participant_visit.c.participant_id
+    ).group_by(Visit.id)
+
+
+class BookingConflict(Exception):
+    """Raised when a visit overlaps the visit named overlap"""
+
+    def __init__(self, overlap):
+        super().__init__(overlap)
+        self.overlap = overlap
+
+
+def find_overlap(mokki_id, start_epoch, end_epoch, visit_id=None):
+    """
+    Returns the name of a visit of the mokki overlapping the time range, or
+    None. Only the visits ending after the start are read from the
+    (mokki_id, time_end_epoch) index, so the check does not slow down as the
+    history of the mokki grows.
+
+    : param int start_epoch: start of the range, see timeutils.to_epoch()
+    : param int end_epoch: end of the range
+    : param int visit_id: id of a visit left out of the check
+    """
+    query = db.session.query(Visit.visit_name).filter(
+            Visit.mokki_id == mokki_id,
+            func.likelihood(Visit.time_end_epoch > start_epoch,
+                            literal_column("0.05")),
+            Visit.time_start_epoch < end_epoch
+    )
+    if visit_id is not None:
+        query = query.filter(Visit.id != visit_id)
+    return query.limit(1).scalar()
+
+
+def get_visit_collection(href, mokki=None, participant=None):
+    """
+    Builds the response of a visit collection GET, with all the visits or
+    only the visits of one mokki or participant. The visits can be filtered
+    with ?mokki= and with ?from=&to=, which select the visits overlapping
+    the time range.
+
+    : param str href: URL of the collection
+    : param Mokki mokki: mokki whose visits are listed, None for all visits
+    : param Participant participant: participant whose visits are listed
+    """
+    etag = get_etag("visit", "participant", "mokki")
+    resp = not_modified(etag)
+    if resp is not None:
+        return resp
+
+    # The participant names of each visit are aggregated in the same query
+    names = get_field_names(VISIT_FIELDS)
+    query = db.session.query(
+            *select_columns(names, VISIT_FIELDS, Visit.visit_name)
+    ).select_from(Visit)
+    if mokki is None and "mokki" in request.args:
+        mokki = get_by_name(Mokki, request.args["mokki"])
+        if mokki is None:
+            return _mokki_not_found(request.args["mokki"])
+    if mokki is not None:
+        query = query.filter(Visit.mokki_id == mokki.id)
+    if participant is not None:
+        # Read from the primary key of participant_visit
+        query = query.filter(Visit.id.in_(
+                select(participant_visit.c.visit_id).where(
+                    participant_visit.c.participant_id == participant.id)
+        ))
+
+    time_from = get_time_arg("from")
+    time_to = get_time_arg("to")
+    if time_to is not None:
+        query = query.filter(Visit.time_start_epoch < to_epoch(time_to))
+    if time_from is not None:
+        # Without the hint SQLite prefers scanning the name index to avoid
+        # sorting the page, which reads the whole table for a short range
+        query = query.filter(func.likelihood(
+                Visit.time_end_epoch > to_epoch(time_from),
+                literal_column("0.05")
+        ))
+    if "participants" in names:
+        query = _participant_join(query)
+    page = paginate(query, Visit.visit_name)
+    if not page.rows and not request.args:
+        return create_error_response(
+                title="Not found",
+                status_code=404,
+                message="Database is empty"
+        )
+
+    body = MokkigoBuilder()
+    if page.total is not None:
+        body["total"] = page.total
+
+    body.add_namespace("mokkigo", LINK_RELATIONS_URL)
+    body.add_control("self", href)
+    body.add_control_add_visit()
+
+    lean = is_lean()
+
+    def serialize(visit):
+        v = serialize_fields(visit, names, VISIT_CONVERTERS)
+        if lean:
+            return v
+
+        v.add_control("self", resource_url("api.visititem",
+                                           visit=visit.visit_name))
+        v.add_control("profile", VISIT_PROFILE)
+        return v
+
+    return collection_response(body, page, serialize, etag)
 
 
 class VisitCollection(Resource):
@@ -25,6 +179,21 @@ class VisitCollection(Resource):
         OpenAPI description below:
         ---
         description: Get the list of visits
+        parameters:
+          - $ref: '#/components/parameters/limit'
+          - $ref: '#/components/parameters/after'
+          - $ref: '#/components/parameters/before'
+          - $ref: '#/components/parameters/count'
+          - $ref: '#/components/parameters/fields'
+          - $ref: '#/components/parameters/controls'
+          - $ref: '#/components/parameters/from'
+          - $ref: '#/components/parameters/to'
+          - in: query
+            name: mokki
+            schema:
+              type: string
+            required: false
+            description: list only the visits of this mokki
         responses:
           '200':
             description: List of visits
@@ -39,41 +208,14 @@ class VisitCollection(Resource):
                   time_start: 2020-01-03T00:02:02.003+1:00
                   time_end:   2020-01-04T00:02:02.003+1:00
                   mokki_name: Ii-mokki
+          '304':
+            description: Not modified since the ETag in If-None-Match
+          '400':
+            description: A time filter is not an ISO 8601 date-time
+          '404':
+            description: The mokki of the ?mokki= filter was not found
         """
-        visits = Visit.query.all()
-        if not visits:
-            return create_error_response(
-                    title="Not found",
-                    status_code=404,
-                    message="Database is empty"
-            )
-
-        body = MokkigoBuilder(items=[])
-
-        body.add_namespace("mokkigo", LINK_RELATIONS_URL)
-        body.add_control("self", url_for("api.visitcollection"))
-        body.add_control_add_visit()
-
-        participant_names = []
-
-        for visit in visits:
-            for part in visit.participants:
-                participant_names.append(part.name)
-
-            v = MokkigoBuilder(
-                visit_name=visit.visit_name,
-                mokki_name=visit.mokki_name,
-                time_start=visit.time_start.isoformat(),
-                time_end=visit.time_end.isoformat(),
-                participants=participant_names
-            )
-
-            participant_names = []
-            v.add_control("self", url_for("api.visititem", visit=visit))
-            v.add_control("profile", VISIT_PROFILE)
-            body["items"].append(v)
-
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return get_visit_collection(url_for("api.visitcollection"))
 
     def post(self):
         """
@@ -82,7 +224,9 @@ class VisitCollection(Resource):
         ---
         description: create new visit
         requestBody:
-          description: JSON document that contains data for a new visit
+          description: >
+            JSON document that contains data for a new visit, or an array of
+            them to create many visits in one transaction
           content:
             application/json:
               schema:
@@ -94,6 +238,10 @@ class VisitCollection(Resource):
                 mokki_name: Ii-mokki
                 participants: ["test"]
         responses:
+          '200':
+            description: >
+              Results of a bulk creation, one item with status created,
+              conflict or invalid for each posted entry
           '201':
             description: Visit was created successfully
             headers:
@@ -101,12 +249,22 @@ class VisitCollection(Resource):
                 description: URI of the new visit
                 schema:
                   type: string
+              Warning:
+                description: >
+                  Set if the visit overlaps another visit of the mokki and
+                  BOOKING_CONFLICTS is warn
+                schema:
+                  type: string
           '400':
             description: The request body was not valid
           '409':
-            description: Already exists
+            description: >
+              Already exists, or the visit overlaps another visit of the
+              mokki and BOOKING_CONFLICTS is reject
           '415':
             description: Wrong media type was used
+          '503':
+            description: The database stayed locked by other writes
         """
         if request.mimetype != JSON:
             return create_error_response(
@@ -115,45 +273,169 @@ class VisitCollection(Resource):
                     message="Content type must be JSON"
             )
 
-        try:
-            validate(
-                request.json,
-                Visit.json_schema(),
-                format_checker=draft7_format_checker
+        if isinstance(request.json, list):
+            mokki_ids = find_ids(Mokki.name, Mokki.id,
+                                 _mokki_names(request.json))
+            return bulk_create(
+                    request.json, Visit, "visit_name",
+                    to_row=lambda doc: _visit_row(doc, mokki_ids),
+                    href=lambda doc: resource_url("api.visititem",
+                                                  visit=doc["visit_name"]),
+                    after_insert=_insert_participants,
+                    find_conflicts=_find_bulk_overlaps,
+                    reject_conflicts=_reject_conflicts()
             )
-        except ValidationError as e:
+
+        error = validation_error(request.json, Visit, check_formats=True)
+        if error is not None:
             return create_error_response(
                     status_code=400,
                     title="Invalid JSON document",
-                    message=str(e)
+                    message=error
             )
 
-        try:
+        mokki = get_by_name(Mokki, request.json["mokki_name"])
+        if mokki is None:
+            return _mokki_not_found(request.json["mokki_name"])
+
+        # create() may run in the thread of the group committer, so it only
+        # uses plain values of the request
+        doc = request.json
+        mokki_id = mokki.id
+        time_start, time_end = _parse_times(doc)
+        href = resource_url("api.visititem", visit=doc["visit_name"])
+
+        def create():
             v = Visit(
-                visit_name=request.json["visit_name"],
-                mokki_name=request.json["mokki_name"],
-                time_start=parser.parse(request.json["time_start"]),
-                time_end=parser.parse(request.json["time_end"])
+                visit_name=doc["visit_name"],
+                mokki_id=mokki_id,
+                time_start=time_start,
+                time_end=time_end
             )
 
-            participant_names = request.json["participants"]
-            for name in participant_names:
-                participant = Participant.query.filter_by(name=name).first()
-                if participant is not None:
-                    v.participants.append(participant)
-
-            href = url_for("api.visititem", visit=v)
+            # One query for all the participants, a name listed twice is
+            # linked once
+            participant_names = doc.get("participants", [])
+            if participant_names:
+                v.participants = Participant.query.filter(
+                        Participant.name.in_(set(participant_names))
+                ).all()
 
             db.session.add(v)
-            db.session.commit()
+            # Checked after the flush, so that the write lock of the database
+            # is held and no other booking can be added before the commit
+            db.session.flush()
+            overlap = find_overlap(mokki_id, v.time_start_epoch,
+                                   v.time_end_epoch, v.id)
+            if overlap is not None and _reject_conflicts():
+                raise BookingConflict(overlap)
+            return overlap
+
+        try:
+            overlap = insert_transaction(create)
+        except BookingConflict as e:
+            return _booking_conflict(e.overlap)
         except IntegrityError:
-            db.session.rollback()
             return create_error_response(
                     status_code=409,
                     title="Visit already exists"
             )
 
-        return Response(status=201, headers={"Location": href})
+        headers = {"Location": href}
+        if overlap is not None:
+            headers["Warning"] = _overlap_warning(overlap)
+        return Response(status=201, headers=headers)
+
+
+class MokkiVisitCollection(Resource):
+    def get(self, mokki):
+        """
+        GET method for MokkiVisitCollection
+        OpenAPI description below:
+        ---
+        description: Get the list of visits of one mokki
+        parameters:
+          - in: path
+            name: mokki
+            schema:
+              type: string
+            required: true
+            description: name of the mokki
+            example:
+              Ii-mokki
+          - $ref: '#/components/parameters/limit'
+          - $ref: '#/components/parameters/after'
+          - $ref: '#/components/parameters/before'
+          - $ref: '#/components/parameters/count'
+          - $ref: '#/components/parameters/fields'
+          - $ref: '#/components/parameters/controls'
+          - $ref: '#/components/parameters/from'
+          - $ref: '#/components/parameters/to'
+        responses:
+          '200':
+            description: List of the visits of the mokki
+            content:
+              application/json:
+                example:
+                - visit_name: Trip to Ii
+                  time_start: 2020-02-01T00:01:01.003+1:00
+                  time_end: 2020-02-03T00:02:02.003+1:00
+                  mokki_name: Ii-mokki
+          '304':
+            description: Not modified since the ETag in If-None-Match
+          '404':
+            description: The mokki was not found or it has no visits
+        """
+        return get_visit_collection(
+                url_for("api.mokkivisitcollection", mokki=mokki),
+                mokki=mokki
+        )
+
+
+class ParticipantVisitCollection(Resource):
+    def get(self, participant):
+        """
+        GET method for ParticipantVisitCollection
+        OpenAPI description below:
+        ---
+        description: Get the list of visits of one participant
+        parameters:
+          - in: path
+            name: participant
+            schema:
+              type: string
+            required: true
+            description: name of the participant
+            example:
+              Matti
+          - $ref: '#/components/parameters/limit'
+          - $ref: '#/components/parameters/after'
+          - $ref: '#/components/parameters/before'
+          - $ref: '#/components/parameters/count'
+          - $ref: '#/components/parameters/fields'
+          - $ref: '#/components/parameters/controls'
+          - $ref: '#/components/parameters/from'
+          - $ref: '#/components/parameters/to'
+        responses:
+          '200':
+            description: List of the visits of the participant
+            content:
+              application/json:
+                example:
+                - visit_name: Trip to Ii
+                  time_start: 2020-02-01T00:01:01.003+1:00
+                  time_end: 2020-02-03T00:02:02.003+1:00
+                  mokki_name: Ii-mokki
+          '304':
+            description: Not modified since the ETag in If-None-Match
+          '404':
+            description: The participant was not found or has no visits
+        """
+        return get_visit_collection(
+                url_for("api.participantvisitcollection",
+                        participant=participant),
+                participant=participant
+        )
 
 
 class VisitItem(Resource):
@@ -172,6 +454,8 @@ class VisitItem(Resource):
             description: name of the visit
             example:
               Weekend in the Ii
+          - $ref: '#/components/parameters/fields'
+          - $ref: '#/components/parameters/controls'
         responses:
           '200':
             description: Data of the single visit
@@ -185,8 +469,15 @@ class VisitItem(Resource):
                   participants: ["test"]
           '404':
             description: The visit was not found
+          '304':
+            description: Not modified since the ETag in If-None-Match
         """
-        v = Visit.query.filter_by(visit_name=visit.visit_name).first()
+        etag = get_etag("visit", "participant", "mokki")
+        resp = not_modified(etag)
+        if resp is not None:
+            return resp
+
+        v = visit
         p = []
         for part in v.participants:
             p.append(part.name)
@@ -208,7 +499,7 @@ class VisitItem(Resource):
         body.add_control_delete_visit(visit=v)
         body.add_control_edit_visit(visit=v)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return item_response(body, get_field_names(VISIT_FIELDS), etag)
 
     def put(self, visit):
         """
@@ -245,9 +536,13 @@ class VisitItem(Resource):
           '404':
             description: The visit was not found
           '409':
-            description: A visit with that name already exists
+            description: >
+              A visit with that name already exists, or the visit overlaps
+              another visit of the mokki and BOOKING_CONFLICTS is reject
           '415':
             description: Wrong media type was used
+          '503':
+            description: The database stayed locked by other writes
         """
         if request.mimetype != JSON:
             return create_error_response(
@@ -256,25 +551,46 @@ class VisitItem(Resource):
                     message="Content type must be JSON"
             )
 
-        try:
-            validate(request.json, Visit.json_schema())
-        except ValidationError as e:
+        error = validation_error(request.json, Visit)
+        if error is not None:
             return create_error_response(
                     status_code=400,
                     title="Invalid JSON document",
-                    message=str(e)
+                    message=error
             )
 
-        try:
-            visit.deserialize(request.json)
+        mokki = get_by_name(Mokki, request.json["mokki_name"])
+        if mokki is None:
+            return _mokki_not_found(request.json["mokki_name"])
+        time_start, time_end = _parse_times(request.json)
+
+        def update():
+            # Not deserialize(), which would parse the times again
+            visit.visit_name = request.json["visit_name"]
+            visit.time_start = time_start
+            visit.time_end = time_end
+            visit.mokki = mokki
             db.session.add(visit)
-            db.session.commit()
+            db.session.flush()
+            overlap = find_overlap(mokki.id, visit.time_start_epoch,
+                                   visit.time_end_epoch, visit.id)
+            if overlap is not None and _reject_conflicts():
+                raise BookingConflict(overlap)
+            return overlap
+
+        try:
+            overlap = write_transaction(update)
+        except BookingConflict as e:
+            return _booking_conflict(e.overlap)
         except IntegrityError:
-            db.session.rollback()
             return create_error_response(
                     status_code=409,
                     title="Visit already exists"
             )
+
+        if overlap is not None:
+            return Response(status=204,
+                            headers={"Warning": _overlap_warning(overlap)})
         return Response(status=204)
 
     def delete(self, visit):
@@ -297,18 +613,143 @@ class VisitItem(Resource):
             description: visit deleted successfully
           '404':
             description: visit not found
+          '503':
+            description: The database stayed locked by other writes
         """
-        db.session.delete(visit)
-        db.session.commit()
+        write_transaction(lambda: db.session.delete(visit))
         return Response(status=204)
 
 
+def _mokki_not_found(name):
+    return create_error_response(
+            status_code=404,
+            title="Not found",
+            message="No mokki with name {} found".format(name)
+    )
+
+
+def _reject_conflicts():
+    return current_app.config["BOOKING_CONFLICTS"] == "reject"
+
+
+def _booking_conflict(overlap):
+    return create_error_response(
+            status_code=409,
+            title="Booking conflict",
+            message="The visit overlaps visit {}".format(overlap)
+    )
+
+
+def _overlap_warning(overlap):
+    return '299 - "The visit overlaps visit {}"'.format(overlap)
+
+
+def _find_bulk_overlaps(rows):
+    """
+    Finds the overlapping bookings of visits about to be created by
+    bulk_create. The existing visits of the mokkis in the time span of the
+    rows are read with one query, and the rows are also checked against the
+    rows before them.
+    """
+    reject = _reject_conflicts()
+    start = min(row["time_start_epoch"] for row in rows)
+    end = max(row["time_end_epoch"] for row in rows)
+    existing = db.session.query(
+            Visit.mokki_id, Visit.time_start_epoch, Visit.time_end_epoch,
+            Visit.visit_name
+    ).filter(
+            Visit.mokki_id.in_(set(row["mokki_id"] for row in rows)),
+            func.likelihood(Visit.time_end_epoch > start,
+                            literal_column("0.05")),
+            Visit.time_start_epoch < end
+    )
+
+    booked = {}
+    for mokki_id, time_start, time_end, name in existing:
+        booked.setdefault(mokki_id, []).append((time_start, time_end, name))
+
+    messages = []
+    for row in rows:
+        time_start = row["time_start_epoch"]
+        time_end = row["time_end_epoch"]
+        bookings = booked.setdefault(row["mokki_id"], [])
+        overlap = next((name for s, e, name in bookings
+                        if e > time_start and s < time_end), None)
+        if overlap is None:
+            messages.append(None)
+        else:
+            messages.append("The visit overlaps visit {}".format(overlap))
+        if overlap is None or not reject:
+            bookings.append((time_start, time_end, row["visit_name"]))
+    return messages
+
+
+def _mokki_names(docs):
+    """Mokki names referred to by the documents of a bulk request"""
+    return set(
+        doc["mokki_name"] for doc in docs
+        if isinstance(doc, dict) and isinstance(doc.get("mokki_name"), str)
+    )
+
+
+def _parse_times(doc):
+    """
+    Returns the start and end of a visit document as datetimes, or raises
+    BadRequest if they are not ISO 8601 date-times
+    """
+    try:
+        return (parse_datetime(doc["time_start"]),
+                parse_datetime(doc["time_end"]))
+    except ValueError as e:
+        raise BadRequest(response=create_error_response(
+                status_code=400,
+                title="Invalid JSON document",
+                message=str(e)
+        ))
+
+
+def _visit_row(doc, mokki_ids):
+    if doc["mokki_name"] not in mokki_ids:
+        raise ValueError("No mokki with name {} found".format(
+            doc["mokki_name"]))
+    time_start = parse_datetime(doc["time_start"])
+    time_end = parse_datetime(doc["time_end"])
+    # The epoch columns are given so _find_bulk_overlaps() can use them
+    return {
+        "visit_name": doc["visit_name"],
+        "mokki_id": mokki_ids[doc["mokki_name"]],
+        "time_start": time_start,
+        "time_end": time_end,
+        "time_start_epoch": to_epoch(time_start),
+        "time_end_epoch": to_epoch(time_end),
+    }
+
+
+def _insert_participants(docs):
+    """Links the participants of visits created by bulk_create"""
+    visit_ids = find_ids(Visit.visit_name, Visit.id,
+                         [doc["visit_name"] for doc in docs])
+    part_ids = find_ids(Participant.name, Participant.id,
+                        set(name for doc in docs
+                            for name in doc.get("participants", [])))
+    links = [
+        {"visit_id": visit_ids[doc["visit_name"]],
+         "participant_id": part_ids[name]}
+        for doc in docs
+        for name in set(doc.get("participants", []))
+        if name in part_ids
+    ]
+    if links:
+        db.session.execute(participant_visit.insert(), links)
+
+
 class VisitConverter(BaseConverter):
     def to_url(self, visit):
         return visit.visit_name
 
     def to_python(self, visit_name):
-        db_v = Visit.query.filter_by(visit_name=visit_name).first()
+        with timed("convert"):
+            db_v = get_by_name(Visit, visit_name)
         if db_v is None:
             raise NotFound
         return db_v
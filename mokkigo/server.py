@@ -0,0 +1,96 @@
+"""
+Multi-process production server.
+
+Runs the app under gunicorn (`./mokkigo.sh serve`, `mokkigo-serve` or
+`python -m mokkigo.server`, install with `pip install .[server]`). The app is
+created in the master process before the workers are forked, so the workers
+share its memory and start at once. Every worker runs the given number of
+threads.
+
+SQLite connections must not be shared between processes, so a forked
+worker drops the connection pool it inherited from the master and opens its
+own connections. The group committer thread (see mokkigo.storage) is
+started by each worker on its first write.
+
+Signals to the master:
+    HUP   graceful reload: the app and its instance config are created
+          again and new workers replace the old ones, which finish their
+          requests first
+    TERM  graceful shutdown
+    USR2  start a new master with the new code, for upgrades of the code
+"""
+import os
+
+import click
+
+from mokkigo import create_app, db
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:
+    BaseApplication = None
+
+
+def post_fork(server, worker):
+    """
+    Worker hook that drops the connections inherited from the master
+    without closing them, since they belong to the master
+    """
+    app = server.app.callable
+    if app is None:
+        return
+    with app.app_context():
+        db.get_engine(app).dispose(close=False)
+
+
+if BaseApplication is not None:
+    class MokkigoApplication(BaseApplication):
+        """gunicorn application serving create_app() with preloading"""
+
+        def __init__(self, options):
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+            self.cfg.set("preload_app", True)
+            self.cfg.set("post_fork", post_fork)
+
+        def load(self):
+            return create_app()
+
+        def reload(self):
+            super().reload()
+            # Preloaded apps are not loaded again by default, HUP creates a
+            # new app so changes of the instance config are picked up
+            self.callable = None
+
+
+@click.command("mokkigo-serve")
+@click.option("--bind", "-b", default="127.0.0.1:8000", show_default=True,
+              help="Address to listen on")
+@click.option("--workers", "-w", default=os.cpu_count() or 1,
+              show_default="number of cores", help="Number of processes")
+@click.option("--threads", default=8, show_default=True,
+              help="Number of threads in every process")
+@click.option("--timeout", default=30, show_default=True,
+              help="Seconds before a silent worker is restarted")
+@click.option("--graceful-timeout", default=30, show_default=True,
+              help="Seconds the old workers have to finish on a reload")
+def main(bind, workers, threads, timeout, graceful_timeout):
+    """Runs MokkiGo with several worker processes"""
+    if BaseApplication is None:
+        raise click.ClickException("gunicorn is not installed, install it "
+                                   "with pip install .[server]")
+    MokkigoApplication({
+        "bind": bind,
+        "workers": workers,
+        "threads": threads,
+        "timeout": timeout,
+        "graceful_timeout": graceful_timeout,
+    }).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,375 @@
+"""
+SQLite storage profiles.
+
+A profile is a set of PRAGMAs run on every new connection of the database,
+selected with the SQLITE_PROFILE config key. The PRAGMAs of the profile can
+be overridden one by one with SQLITE_PRAGMAS. The "production" profile also
+sets up a connection pool that is shared by the threads of a server, unless
+SQLALCHEMY_ENGINE_OPTIONS already sets the pool.
+
+Writes go through write_transaction(), which retries the transactions that
+fail because another connection holds the write lock. The inserts of the
+collection POSTs go through insert_transaction(), which can also coalesce
+the inserts of concurrent requests into one commit (GROUP_COMMIT).
+"""
+import os
+import queue
+import random
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import event, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import QueuePool
+from werkzeug.exceptions import ServiceUnavailable
+
+from mokkigo import db, metrics
+from mokkigo.utils import create_error_response
+
+# Primary result codes of a lock held by another connection
+SQLITE_BUSY = 5
+SQLITE_LOCKED = 6
+
+# Longest single pause of write_transaction() in seconds
+RETRY_MAX_DELAY = 0.5
+
+SQLITE_PROFILES = {
+    # Settings of SQLite, only the foreign keys (see models) are enabled
+    "default": {},
+    "production": {
+        # Readers do not block the writer and the writer does not block them
+        "journal_mode": "WAL",
+        # Safe with WAL, a commit does not wait for the disk
+        "synchronous": "NORMAL",
+        # Read the database file through a 256 MiB memory map
+        "mmap_size": 256 * 1024 * 1024,
+        # 64 MiB page cache per connection, negative values are KiB
+        "cache_size": -64 * 1024,
+        "temp_store": "MEMORY",
+        # Wait up to 5 s for the write lock instead of failing at once
+        "busy_timeout": 5000,
+    },
+}
+
+# Pool of the "production" profile, one connection per thread of a server
+# process and some extra for bursts
+PRODUCTION_ENGINE_OPTIONS = {
+    "poolclass": QueuePool,
+    "pool_size": 8,
+    "max_overflow": 8,
+    "pool_timeout": 10,
+    "connect_args": {"check_same_thread": False},
+}
+
+
+def get_pragmas(app):
+    """Returns the PRAGMAs of the configured profile as a dictionary"""
+    name = app.config["SQLITE_PROFILE"]
+    try:
+        pragmas = dict(SQLITE_PROFILES[name])
+    except KeyError:
+        raise ValueError("Unknown SQLITE_PROFILE {}, available profiles are "
+                         "{}".format(name, ", ".join(SQLITE_PROFILES)))
+    pragmas.update(app.config["SQLITE_PRAGMAS"])
+    return pragmas
+
+
+def init_app(app):
+    """
+    Applies the storage profile of the app. Must be called after the config
+    is loaded and before the database is used.
+    """
+    url = make_url(app.config["SQLALCHEMY_DATABASE_URI"])
+    if url.get_backend_name() != "sqlite":
+        return
+    pragmas = get_pragmas(app)
+    # In-memory databases keep the single connection pool of Flask-SQLAlchemy
+    in_memory = url.database in (None, "", ":memory:")
+    if app.config["SQLITE_PROFILE"] == "production" and not in_memory:
+        options = app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", {})
+        for key, value in PRODUCTION_ENGINE_OPTIONS.items():
+            options.setdefault(key, value)
+    if not pragmas:
+        return
+
+    @event.listens_for(db.get_engine(app), "connect")
+    def set_profile_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute("PRAGMA {}={}".format(name, value))
+        cursor.close()
+
+
+def is_busy(error):
+    """
+    Returns True if the OperationalError means that another connection held
+    a lock of the database, so the transaction can be tried again.
+    """
+    code = getattr(error.orig, "sqlite_errorcode", None)
+    if code is not None:
+        # Extended result codes keep the primary code in the lowest byte
+        return code & 0xff in (SQLITE_BUSY, SQLITE_LOCKED)
+    message = str(error.orig)
+    return "database is locked" in message or "database is busy" in message
+
+
+class DatabaseBusy(Exception):
+    """Raised by retry_transaction() when the database stayed locked"""
+
+
+def retry_transaction(write):
+    """
+    Calls write() and commits the session. When SQLite reports the database
+    busy or locked, the session is rolled back and both are tried again after
+    a random delay that grows exponentially, until WRITE_RETRY_DEADLINE
+    seconds have passed and DatabaseBusy is raised. Any other error rolls the
+    session back and is raised as is.
+
+    Because the whole transaction is repeated, write must do all the changes
+    of the request, including changes to already loaded objects, which the
+    rollback reverts.
+
+    : param function write: function doing the changes, its return value is
+        returned after the commit
+    """
+    deadline = time.monotonic() + current_app.config["WRITE_RETRY_DEADLINE"]
+    delay = current_app.config["WRITE_RETRY_DELAY"]
+    attempt = 0
+    while True:
+        try:
+            result = write()
+            db.session.commit()
+            return result
+        except OperationalError as e:
+            db.session.rollback()
+            if not is_busy(e):
+                raise
+            pause = random.uniform(0, min(RETRY_MAX_DELAY,
+                                          delay * 2 ** attempt))
+            attempt += 1
+            if time.monotonic() + pause > deadline:
+                metrics.count("write_retry_failures")
+                raise DatabaseBusy()
+            metrics.count("write_retries")
+            time.sleep(pause)
+        except Exception:
+            db.session.rollback()
+            raise
+
+
+def _service_unavailable():
+    return ServiceUnavailable(response=create_error_response(
+            status_code=503,
+            title="Database busy",
+            message="The database stayed locked by other writes, try again "
+                    "later"
+    ))
+
+
+def begin_immediate():
+    """
+    Takes the write lock for the transaction of the session, unless it is
+    already held. pysqlite begins a transaction only at the first write, so
+    without this the reads before it are not protected from other writers.
+    """
+    connection = db.session.connection()
+    if not connection.connection.driver_connection.in_transaction:
+        connection.execute(text("BEGIN IMMEDIATE"))
+
+
+def write_transaction(write):
+    """
+    Runs the changes of a request with retry_transaction(). If the database
+    stays locked, the request gets a 503 response.
+    """
+    try:
+        return retry_transaction(write)
+    except DatabaseBusy:
+        raise _service_unavailable()
+
+
+def insert_transaction(write):
+    """
+    Runs the inserts of a collection POST. With GROUP_COMMIT the write is
+    queued to the GroupCommitter of the process and committed together with
+    the writes of other requests, otherwise it is run with
+    write_transaction(). Errors of the write (e.g. IntegrityError) are raised
+    in the calling request either way.
+
+    The write may run in the thread of the committer, so it must not touch
+    objects in the session of the request (e.g. objects loaded by the URL
+    converters) and cannot use the request context. New objects may be
+    created before the write as long as they are not added to that session.
+    """
+    if not current_app.config["GROUP_COMMIT"]:
+        return write_transaction(write)
+    try:
+        committer = get_committer(current_app._get_current_object())
+        return committer.submit(write)
+    except DatabaseBusy:
+        raise _service_unavailable()
+
+
+class _Entry(object):
+    """A queued write and its outcome"""
+
+    def __init__(self, write):
+        self.write = write
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+        self._started = False
+        self._cancelled = False
+
+    def start(self):
+        """Returns True if the write was not cancelled and may be run"""
+        with self._lock:
+            self._started = not self._cancelled
+            return self._started
+
+    def cancel(self):
+        """Returns True if the write was not started and never will be"""
+        with self._lock:
+            self._cancelled = not self._started
+            return self._cancelled
+
+
+class GroupCommitter(object):
+    """
+    Background thread that commits queued writes in batches. The first write
+    of a batch waits at most GROUP_COMMIT_WINDOW seconds for others to join,
+    up to GROUP_COMMIT_MAX_BATCH writes. Every write runs in its own
+    savepoint, so a failing write is rolled back alone and the others of the
+    batch are committed with a single commit, i.e. a single sync of the
+    database file.
+
+    A request waits at most GROUP_COMMIT_TIMEOUT seconds for its write to be
+    started, then the write is cancelled and DatabaseBusy is raised. If the
+    thread has stopped, the next write starts a new one.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.window = app.config["GROUP_COMMIT_WINDOW"]
+        self.max_batch = app.config["GROUP_COMMIT_MAX_BATCH"]
+        self.timeout = app.config["GROUP_COMMIT_TIMEOUT"]
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+
+    def submit(self, write):
+        """
+        Queues write, waits until its batch is committed and returns its
+        result or raises its error
+        """
+        entry = _Entry(write)
+        self._get_queue().put(entry)
+        if not entry.done.wait(self.timeout):
+            if entry.cancel():
+                metrics.count("group_commit_timeouts")
+                raise DatabaseBusy()
+            # Already in a batch, whose retries end at WRITE_RETRY_DEADLINE
+            if not entry.done.wait(self.timeout):
+                metrics.count("group_commit_timeouts")
+                raise DatabaseBusy()
+        if entry.error is not None:
+            raise entry.error
+        return entry.result
+
+    def _get_queue(self):
+        with self._lock:
+            # The thread does not survive a fork, so a forked worker process
+            # starts its own committer the first time it writes
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._queue = queue.Queue()
+                self._thread = None
+            if self._thread is None or not self._thread.is_alive():
+                if self._thread is not None:
+                    self.app.logger.warning("Restarting the stopped group "
+                                            "committer thread")
+                self._thread = threading.Thread(
+                        target=self._run, args=(self._queue,),
+                        name="mokkigo-group-commit", daemon=True
+                )
+                self._thread.start()
+            return self._queue
+
+    def _run(self, entries):
+        try:
+            with self.app.app_context():
+                while True:
+                    self._commit_next(entries)
+        except BaseException:
+            self.app.logger.exception("The group committer thread stopped")
+            raise
+
+    def _commit_next(self, entries):
+        batch = [entries.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(entries.get(timeout=timeout))
+            except queue.Empty:
+                break
+        batch = [entry for entry in batch if entry.start()]
+        if not batch:
+            return
+        try:
+            self._commit(batch)
+        except Exception:
+            self.app.logger.exception("Group commit failed")
+        finally:
+            try:
+                db.session.remove()
+            except Exception:
+                self.app.logger.exception("Removing the session of the "
+                                          "group committer failed")
+
+    def _commit(self, batch):
+        def write():
+            # pysqlite does not begin a transaction for SAVEPOINT, so the
+            # first RELEASE would commit without an explicit BEGIN
+            db.session.execute(text("BEGIN IMMEDIATE"))
+            for entry in batch:
+                entry.result = entry.error = None
+                savepoint = db.session.begin_nested()
+                try:
+                    entry.result = entry.write()
+                    savepoint.commit()
+                except OperationalError:
+                    raise
+                except Exception as e:
+                    savepoint.rollback()
+                    entry.error = e
+
+        try:
+            retry_transaction(write)
+            metrics.count("group_commit_batches")
+            metrics.count("group_commit_writes", len(batch))
+        except Exception as e:
+            for entry in batch:
+                entry.error = e
+        finally:
+            for entry in batch:
+                entry.done.set()
+
+
+_committer_lock = threading.Lock()
+
+
+def get_committer(app):
+    """Returns the GroupCommitter of the app, creating it at first use"""
+    with _committer_lock:
+        committer = app.extensions.get("mokkigo_group_commit")
+        if committer is None:
+            committer = GroupCommitter(app)
+            app.extensions["mokkigo_group_commit"] = committer
+        return committer
@@ -0,0 +1,50 @@
+"""
+Date-times of the visits.
+
+The date-times of the requests are parsed strictly as ISO 8601, first with
+datetime.fromisoformat() and only for the forms it does not accept with the
+ISO parser of dateutil. The visits store the date-time as given, without its
+UTC offset, for the representation, and alongside it an integer copy
+normalized to UTC (microseconds since the Unix epoch) that the range queries
+compare. Date-times without an offset are taken to be in UTC.
+"""
+from datetime import datetime, timezone
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def parse_datetime(value):
+    """
+    Returns the ISO 8601 date-time of the string value as a datetime, which
+    is aware if the string has a UTC offset. Raises ValueError if value is
+    not an ISO 8601 date-time.
+    """
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        pass
+    from dateutil import parser
+
+    try:
+        return parser.isoparse(value)
+    except (ValueError, OverflowError):
+        raise ValueError("{!r} is not an ISO 8601 date-time".format(value))
+
+
+def to_epoch(value):
+    """Returns the datetime as microseconds since the Unix epoch in UTC"""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    delta = value - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def stored_isoformat(value):
+    """
+    Returns the ISO 8601 form of a date-time read as text from a DateTime
+    column ("YYYY-MM-DD HH:MM:SS.ffffff"), the same string as isoformat()
+    of the datetime, without building the datetime.
+    """
+    if value.endswith(".000000"):
+        value = value[:-7]
+    return value[:10] + "T" + value[11:]
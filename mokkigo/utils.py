@@ -1,11 +1,27 @@
 # Taken from the course material
 # https://lovelace.oulu.fi/file-download/embedded/ohjelmoitava-web/ohjelmoitava-web/pwp-masonbuilder-py/
+import hashlib
 import json
 
-from flask import url_for, request, Response
+from functools import lru_cache
+from urllib.parse import urlencode
 
-from mokkigo.models import Visit, Mokki, Participant, Item
-from mokkigo.constants import ERROR_PROFILE, MASON
+from flask import (url_for, request, Response, current_app,
+                   stream_with_context)
+from werkzeug.exceptions import BadRequest
+
+from mokkigo.models import Visit, Mokki, Participant, Item, get_versions
+from mokkigo.constants import ERROR_PROFILE, MASON, JSON
+from mokkigo.metrics import timed
+from mokkigo.timeutils import parse_datetime
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Number of list elements joined into one chunk of a streamed response
+STREAM_CHUNK_ITEMS = 128
 
 
 class MasonBuilder(dict):
@@ -74,121 +90,519 @@ class MasonBuilder(dict):
 
 
 class MokkigoBuilder(MasonBuilder):
+    def add_page_controls(self, page):
+        """
+        Adds the Mason "prev" and "next" controls of a keyset paginated
+        collection. Other query parameters (e.g. limit) are kept as they are.
+
+        : param Page page: page returned by paginate()
+        """
+        if page.prev_cursor is not None:
+            self.add_control(
+                    "prev",
+                    href=_page_url(before=page.prev_cursor),
+                    title="Previous page"
+            )
+        if page.next_cursor is not None:
+            self.add_control(
+                    "next",
+                    href=_page_url(after=page.next_cursor),
+                    title="Next page"
+            )
+
     def add_control_add_visit(self):
-        self.add_control(
-                "mokkigo:add-visit",
-                href=url_for("api.visitcollection"),
-                method="POST",
-                encoding="json",
-                title="Add a new visit",
-                schema=Visit.json_schema()
-        )
+        self.add_control_template("mokkigo:add-visit")
 
     def add_control_delete_visit(self, visit):
-        self.add_control(
-                "mokkigo:delete-visit",
-                href=url_for("api.visititem", visit=visit),
-                method="DELETE",
-                title="Delete this visit",
-                schema=Visit.json_schema()
-        )
+        self.add_control_template("mokkigo:delete-visit",
+                                  visit=visit.visit_name)
 
     def add_control_edit_visit(self, visit):
-        self.add_control(
-                "mokkigo:edit-visit",
-                href=url_for("api.visititem", visit=visit),
-                method="PUT",
-                encoding="json",
-                title="Edit this visit",
-                schema=Visit.json_schema()
-        )
+        self.add_control_template("mokkigo:edit-visit",
+                                  visit=visit.visit_name)
 
     def add_control_add_mokki(self):
-        self.add_control(
-                "mokkigo:add-mokki",
-                href=url_for("api.mokkicollection"),
-                method="POST",
-                encoding="json",
-                title="Add a new mokki",
-                schema=Mokki.json_schema()
-        )
+        self.add_control_template("mokkigo:add-mokki")
 
     def add_control_delete_mokki(self, mokki):
-        self.add_control(
-                "mokkigo:delete-mokki",
-                href=url_for("api.mokkiitem", mokki=mokki),
-                method="DELETE",
-                title="Delete this mokki",
-                schema=Mokki.json_schema()
-        )
+        self.add_control_template("mokkigo:delete-mokki", mokki=mokki.name)
 
     def add_control_edit_mokki(self, mokki):
-        self.add_control(
-                "mokkigo:edit-mokki",
-                href=url_for("api.mokkiitem", mokki=mokki),
-                method="PUT",
-                encoding="json",
-                title="Edit this mokki",
-                schema=Mokki.json_schema()
-        )
+        self.add_control_template("mokkigo:edit-mokki", mokki=mokki.name)
 
     def add_control_add_participant(self):
-        self.add_control(
-                "mokkigo:add-participant",
-                href=url_for("api.participantcollection"),
-                method="POST",
-                encoding="json",
-                title="Add a new participant",
-                schema=Participant.json_schema()
-        )
+        self.add_control_template("mokkigo:add-participant")
 
     def add_control_delete_participant(self, participant):
-        self.add_control(
-                "mokkigo:delete-participant",
-                href=url_for("api.participantitem", participant=participant),
-                method="DELETE",
-                title="Delete this participant",
-                schema=Participant.json_schema()
-        )
+        self.add_control_template("mokkigo:delete-participant",
+                                  participant=participant.name)
 
     def add_control_edit_participant(self, participant):
-        self.add_control(
-                "mokkigo:editgparticipant",
-                href=url_for("api.participantitem", participant=participant),
-                method="PUT",
-                encoding="json",
-                title="Edit this participant",
-                schema=Participant.json_schema()
-        )
+        self.add_control_template("mokkigo:editgparticipant",
+                                  participant=participant.name)
 
     def add_control_add_item(self, mokki):
-        self.add_control(
-                "mokkigo:add-item",
-                href=url_for("api.itemcollection", mokki=mokki),
-                method="POST",
-                encoding="json",
-                title="Add a new item",
-                schema=Item.json_schema()
-        )
+        self.add_control_template("mokkigo:add-item", mokki=mokki.name)
 
     def add_control_delete_item(self, mokki, item):
-        self.add_control(
-                "mokkigo:delete-item",
-                href=url_for("api.itemitem", mokki=mokki, item=item),
-                method="DELETE",
-                title="Delete this item",
-                schema=Item.json_schema()
-        )
+        self.add_control_template("mokkigo:delete-item",
+                                  mokki=mokki.name, item=item.name)
 
     def add_control_edit_item(self, mokki, item):
-        self.add_control(
-                "mokkigo:edit-item",
-                href=url_for("api.itemitem", mokki=mokki, item=item),
-                method="PUT",
-                encoding="json",
-                title="Edit this item",
-                schema=Item.json_schema()
-        )
+        self.add_control_template("mokkigo:edit-item",
+                                  mokki=mokki.name, item=item.name)
+
+    def add_control_template(self, ctrl_name, **names):
+        """
+        Adds one of the controls of CONTROLS. Only the href is built per
+        call, the rest of the control (including the schema) is shared.
+
+        : param str ctrl_name: name of the control in CONTROLS
+        : param str names: URL names of the objects in the href
+        """
+        endpoint, static = _get_control_templates()[ctrl_name]
+        self.add_control(ctrl_name, href=resource_url(endpoint, **names),
+                         **static)
+
+
+# Static parts of the MokkigoBuilder controls:
+# name: (endpoint, model whose schema is attached, other properties)
+CONTROLS = {
+    "mokkigo:add-visit": ("api.visitcollection", Visit, {
+        "method": "POST", "encoding": "json", "title": "Add a new visit"}),
+    "mokkigo:delete-visit": ("api.visititem", Visit, {
+        "method": "DELETE", "title": "Delete this visit"}),
+    "mokkigo:edit-visit": ("api.visititem", Visit, {
+        "method": "PUT", "encoding": "json", "title": "Edit this visit"}),
+    "mokkigo:add-mokki": ("api.mokkicollection", Mokki, {
+        "method": "POST", "encoding": "json", "title": "Add a new mokki"}),
+    "mokkigo:delete-mokki": ("api.mokkiitem", Mokki, {
+        "method": "DELETE", "title": "Delete this mokki"}),
+    "mokkigo:edit-mokki": ("api.mokkiitem", Mokki, {
+        "method": "PUT", "encoding": "json", "title": "Edit this mokki"}),
+    "mokkigo:add-participant": ("api.participantcollection", Participant, {
+        "method": "POST", "encoding": "json",
+        "title": "Add a new participant"}),
+    "mokkigo:delete-participant": ("api.participantitem", Participant, {
+        "method": "DELETE", "title": "Delete this participant"}),
+    "mokkigo:editgparticipant": ("api.participantitem", Participant, {
+        "method": "PUT", "encoding": "json",
+        "title": "Edit this participant"}),
+    "mokkigo:add-item": ("api.itemcollection", Item, {
+        "method": "POST", "encoding": "json", "title": "Add a new item"}),
+    "mokkigo:delete-item": ("api.itemitem", Item, {
+        "method": "DELETE", "title": "Delete this item"}),
+    "mokkigo:edit-item": ("api.itemitem", Item, {
+        "method": "PUT", "encoding": "json", "title": "Edit this item"}),
+}
+
+_control_templates = None
+
+
+@lru_cache(maxsize=None)
+def get_schema(model):
+    """
+    Returns the JSON schema of the model. The schema is built only once, so
+    the returned dictionary must not be modified.
+    """
+    return model.json_schema()
+
+
+def _get_control_templates():
+    global _control_templates
+    if _control_templates is None:
+        templates = {}
+        for name, (endpoint, model, props) in CONTROLS.items():
+            templates[name] = (endpoint, dict(props, schema=get_schema(model)))
+        _control_templates = templates
+    return _control_templates
+
+
+class _Placeholder(object):
+    """Stands in for a model object when building URL templates"""
+
+    def __init__(self, key):
+        self.name = self.visit_name = "\x00{}\x00".format(key)
+
+
+def resource_url(endpoint, **names):
+    """
+    Same as url_for(endpoint, ...) for the api resources, but takes the URL
+    names of the objects and formats a template that is built with url_for
+    only once per app and endpoint. Meant for the self links of collection
+    items, where url_for per row is a noticeable part of the request.
+
+    : param str endpoint: endpoint of the resource, e.g. "api.mokkiitem"
+    : param str names: URL name of each object in the path
+    """
+    templates = current_app.extensions.setdefault("mokkigo_url_templates", {})
+    key = (endpoint, request.script_root, tuple(sorted(names)))
+    template = templates.get(key)
+    if template is None:
+        url = url_for(endpoint, **{k: _Placeholder(k) for k in names})
+        template = url.replace("{", "{{").replace("}", "}}")
+        for k in names:
+            template = template.replace("\x00{}\x00".format(k),
+                                        "{" + k + "}")
+        templates[key] = template
+    return template.format(**names)
+
+
+class Page(object):
+    """
+    One page of a keyset paginated collection.
+
+    rows            rows of the page in ascending key order
+    prev_cursor     key to use with ?before= to get the previous page or None
+    next_cursor     key to use with ?after= to get the next page or None
+    total           number of rows in the whole collection if ?count=true
+                    was requested, otherwise None
+
+    When the page is streamed, rows is an iterator and the cursors are known
+    only after it has been exhausted.
+    """
+
+    def __init__(self, rows, prev_cursor, next_cursor, total=None):
+        self.rows = rows
+        self.prev_cursor = prev_cursor
+        self.next_cursor = next_cursor
+        self.total = total
+
+
+def get_flag(name):
+    """Returns True if the boolean query parameter name is set"""
+    return request.args.get(name, "").lower() in ("1", "true", "yes")
+
+
+def is_streamed():
+    """Returns True if the client requested a streamed collection"""
+    return get_flag("stream")
+
+
+def get_page_limit():
+    """
+    Returns the page size requested with ?limit=. The value is capped to the
+    MAX_PAGE_SIZE (STREAM_MAX_PAGE_SIZE for streamed responses) of the app
+    and defaults to PAGE_SIZE.
+    """
+    limit = request.args.get("limit", current_app.config["PAGE_SIZE"])
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise BadRequest(response=create_error_response(
+                status_code=400,
+                title="Invalid query parameter",
+                message="limit must be an integer"
+        ))
+    if is_streamed():
+        max_size = current_app.config["STREAM_MAX_PAGE_SIZE"]
+    else:
+        max_size = current_app.config["MAX_PAGE_SIZE"]
+    return max(1, min(limit, max_size))
+
+
+def get_time_arg(name):
+    """
+    Returns the date-time given in the query parameter name as a datetime, or
+    None if the parameter is not given.
+    """
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return parse_datetime(value)
+    except ValueError:
+        raise BadRequest(response=create_error_response(
+                status_code=400,
+                title="Invalid query parameter",
+                message="{} must be an ISO 8601 date-time".format(name)
+        ))
+
+
+def paginate(query, key):
+    """
+    Keyset pagination of a collection query. The rows are ordered by the
+    unique column key and the page is selected with ?after= or ?before=
+    cursors, so fetching any page is an index range scan instead of an
+    OFFSET over the whole table. One extra row is fetched to find out if
+    there is a page after this one.
+
+    For streamed responses (?stream=true) the rows of a forward page are
+    fetched lazily in batches with yield_per.
+
+    : param Query query: query of the whole collection
+    : param Column key: unique column used for ordering and as the cursor
+    : return: Page
+    """
+    limit = get_page_limit()
+    after = request.args.get("after")
+    before = request.args.get("before")
+
+    total = None
+    if get_flag("count"):
+        total = query.order_by(None).count()
+
+    if before is not None:
+        rows = query.filter(key < before).order_by(key.desc()) \
+                    .limit(limit + 1).all()
+        has_prev = len(rows) > limit
+        rows = rows[:limit]
+        rows.reverse()
+        has_next = True
+    else:
+        if after is not None:
+            query = query.filter(key > after)
+        query = query.order_by(key).limit(limit + 1)
+        if is_streamed():
+            page = Page(None, None, None, total)
+            page.rows = _stream_rows(query, key, limit, after, page)
+            return page
+        rows = query.all()
+        has_next = len(rows) > limit
+        rows = rows[:limit]
+        has_prev = after is not None
+
+    prev_cursor = next_cursor = None
+    if rows:
+        if has_prev:
+            prev_cursor = getattr(rows[0], key.key)
+        if has_next:
+            next_cursor = getattr(rows[-1], key.key)
+    return Page(rows, prev_cursor, next_cursor, total)
+
+
+def _stream_rows(query, key, limit, after, page):
+    count = 0
+    last = None
+    for row in query.yield_per(current_app.config["STREAM_BATCH_SIZE"]):
+        if count == limit:
+            page.next_cursor = last
+            break
+        last = getattr(row, key.key)
+        if count == 0 and after is not None:
+            page.prev_cursor = last
+        count += 1
+        yield row
+
+
+def is_lean():
+    """
+    Returns True if the client asked for the lean representation without
+    Mason controls and namespaces, either with ?controls=none or by
+    preferring application/json over Mason in the Accept header.
+    """
+    if request.args.get("controls", "").lower() == "none":
+        return True
+    accept = request.accept_mimetypes
+    return accept[JSON] > accept[MASON]
+
+
+def get_field_names(fields):
+    """
+    Returns the names of the fields requested with ?fields=name,location in
+    the requested order, or all the fields if the parameter is not given.
+
+    : param dict fields: field name -> column of all the fields
+    """
+    names = request.args.get("fields")
+    if names is None:
+        return list(fields)
+    names = [name.strip() for name in names.split(",") if name.strip()]
+    unknown = [name for name in names if name not in fields]
+    if unknown or not names:
+        raise BadRequest(response=create_error_response(
+                status_code=400,
+                title="Invalid query parameter",
+                message="Unknown fields {}, available fields are {}".format(
+                    ", ".join(unknown), ", ".join(fields))
+        ))
+    return names
+
+
+def select_columns(names, fields, key):
+    """
+    Returns the columns to select for the requested fields. The collections
+    read their rows as plain tuples of these columns rather than as ORM
+    instances, so only the requested columns are loaded. The columns are
+    labeled with the field names and the cursor column key is always
+    included, so the rows work with paginate().
+
+    : param list names: requested field names from get_field_names()
+    : param dict fields: field name -> column of all the fields
+    : param Column key: cursor column of the collection
+    """
+    columns = [fields[name].label(name) for name in names]
+    if key.key not in names:
+        columns.append(key)
+    return columns
+
+
+def serialize_fields(row, names, converters=None):
+    """
+    Returns a MokkigoBuilder with the requested fields of a row. Values of
+    the fields in converters are passed through the converter function.
+    """
+    converters = converters or {}
+    doc = MokkigoBuilder()
+    for name in names:
+        value = getattr(row, name)
+        if name in converters:
+            value = converters[name](value)
+        doc[name] = value
+    return doc
+
+
+def item_response(body, names, etag, mimetype=MASON):
+    """
+    Builds the response of an item GET with only the requested fields. The
+    lean representation (see is_lean()) drops the controls and namespaces.
+    """
+    with timed("mason"):
+        for name in list(body):
+            if not name.startswith("@") and name not in names:
+                del body[name]
+        if is_lean():
+            body.pop("@controls", None)
+            body.pop("@namespaces", None)
+            mimetype = JSON
+    with timed("encode"):
+        data = json_dumps(body)
+    resp = Response(data, 200, mimetype=mimetype)
+    resp.set_etag(etag)
+    return resp
+
+
+def json_dumps(obj):
+    """
+    Serializes obj to JSON bytes with orjson if it is installed and with the
+    standard library json module otherwise.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode("utf-8")
+
+
+def collection_response(body, page, serialize, etag, mimetype=MASON):
+    """
+    Builds the response of a collection GET. The rows of the page are turned
+    into items with serialize and the page controls are added to body.
+
+    Streamed responses (?stream=true) are written item by item from a
+    generator, so neither the whole items list nor the whole document is
+    ever held in memory. The controls are written after the items because
+    the next page is known only at the end.
+
+    : param MokkigoBuilder body: collection document without the items
+    : param Page page: page returned by paginate()
+    : param function serialize: function that returns the item of a row
+    : param str etag: ETag of the representation
+    """
+    if is_lean():
+        # Page links become plain "next" and "prev" hrefs
+        body.pop("@namespaces", None)
+        body.pop("@controls", None)
+        mimetype = JSON
+
+    if not is_streamed():
+        with timed("mason"):
+            body["items"] = [serialize(row) for row in page.rows]
+            _add_page_links(body, page)
+        with timed("encode"):
+            data = json_dumps(body)
+        resp = Response(data, 200, mimetype=mimetype)
+        resp.set_etag(etag)
+        return resp
+
+    controls = MokkigoBuilder()
+    if not is_lean():
+        controls["@controls"] = body.pop("@controls", {})
+    head = json_dumps(body)[:-1]
+    if len(head) > 1:
+        head += b","
+
+    def generate():
+        chunk = [head, b'"items":[']
+        first = True
+        for row in page.rows:
+            if not first:
+                chunk.append(b",")
+            first = False
+            chunk.append(json_dumps(serialize(row)))
+            if len(chunk) >= STREAM_CHUNK_ITEMS:
+                yield b"".join(chunk)
+                chunk = []
+        _add_page_links(controls, page)
+        chunk.append(b"]")
+        for key, value in controls.items():
+            chunk.append(b"," + json_dumps(key) + b":" + json_dumps(value))
+        chunk.append(b"}")
+        yield b"".join(chunk)
+
+    resp = Response(stream_with_context(generate()), 200, mimetype=mimetype)
+    resp.set_etag(etag)
+    return resp
+
+
+def get_etag(*table_names, extra=None):
+    """
+    Returns a strong ETag for the representation of the current request. The
+    ETag is derived from the request URL and the change counters of the
+    tables the representation is built from, so it can be checked with one
+    small query and without loading or serializing any rows.
+
+    : param str table_names: names of the tables the representation uses
+    : param extra: optional, other values the representation depends on that
+        are not in the URL, e.g. the current date
+    """
+    key = "{} {} {} {}".format(
+            request.full_path,
+            request.accept_mimetypes,
+            get_versions(table_names),
+            extra
+    )
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def not_modified(etag):
+    """
+    Returns a 304 response if the client already has the representation with
+    the given ETag (If-None-Match), otherwise None.
+    """
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+        resp.set_etag(etag)
+        return resp
+    return None
+
+
+def _add_page_links(body, page):
+    if not is_lean():
+        body.add_page_controls(page)
+        return
+    if page.prev_cursor is not None:
+        body["prev"] = _page_url(before=page.prev_cursor)
+    if page.next_cursor is not None:
+        body["next"] = _page_url(after=page.next_cursor)
+
+
+def _page_url(**cursor):
+    args = request.args.to_dict()
+    args.pop("after", None)
+    args.pop("before", None)
+    args.update(cursor)
+    return request_url(args)
+
+
+def request_url(args):
+    """
+    Returns the URL of the current resource with the query args. The args
+    are not given to url_for, which would take those named like a path
+    variable or starting with _ as its own.
+    """
+    url = url_for(request.endpoint, **request.view_args)
+    if args:
+        url += "?" + urlencode(args)
+    return url
 
 
 def create_error_response(status_code, title, message=None):
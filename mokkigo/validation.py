@@ -0,0 +1,147 @@
+"""
+Validation of the JSON documents of the requests against the schemas of the
+models.
+
+The validator of each model is compiled once and kept in a registry, so a
+request neither checks the schema against the metaschema nor creates a new
+validator class. For the flat schemas of the models a checking function is
+also generated from the schema (VALIDATION_FAST_PATH). It only tells whether
+a document is valid: documents it rejects are validated again by jsonschema,
+so the error messages are always those of jsonschema.
+
+jsonschema is imported on the first validation rather than with the
+resources, since it is one of the slowest imports of the app and e.g. the
+CLI commands never need it.
+"""
+from functools import lru_cache
+
+from flask import current_app
+
+from mokkigo.metrics import timed
+from mokkigo.utils import get_schema
+
+# Python types of the JSON schema types, as jsonschema checks them
+SCHEMA_TYPES = {
+    "object": "dict",
+    "array": "list",
+    "string": "str",
+}
+
+# Keywords the generated checkers understand, others prevent the fast path
+FAST_PATH_KEYWORDS = {"type", "properties", "required", "items", "format",
+                      "description"}
+
+
+def _check_lines(schema, var, depth, lines, indent):
+    """
+    Appends the lines of Python checking that the value in var follows
+    schema. Returns False if the schema uses keywords the checker does not
+    understand.
+    """
+    if set(schema) - FAST_PATH_KEYWORDS:
+        return False
+    pad = "    " * indent
+    if "type" in schema:
+        if schema["type"] not in SCHEMA_TYPES:
+            return False
+        lines.append("{}if not isinstance({}, {}):".format(
+            pad, var, SCHEMA_TYPES[schema["type"]]))
+        lines.append("{}    return False".format(pad))
+    if "format" in schema:
+        lines.append("{}if not conforms({}, {!r}):".format(
+            pad, var, schema["format"]))
+        lines.append("{}    return False".format(pad))
+    if ("properties" in schema or "required" in schema) and \
+            schema.get("type") != "object":
+        return False
+    for name in schema.get("required", []):
+        lines.append("{}if {!r} not in {}:".format(pad, name, var))
+        lines.append("{}    return False".format(pad))
+    value = "v{}".format(depth + 1)
+    for name, prop in schema.get("properties", {}).items():
+        lines.append("{}if {!r} in {}:".format(pad, name, var))
+        lines.append("{}    {} = {}[{!r}]".format(pad, value, var, name))
+        if not _check_lines(prop, value, depth + 1, lines, indent + 1):
+            return False
+    if "items" in schema:
+        if schema.get("type") != "array":
+            return False
+        lines.append("{}for {} in {}:".format(pad, value, var))
+        if not _check_lines(schema["items"], value, depth + 1, lines,
+                            indent + 1):
+            return False
+    return True
+
+
+def compile_checker(schema, format_checker=None):
+    """
+    Generates a function that returns True if a document follows schema, or
+    None if the schema uses keywords the generator does not support. Formats
+    are checked with format_checker, or not at all if it is None.
+    """
+    lines = ["def check(v0):"]
+    if not _check_lines(schema, "v0", 0, lines, 1):
+        return None
+    lines.append("    return True")
+
+    def conforms(value, format):
+        return format_checker is None or \
+            format_checker.conforms(value, format)
+
+    namespace = {"conforms": conforms}
+    exec(compile("\n".join(lines), "<validator>", "exec"), namespace)
+    return namespace["check"]
+
+
+class ModelValidator(object):
+    """Compiled jsonschema validator and fast path checker of a schema"""
+
+    def __init__(self, schema, check_formats=False):
+        from jsonschema import Draft7Validator, draft7_format_checker
+
+        format_checker = draft7_format_checker if check_formats else None
+        Draft7Validator.check_schema(schema)
+        self.validator = Draft7Validator(schema,
+                                         format_checker=format_checker)
+        self.fast_check = compile_checker(schema, format_checker)
+
+    def is_valid(self, doc, fast=True):
+        if fast and self.fast_check is not None:
+            return self.fast_check(doc)
+        return self.validator.is_valid(doc)
+
+    def best_error(self, doc):
+        """Returns the error jsonschema.validate() would raise, or None"""
+        from jsonschema.exceptions import best_match
+
+        return best_match(self.validator.iter_errors(doc))
+
+    def first_error(self, doc):
+        """Returns the first error found in the document, or None"""
+        return next(self.validator.iter_errors(doc), None)
+
+
+@lru_cache(maxsize=None)
+def get_validator(model, check_formats=False):
+    """Returns the ModelValidator of the model, compiled at first use"""
+    return ModelValidator(get_schema(model), check_formats)
+
+
+def validation_error(doc, model, check_formats=False):
+    """
+    Returns the error message of the document, or None if the document is
+    valid.
+
+    : param doc: JSON document of the request
+    : param Model model: model whose json_schema() the document must follow
+    : param bool check_formats: whether formats like date-time are checked
+    """
+    with timed("validate"):
+        validator = get_validator(model, check_formats)
+        if validator.is_valid(doc,
+                              current_app.config["VALIDATION_FAST_PATH"]):
+            return None
+        error = validator.best_error(doc)
+    if error is None:
+        return None
+    return str(error)
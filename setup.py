@@ -15,5 +15,14 @@ setup(
         'flask-sqlalchemy',
         'python-dateutil',
         'SQLAlchemy'
-    ]
+    ],
+    extras_require={
+        'asgi': ['uvicorn'],
+        'server': ['gunicorn']
+    },
+    entry_points={
+        'console_scripts': [
+            'mokkigo-serve = mokkigo.server:main'
+        ]
+    }
 )
@@ -5,13 +5,16 @@ import os
 import pytest
 import tempfile
 
+from types import SimpleNamespace
+
 from datetime import datetime
 
 from sqlalchemy.engine import Engine
-from sqlalchemy import event
+from sqlalchemy import event, inspect, text
 
 from mokkigo import create_app, db
 from mokkigo.models import Visit, Mokki, Participant, Item
+from mokkigo.server import post_fork
 
 
 @event.listens_for(Engine, "connect")
@@ -44,7 +47,7 @@ def _get_visit(num, mokki, parts):
     name = "Visit {}".format(num)
     time = datetime.now()
     return Visit(visit_name=name,
-                 mokki_name=mokki,
+                 mokki=mokki,
                  time_start=time,
                  time_end=time,
                  participants=parts)
@@ -98,7 +101,7 @@ def test_create_visit(app):
         m = _get_mokki(1)
         p1 = _get_participant(1)
         participants.append(p1)
-        v = _get_visit(2, m.name, participants)
+        v = _get_visit(2, m, participants)
 
         db.session.add(m)
         db.session.add(p1)
@@ -126,7 +129,7 @@ def test_create_instances(app):
         parts.append(p1)
         parts.append(p2)
 
-        v1 = _get_visit(num=1, mokki=m1.name, parts=parts)
+        v1 = _get_visit(num=1, mokki=m1, parts=parts)
 
         db.session.add(p1)
         db.session.add(p2)
@@ -140,3 +143,187 @@ def test_create_instances(app):
         assert Mokki.query.count() == 1
         assert Participant.query.count() == 2
         assert Item.query.count() == 2
+
+
+def test_export_import(app):
+    with app.app_context():
+        p1 = _get_participant(num=1)
+        p2 = _get_participant(num=2)
+        m1 = _get_mokki(num=1)
+        i1 = _get_item(num=1)
+        i1.mokki = m1
+        v1 = _get_visit(num=1, mokki=m1, parts=[p1, p2])
+        db.session.add_all([p1, p2, m1, i1, v1])
+        db.session.commit()
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=["export-db", "--batch-size", "1"])
+    assert result.exit_code == 0
+    lines = result.output.splitlines()
+    assert len(lines) == 7
+
+    db_fd, db_fname = tempfile.mkstemp()
+    other = create_app({
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+            "TESTING": "TRUE",
+    })
+    with other.app_context():
+        db.create_all()
+
+    runner = other.test_cli_runner()
+    result = runner.invoke(args=["import-db", "--commit-size", "2"],
+                           input=result.output)
+    assert result.exit_code == 0
+    with other.app_context():
+        v = Visit.query.first()
+        assert v.time_start is not None
+        assert len(v.participants) == 2
+        assert Item.query.first().mokki.name == "Mokki 1"
+    os.close(db_fd)
+    os.unlink(db_fname)
+
+
+def test_migrate_visit_mokki_id(app):
+    with app.app_context():
+        db.session.add(_get_mokki(num=1))
+        db.session.commit()
+        # Visit table of the schema before mokki_id was added
+        db.session.execute(text("DROP TABLE participant_visit"))
+        db.session.execute(text("DROP TABLE visit"))
+        db.session.execute(text(
+            "CREATE TABLE visit (id INTEGER PRIMARY KEY, "
+            "visit_name VARCHAR(64) NOT NULL UNIQUE, "
+            "mokki_name VARCHAR(64) NOT NULL, "
+            "time_start DATETIME NOT NULL, time_end DATETIME NOT NULL)"
+        ))
+        db.session.execute(text(
+            "INSERT INTO visit (visit_name, mokki_name, time_start, time_end)"
+            " VALUES ('Visit 1', 'Mokki 1', '2022-01-01 00:00:00.000000',"
+            " '2022-01-02 00:00:00.000000')"
+        ))
+        db.session.commit()
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=["migrate-db"])
+    assert result.exit_code == 0
+    with app.app_context():
+        v = Visit.query.first()
+        assert v.mokki_name == "Mokki 1"
+        assert v.mokki.visits == [v]
+        assert v.time_start_epoch == 1640995200 * 1000000
+        assert v.time_end_epoch == (1640995200 + 86400) * 1000000
+
+
+def _visit_schema():
+    inspector = inspect(db.engine)
+    columns = [(c["name"], str(c["type"]), c["nullable"])
+               for c in inspector.get_columns("visit")]
+    indexes = sorted((i["name"], i["column_names"], i["unique"])
+                     for i in inspector.get_indexes("visit"))
+    return columns, indexes, inspector.get_foreign_keys("visit")
+
+
+def test_migrate_visit_epochs(app):
+    with app.app_context():
+        p1 = _get_participant(num=1)
+        m1 = _get_mokki(num=1)
+        db.session.add(_get_visit(num=1, mokki=m1, parts=[p1]))
+        db.session.commit()
+        fresh = _visit_schema()
+        # Visit table of the schema before the epoch columns were added
+        for index in ("ix_visit_mokki_id_time_end_epoch",
+                      "ix_visit_time_end_epoch"):
+            db.session.execute(text("DROP INDEX {}".format(index)))
+        for column in ("time_start_epoch", "time_end_epoch"):
+            db.session.execute(text(
+                "ALTER TABLE visit DROP COLUMN {}".format(column)))
+        db.session.commit()
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=["migrate-db"])
+    assert result.exit_code == 0
+    with app.app_context():
+        assert _visit_schema() == fresh
+        v = Visit.query.first()
+        assert v.time_start_epoch is not None
+        assert [p.name for p in v.participants] == ["Participant 1"]
+        # The search triggers of the rebuilt table work
+        db.session.add(_get_visit(num=2, mokki=v.mokki, parts=[]))
+        db.session.commit()
+        names = db.session.execute(text(
+            "SELECT name FROM search_index WHERE search_index MATCH 'visit'"
+        )).scalars().all()
+        assert sorted(names) == ["Visit 1", "Visit 2"]
+
+
+def test_migrate_participant_visit_pk(app):
+    with app.app_context():
+        p1 = _get_participant(num=1)
+        m1 = _get_mokki(num=1)
+        v1 = _get_visit(num=1, mokki=m1, parts=[])
+        db.session.add_all([p1, m1, v1])
+        db.session.commit()
+        # Association table of the schema before the primary key was added
+        db.session.execute(text("DROP TABLE participant_visit"))
+        db.session.execute(text(
+            "CREATE TABLE participant_visit ("
+            "participant_id INTEGER REFERENCES participant(id), "
+            "visit_id INTEGER REFERENCES visit(id))"
+        ))
+        for i in range(3):
+            db.session.execute(text(
+                "INSERT INTO participant_visit VALUES (1, 1)"
+            ))
+        db.session.commit()
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=["migrate-db"])
+    assert result.exit_code == 0
+    assert "removed 2 duplicate links" in result.output
+    with app.app_context():
+        v = Visit.query.first()
+        assert [p.name for p in v.participants] == ["Participant 1"]
+
+
+def test_production_profile():
+    db_fd, db_fname = tempfile.mkstemp()
+    app = create_app({
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+            "TESTING": "TRUE",
+            "SQLITE_PROFILE": "production",
+            "SQLITE_PRAGMAS": {"cache_size": -1024},
+    })
+    with app.app_context():
+        assert db.session.execute(text("PRAGMA journal_mode")).scalar() == \
+            "wal"
+        assert db.session.execute(text("PRAGMA busy_timeout")).scalar() == \
+            5000
+        assert db.session.execute(text("PRAGMA cache_size")).scalar() == \
+            -1024
+        db.session.remove()
+        db.get_engine().dispose()
+    os.close(db_fd)
+    os.unlink(db_fname)
+
+
+def test_post_fork():
+    db_fd, db_fname = tempfile.mkstemp()
+    app = create_app({
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+            "TESTING": "TRUE",
+            "SQLITE_PROFILE": "production",
+    })
+    with app.app_context():
+        db.session.execute(text("SELECT 1"))
+        db.session.remove()
+        pool = db.get_engine().pool
+        assert pool.checkedin() == 1
+
+    # A forked worker starts with an empty pool of its own
+    post_fork(SimpleNamespace(app=SimpleNamespace(callable=app)), None)
+    with app.app_context():
+        assert db.get_engine().pool is not pool
+        assert db.get_engine().pool.checkedin() == 0
+    pool.dispose()
+    os.close(db_fd)
+    os.unlink(db_fname)
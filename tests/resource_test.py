@@ -1,17 +1,31 @@
 # Code edited from
 # https://lovelace.oulu.fi/ohjelmoitava-web/ohjelmoitava-web/testing-flask-applications-part-2/ # noqa
 
+import asyncio
 import json
+import logging
 import os
 import pytest
+import queue
+import sqlite3
 import tempfile
-from datetime import datetime
-from jsonschema import validate
+import threading
+from datetime import date, datetime, timedelta
+from flask import url_for
+from jsonschema import ValidationError, validate
 from sqlalchemy.engine import Engine
 from sqlalchemy import event
 
 from mokkigo import create_app, db
+from mokkigo.asgi import AsgiAdapter
+from mokkigo.constants import LINK_RELATIONS_URL
+from mokkigo.metrics import get_counters, get_query_count
 from mokkigo.models import Visit, Mokki, Item, Participant
+from mokkigo.resources import calendar
+from mokkigo.storage import get_committer
+from mokkigo.timeutils import parse_datetime
+from mokkigo.utils import STREAM_CHUNK_ITEMS, MokkigoBuilder, resource_url
+from mokkigo.validation import get_validator, validation_error
 
 from tests.utils import (get_mokki, get_item, get_participant, get_visit)
 
@@ -44,32 +58,33 @@ def client():
     os.unlink(db_fname)
 
 
-def _populate_db():
+def _populate_db(count=4, offset=0):
     ps = []
     items = []
     ms = []
     vs = []
-    for i in range(4):
-        ps.append(Participant(name="participant-{}".format(i+1),
-                              allergies="food-{}".format(i+1)))
+    for i in range(count):
+        n = offset + i + 1
+        ps.append(Participant(name="participant-{}".format(n),
+                              allergies="food-{}".format(n)))
 
-        items.append(Item(name="item-{}".format(i+1),
-                          amount="{}".format(i+1)))
+        items.append(Item(name="item-{}".format(n),
+                          amount="{}".format(n)))
 
-        ms.append(Mokki(name="mokki-{}".format(i+1),
-                        location="location-{}".format(i+1)))
+        ms.append(Mokki(name="mokki-{}".format(n),
+                        location="location-{}".format(n)))
 
         db.session.add(ps[i])
         db.session.add(items[i])
         db.session.add(ms[i])
         db.session.commit()
 
-    for i in range(4):
+    for i in range(count):
         visit_parts = []
         visit_parts.append(ps[i])
         visit_parts.append(ps[i-1])
-        vs.append(Visit(visit_name="visit-{}".format(i+1),
-                        mokki_name=ms[i].name,
+        vs.append(Visit(visit_name="visit-{}".format(offset + i + 1),
+                        mokki=ms[i],
                         time_start=datetime.now(),
                         time_end=datetime.now(),
                         participants=visit_parts))
@@ -77,6 +92,21 @@ def _populate_db():
         db.session.commit()
 
 
+def _populate_mokki_1(client, count=4, offset=0):
+    """
+    Populates the DB and moves all the items and visits to mokki-1, so its
+    lists grow with count
+    """
+    with client.application.app_context():
+        _populate_db(count, offset)
+        m = Mokki.query.filter_by(name="mokki-1").first()
+        for i in Item.query.all():
+            i.mokki = m
+        for v in Visit.query.all():
+            v.mokki = m
+        db.session.commit()
+
+
 def _check_namespace(client, body):
     """ Checks that the namespace (mokkigo) is in response body."""
     href = body["@namespaces"]["mokkigo"]["name"]
@@ -449,8 +479,916 @@ class TestVisit(object):
         r = client.delete(self.ITEM2)
         assert r.status_code == 404
 
+    def test_put_parses_times_once(self, client, monkeypatch):
+        client.post(self.MOKKI, json=get_mokki())
+        client.post(self.COLLECTION, json=get_visit())
+
+        calls = []
+
+        def parse(value):
+            calls.append(value)
+            return parse_datetime(value)
+
+        monkeypatch.setattr("mokkigo.resources.visit.parse_datetime", parse)
+        monkeypatch.setattr("mokkigo.models.parse_datetime", parse)
+        vjson = get_visit()
+        vjson["time_end"] = "2022-12-31T12:00:00"
+        r = client.put(self.ITEM, json=vjson)
+        assert r.status_code == 204
+        assert calls == [vjson["time_start"], vjson["time_end"]]
+        r = client.get(self.ITEM)
+        assert json.loads(r.data)["time_end"] == "2022-12-31T12:00:00"
+
 
 class TestOther(object):
     def test(self, client):
         r = client.get('/api/')
         assert r.status_code == 200
+
+
+class TestApiDocs(object):
+    def test_lazy_docs(self, client, tmp_path):
+        app = client.application
+        app.instance_path = str(tmp_path)
+        assert app.wsgi_app.docs is None
+
+        r = client.get('/apispec_1.json')
+        assert r.status_code == 200
+        spec = json.loads(r.data)
+        assert spec["info"]["title"] == "MokkiGo"
+        assert "post" in spec["paths"]["/api/visits/"]
+        cached = list(tmp_path.glob("apispec-*.json"))
+        assert len(cached) == 1
+
+        r = client.get('/apidocs/')
+        assert r.status_code == 200
+
+        # A new process reads the spec from the cache
+        app = create_app(dict(app.config, API_DOCS=True))
+        app.instance_path = str(tmp_path)
+        r = app.test_client().get('/apispec_1.json')
+        assert json.loads(r.data) == spec
+
+        app = create_app(dict(app.config, API_DOCS=False))
+        assert app.test_client().get('/apidocs/').status_code == 404
+
+
+class TestPagination(object):
+    COLLECTIONS = ['/api/mokkis/', '/api/participants/', '/api/visits/',
+                   '/api/mokkis/mokki-1/items/']
+
+    def test_pages(self, client):
+        _populate_mokki_1(client)
+
+        for url in self.COLLECTIONS:
+            r = client.get(url + '?limit=3&count=true')
+            assert r.status_code == 200
+            body = json.loads(r.data)
+            assert len(body["items"]) == 3
+            assert body["total"] == 4
+            assert "prev" not in body["@controls"]
+
+            r = client.get(body["@controls"]["next"]["href"])
+            assert r.status_code == 200
+            body = json.loads(r.data)
+            assert len(body["items"]) == 1
+            assert "next" not in body["@controls"]
+
+            r = client.get(body["@controls"]["prev"]["href"])
+            body = json.loads(r.data)
+            assert len(body["items"]) == 3
+            assert "prev" not in body["@controls"]
+
+        r = client.get('/api/mokkis/?limit=100000')
+        assert len(json.loads(r.data)["items"]) == 4
+
+        r = client.get('/api/mokkis/?limit=abc')
+        assert r.status_code == 400
+
+        r = client.get('/api/mokkis/?after=mokki-4')
+        assert r.status_code == 200
+        assert json.loads(r.data)["items"] == []
+
+    def test_page_links_keep_args(self, client):
+        with client.application.app_context():
+            _populate_db()
+
+        # Query args named like a path variable or a url_for option
+        r = client.get('/api/participants/participant-1/visits/?limit=1'
+                       '&participant=participant-2&_anchor=zz')
+        assert r.status_code == 200
+        href = json.loads(r.data)["@controls"]["next"]["href"]
+        assert href.startswith('/api/participants/participant-1/visits/?')
+        assert "participant=participant-2" in href
+        assert "_anchor=zz" in href
+        assert "#" not in href
+        r = client.get(href)
+        assert r.status_code == 200
+
+
+class TestQueryCount(object):
+    """
+    The number of queries of a GET must not depend on the number of rows, so
+    N+1 query patterns in the resource modules fail here.
+    """
+    URLS = ['/api/mokkis/', '/api/participants/', '/api/visits/',
+            '/api/mokkis/mokki-1/items/', '/api/mokkis/mokki-1/',
+            '/api/participants/participant-1/', '/api/visits/visit-1/',
+            '/api/mokkis/mokki-1/items/item-1/',
+            '/api/mokkis/mokki-1/visits/',
+            '/api/participants/participant-1/visits/',
+            '/api/mokkis/mokki-1/calendar/', '/api/search/?q=mokki']
+
+    def _count_queries(self, client):
+        counts = []
+        for url in self.URLS:
+            with client:
+                r = client.get(url)
+                assert r.status_code == 200
+                counts.append(get_query_count())
+        return counts
+
+    def test_constant_queries(self, client):
+        _populate_mokki_1(client)
+        small = self._count_queries(client)
+
+        _populate_mokki_1(client, count=8, offset=4)
+        large = self._count_queries(client)
+
+        assert small == large
+
+
+class TestIdentityCache(object):
+    def test_cached_lookup(self, client):
+        with client.application.app_context():
+            _populate_db()
+
+        # First request fills the cache, second one only reads the ETag
+        # change counters
+        r = client.get('/api/mokkis/mokki-1/')
+        assert r.status_code == 200
+        with client:
+            r = client.get('/api/mokkis/mokki-1/')
+            assert r.status_code == 200
+            assert get_query_count() == 1
+
+        r = client.get('/api/visits/visit-1/')
+        r = client.get('/api/visits/visit-1/')
+        body = json.loads(r.data)
+        assert sorted(body["participants"]) == ["participant-1",
+                                                "participant-4"]
+
+        # Updates and deletes evict the cached rows
+        r = client.put('/api/mokkis/mokki-1/', json=get_mokki(10))
+        assert r.status_code == 204
+        r = client.get('/api/mokkis/mokki-1/')
+        assert r.status_code == 404
+        r = client.get('/api/mokkis/mokki-10/')
+        body = json.loads(r.data)
+        assert body["location"] == "Location-10"
+
+        r = client.delete('/api/mokkis/mokki-10/')
+        assert r.status_code == 204
+        r = client.get('/api/mokkis/mokki-10/')
+        assert r.status_code == 404
+
+    def test_other_process(self, client):
+        # A second app on the same database stands for another worker
+        other = create_app({
+            "SQLALCHEMY_DATABASE_URI":
+                client.application.config["SQLALCHEMY_DATABASE_URI"],
+            "TESTING": True
+        }).test_client()
+        client.post('/api/mokkis/', json=[get_mokki(1), get_mokki(2)])
+        for c in (client, other):
+            assert c.get('/api/mokkis/mokki-1/').status_code == 200
+
+        r = client.delete('/api/mokkis/mokki-1/')
+        assert r.status_code == 204
+        assert other.get('/api/mokkis/mokki-1/').status_code == 404
+        assert other.delete('/api/mokkis/mokki-1/').status_code == 404
+        assert other.get('/api/mokkis/mokki-2/').status_code == 200
+
+
+class TestETag(object):
+    URLS = ['/api/mokkis/', '/api/participants/', '/api/visits/',
+            '/api/mokkis/mokki-1/', '/api/participants/participant-1/',
+            '/api/visits/visit-1/']
+
+    def test_not_modified(self, client):
+        with client.application.app_context():
+            _populate_db()
+
+        for url in self.URLS:
+            r = client.get(url)
+            assert r.status_code == 200
+            etag = r.headers["ETag"]
+
+            r = client.get(url, headers={"If-None-Match": etag})
+            assert r.status_code == 304
+            assert r.data == b""
+
+        r = client.get('/api/visits/')
+        etag = r.headers["ETag"]
+        r = client.put('/api/participants/participant-1/',
+                       json=get_participant(1))
+        assert r.status_code == 204
+        r = client.get('/api/visits/', headers={"If-None-Match": etag})
+        assert r.status_code == 200
+        assert r.headers["ETag"] != etag
+
+    def test_visit_keeps_participants(self, client):
+        with client.application.app_context():
+            _populate_db()
+
+        r = client.get('/api/participants/')
+        etag = r.headers["ETag"]
+        # The participants of the visit are linked through the backref, but
+        # their rows do not change
+        vjson = get_visit(2)
+        vjson["mokki_name"] = "mokki-1"
+        vjson["participants"] = ["participant-1", "participant-2"]
+        r = client.post('/api/visits/', json=vjson)
+        assert r.status_code == 201
+        r = client.get('/api/participants/', headers={"If-None-Match": etag})
+        assert r.status_code == 304
+
+
+class TestControls(object):
+    def test_templates(self, client):
+        app = client.application
+        with app.test_request_context():
+            m = Mokki(name="mokki {x}", location="loc")
+            i = Item(name="item-1", amount="1")
+            assert resource_url("api.mokkiitem", mokki=m.name) == \
+                url_for("api.mokkiitem", mokki=m)
+            assert resource_url("api.itemitem", mokki=m.name,
+                                item=i.name) == \
+                url_for("api.itemitem", mokki=m, item=i)
+
+            body = MokkigoBuilder()
+            body.add_control_edit_item(m, i)
+            ctrl = body["@controls"]["mokkigo:edit-item"]
+            assert ctrl["href"] == url_for("api.itemitem", mokki=m, item=i)
+            assert ctrl["method"] == "PUT"
+            assert ctrl["schema"] == Item.json_schema()
+
+
+class TestStreaming(object):
+    COLLECTIONS = ['/api/mokkis/', '/api/participants/', '/api/visits/',
+                   '/api/mokkis/mokki-1/items/']
+
+    def test_stream(self, client):
+        _populate_mokki_1(client)
+
+        for url in self.COLLECTIONS:
+            r = client.get(url)
+            full = json.loads(r.data)
+
+            r = client.get(url + '?stream=true&limit=3')
+            assert r.status_code == 200
+            assert r.is_streamed
+            body = json.loads(r.data)
+            assert body["items"] == full["items"][:3]
+            assert "prev" not in body["@controls"]
+            assert body["@namespaces"] == full["@namespaces"]
+
+            r = client.get(body["@controls"]["next"]["href"])
+            body = json.loads(r.data)
+            assert body["items"] == full["items"][3:]
+            assert "next" not in body["@controls"]
+            assert "prev" in body["@controls"]
+
+
+class TestFields(object):
+    def test_sparse(self, client):
+        with client.application.app_context():
+            _populate_db()
+
+        r = client.get('/api/visits/?fields=visit_name,time_start&limit=2')
+        assert r.status_code == 200
+        body = json.loads(r.data)
+        assert set(body["items"][0]) == {"visit_name", "time_start",
+                                         "@controls"}
+        assert "next" in body["@controls"]
+
+        r = client.get('/api/mokkis/?fields=location&controls=none&limit=2')
+        assert r.mimetype == "application/json"
+        body = json.loads(r.data)
+        assert body["items"] == [{"location": "location-1"},
+                                 {"location": "location-2"}]
+        assert "@controls" not in body
+        r = client.get(body["next"])
+        assert len(json.loads(r.data)["items"]) == 2
+
+        r = client.get('/api/participants/?stream=true&controls=none')
+        body = json.loads(r.data)
+        assert len(body["items"]) == 4
+        assert set(body["items"][0]) == {"name", "allergies"}
+
+        r = client.get('/api/visits/visit-1/?fields=participants',
+                       headers={"Accept": "application/json"})
+        body = json.loads(r.data)
+        assert sorted(body) == ["participants"]
+
+        r = client.get('/api/mokkis/?fields=name,color')
+        assert r.status_code == 400
+
+
+class TestBulkCreate(object):
+    def test_bulk(self, client):
+        mokkis = [get_mokki(i) for i in range(1, 4)]
+        mokkis.append(get_mokki(1))
+        mokkis.append({"name": "no-location"})
+        r = client.post('/api/mokkis/', json=mokkis)
+        assert r.status_code == 200
+        body = json.loads(r.data)
+        statuses = [item["status"] for item in body["items"]]
+        assert statuses == ["created", "created", "created", "conflict",
+                            "invalid"]
+        r = client.get(body["items"][0]["@controls"]["self"]["href"])
+        assert r.status_code == 200
+
+        r = client.post('/api/mokkis/', json=[get_mokki(2), get_mokki(4)])
+        statuses = [i["status"] for i in json.loads(r.data)["items"]]
+        assert statuses == ["conflict", "created"]
+
+        parts = [get_participant(i) for i in range(1, 4)]
+        r = client.post('/api/participants/', json=parts)
+        assert r.status_code == 200
+
+        items = [get_item(i) for i in range(1, 3)]
+        r = client.post('/api/mokkis/mokki-1/items/', json=items)
+        assert r.status_code == 200
+        r = client.get('/api/mokkis/mokki-1/items/item2/')
+        assert r.status_code == 200
+
+        visits = [get_visit(1), get_visit(2)]
+        visits[1]["time_start"] = "not a time"
+        r = client.post('/api/visits/', json=visits)
+        statuses = [i["status"] for i in json.loads(r.data)["items"]]
+        assert statuses == ["created", "invalid"]
+        r = client.get('/api/visits/visit1/')
+        body = json.loads(r.data)
+        assert sorted(body["participants"]) == ["part1", "part2"]
+
+
+class TestMokkiVisits(object):
+    def test_mokki_visits(self, client):
+        client.post('/api/mokkis/', json=[get_mokki(1), get_mokki(2)])
+        client.post('/api/participants/', json=[get_participant(1)])
+        visits = [get_visit(1), get_visit(2), get_visit(3)]
+        visits[2]["mokki_name"] = "mokki-1"
+        r = client.post('/api/visits/', json=visits)
+        statuses = [i["status"] for i in json.loads(r.data)["items"]]
+        assert statuses == ["created", "created", "created"]
+
+        r = client.get('/api/mokkis/mokki-1/visits/')
+        assert r.status_code == 200
+        names = [v["visit_name"] for v in json.loads(r.data)["items"]]
+        assert names == ["visit1", "visit3"]
+
+        # Visits follow the renamed mokki
+        r = client.put('/api/mokkis/mokki-1/',
+                       json={"name": "renamed", "location": "loc"})
+        assert r.status_code == 204
+        body = json.loads(client.get('/api/visits/visit1/').data)
+        assert body["mokki_name"] == "renamed"
+
+        visit = get_visit(4)
+        visit["mokki_name"] = "no-such-mokki"
+        r = client.post('/api/visits/', json=visit)
+        assert r.status_code == 404
+
+        r = client.delete('/api/mokkis/renamed/')
+        assert r.status_code == 204
+        assert client.get('/api/visits/visit1/').status_code == 404
+        assert client.get('/api/visits/visit2/').status_code == 200
+
+
+class TestVisitFilters(object):
+    def test_time_range(self, client):
+        client.post('/api/mokkis/', json=[get_mokki(1), get_mokki(2)])
+        visits = []
+        for i in range(1, 5):
+            visit = get_visit(i)
+            visit["participants"] = []
+            visit["mokki_name"] = "mokki-{}".format(i % 2 + 1)
+            visit["time_start"] = "2020-02-0{}T12:00:00".format(i * 2)
+            visit["time_end"] = "2020-02-0{}T12:00:00".format(i * 2 + 1)
+            visits.append(visit)
+        client.post('/api/visits/', json=visits)
+
+        def names(url):
+            r = client.get(url)
+            assert r.status_code == 200
+            return [v["visit_name"] for v in json.loads(r.data)["items"]]
+
+        # visit2 (4th-5th) and visit3 (6th-7th) overlap
+        assert names('/api/visits/?from=2020-02-05T00:00:00'
+                     '&to=2020-02-06T13:00:00') == ["visit2", "visit3"]
+        assert names('/api/visits/?from=2020-02-07T00:00:00') == [
+            "visit3", "visit4"]
+        assert names('/api/visits/?to=2020-02-03') == ["visit1"]
+        assert names('/api/visits/?mokki=mokki-1&from=2020-02-05') == [
+            "visit2", "visit4"]
+        assert names('/api/mokkis/mokki-2/visits/?to=2020-02-07') == [
+            "visit1", "visit3"]
+
+        r = client.get('/api/visits/?from=yesterday')
+        assert r.status_code == 400
+        r = client.get('/api/visits/?mokki=no-such-mokki')
+        assert r.status_code == 404
+
+
+class TestBookingConflicts(object):
+    def _visit(self, num, start, end):
+        visit = get_visit(num)
+        visit["mokki_name"] = "mokki-1"
+        visit["participants"] = []
+        visit["time_start"] = "2020-02-{:02d}T12:00:00+02:00".format(start)
+        visit["time_end"] = "2020-02-{:02d}T12:00:00+02:00".format(end)
+        return visit
+
+    def test_reject(self, client):
+        client.post('/api/mokkis/', json=[get_mokki(1), get_mokki(2)])
+        r = client.post('/api/visits/', json=self._visit(1, 10, 12))
+        assert r.status_code == 201
+        # Touching visits do not overlap
+        r = client.post('/api/visits/', json=self._visit(2, 12, 14))
+        assert r.status_code == 201
+        r = client.post('/api/visits/', json=self._visit(3, 11, 13))
+        assert r.status_code == 409
+        other = self._visit(3, 11, 13)
+        other["mokki_name"] = "mokki-2"
+        r = client.post('/api/visits/', json=other)
+        assert r.status_code == 201
+
+        # A visit does not conflict with itself
+        r = client.put('/api/visits/visit1/', json=self._visit(1, 9, 12))
+        assert r.status_code == 204
+        r = client.put('/api/visits/visit1/', json=self._visit(1, 9, 13))
+        assert r.status_code == 409
+
+        visits = [self._visit(4, 1, 3), self._visit(5, 2, 4),
+                  self._visit(6, 13, 15), self._visit(7, 4, 5)]
+        r = client.post('/api/visits/', json=visits)
+        statuses = [i["status"] for i in json.loads(r.data)["items"]]
+        assert statuses == ["created", "conflict", "conflict", "created"]
+
+    def test_warn(self, client):
+        client.application.config["BOOKING_CONFLICTS"] = "warn"
+        client.post('/api/mokkis/', json=get_mokki(1))
+        r = client.post('/api/visits/', json=self._visit(1, 10, 12))
+        assert "Warning" not in r.headers
+        r = client.post('/api/visits/', json=self._visit(2, 11, 13))
+        assert r.status_code == 201
+        assert "visit1" in r.headers["Warning"]
+        r = client.post('/api/visits/', json=[self._visit(3, 11, 12)])
+        item = json.loads(r.data)["items"][0]
+        assert item["status"] == "created"
+        assert "message" in item
+
+    def test_utc_offsets(self, client):
+        client.post('/api/mokkis/', json=get_mokki(1))
+        r = client.post('/api/visits/', json=self._visit(1, 10, 12))
+        assert r.status_code == 201
+        # Ends at 10:00 UTC, when visit1 starts
+        visit = self._visit(2, 9, 10)
+        visit["time_end"] = "2020-02-10T10:00:00Z"
+        r = client.post('/api/visits/', json=visit)
+        assert r.status_code == 201
+        visit = self._visit(3, 9, 10)
+        visit["time_end"] = "2020-02-10T10:00:01Z"
+        r = client.post('/api/visits/', json=visit)
+        assert r.status_code == 409
+
+        visit["time_end"] = "10.2.2020 10:00"
+        r = client.post('/api/visits/', json=visit)
+        assert r.status_code == 400
+        r = client.put('/api/visits/visit1/', json=visit)
+        assert r.status_code == 400
+        r = client.post('/api/visits/', json=[visit])
+        assert json.loads(r.data)["items"][0]["status"] == "invalid"
+
+
+class TestCalendar(object):
+    URL = '/api/mokkis/mokki-1/calendar/'
+
+    def test_calendar(self, client):
+        client.post('/api/mokkis/', json=get_mokki(1))
+        client.post('/api/participants/',
+                    json=[get_participant(1), get_participant(2)])
+        visits = [get_visit(1), get_visit(2)]
+        for visit in visits:
+            visit["mokki_name"] = "mokki-1"
+        # 3rd-4th with two participants, ends at midnight of the 5th
+        visits[0]["time_start"] = "2022-06-03T16:00:00"
+        visits[0]["time_end"] = "2022-06-05T00:00:00"
+        # From before the calendar until the 2nd
+        visits[1]["participants"] = []
+        visits[1]["time_start"] = "2022-05-20T12:00:00"
+        visits[1]["time_end"] = "2022-06-02T10:00:00"
+        client.post('/api/visits/', json=visits)
+
+        r = client.get(self.URL + '?from=2022-06-01&to=2022-06-10&stay=3')
+        assert r.status_code == 200
+        body = json.loads(r.data)
+        assert [d["visits"] for d in body["days"]] == [
+            1, 1, 1, 1, 0, 0, 0, 0, 0]
+        assert [d["participants"] for d in body["days"]][:5] == [
+            0, 0, 2, 2, 0]
+        assert body["free_slots"] == [
+            {"from": "2022-06-05", "to": "2022-06-10", "days": 5}]
+
+        r = client.get(self.URL + '?from=2022-06-01&to=2022-05-01')
+        assert r.status_code == 400
+        r = client.get(self.URL + '?stay=0')
+        assert r.status_code == 400
+        r = client.get('/api/mokkis/mokki-2/calendar/')
+        assert r.status_code == 404
+
+        r = client.get(self.URL + '?from=2022-06-01&mokki=mokki-2')
+        assert r.status_code == 200
+        href = json.loads(r.data)["@controls"]["self"]["href"]
+        assert href == self.URL + '?from=2022-06-01&mokki=mokki-2'
+
+    def test_etag_follows_today(self, client, monkeypatch):
+        client.post('/api/mokkis/', json=get_mokki(1))
+        r = client.get(self.URL)
+        etag = r.headers["ETag"]
+        r = client.get(self.URL, headers={"If-None-Match": etag})
+        assert r.status_code == 304
+
+        class Tomorrow(date):
+            @classmethod
+            def today(cls):
+                return date.today() + timedelta(days=1)
+
+        monkeypatch.setattr(calendar, "date", Tomorrow)
+        r = client.get(self.URL, headers={"If-None-Match": etag})
+        assert r.status_code == 200
+        assert json.loads(r.data)["from"] == Tomorrow.today().isoformat()
+
+
+class TestParticipantVisits(object):
+    def test_participant_visits(self, client):
+        client.post('/api/mokkis/', json=[get_mokki(1), get_mokki(2)])
+        client.post('/api/participants/',
+                    json=[get_participant(i) for i in range(1, 4)])
+        visit = get_visit(1)
+        visit["participants"] = ["part1", "part1", "part2"]
+        r = client.post('/api/visits/', json=visit)
+        assert r.status_code == 201
+        r = client.post('/api/visits/', json=get_visit(2))
+        assert r.status_code == 201
+
+        r = client.get('/api/visits/visit1/')
+        assert sorted(json.loads(r.data)["participants"]) == [
+            "part1", "part2"]
+
+        r = client.get('/api/participants/part2/visits/')
+        assert r.status_code == 200
+        names = [v["visit_name"] for v in json.loads(r.data)["items"]]
+        assert names == ["visit1", "visit2"]
+        r = client.get('/api/participants/part3/visits/?fields=visit_name')
+        names = [v["visit_name"] for v in json.loads(r.data)["items"]]
+        assert names == ["visit2"]
+
+
+class TestSearch(object):
+    def test_search(self, client):
+        client.post('/api/mokkis/', json=[
+            {"name": "Iisalmi-mökki", "location": "Iisalmi"},
+            {"name": "Oulu", "location": "Hietasaari"},
+        ])
+        client.post('/api/participants/', json=[
+            {"name": "Iida", "allergies": "nuts"},
+            {"name": "Matti", "allergies": "none"},
+        ])
+        client.post('/api/mokkis/Oulu/items/',
+                    json={"name": "iron", "amount": "1"})
+
+        r = client.get('/api/search/?q=ii&count=true')
+        assert r.status_code == 200
+        body = json.loads(r.data)
+        assert body["total"] == 2
+        names = sorted(result["name"] for result in body["items"])
+        assert names == ["Iida", "Iisalmi-mökki"]
+        r = client.get('/api/search/?q=ii&limit=1')
+        body = json.loads(r.data)
+        r = client.get(body["@controls"]["next"]["href"])
+        assert json.loads(r.data)["items"][0]["name"] != \
+            body["items"][0]["name"]
+        # Diacritics are ignored and the results link to the rows
+        r = client.get('/api/search/?q=mokki')
+        result = json.loads(r.data)["items"][0]
+        r = client.get(result["@controls"]["self"]["href"])
+        assert r.status_code == 200
+
+        r = client.get('/api/search/?q=ir')
+        result = json.loads(r.data)["items"][0]
+        assert result["type"] == "item"
+        r = client.get(result["@controls"]["self"]["href"])
+        assert r.status_code == 200
+
+        # The index follows updates and deletes
+        client.put('/api/participants/Iida/',
+                   json={"name": "Liisa", "allergies": "nuts"})
+        client.delete('/api/mokkis/Iisalmi-mökki/')
+        r = client.get('/api/search/?q=ii')
+        assert json.loads(r.data)["items"] == []
+        r = client.get('/api/search/?q=nuts')
+        assert json.loads(r.data)["items"][0]["name"] == "Liisa"
+
+        r = client.get('/api/search/?q=%22*')
+        assert r.status_code == 400
+
+    def test_self_link_keeps_args(self, client):
+        client.post('/api/mokkis/', json={"name": "Iisalmi",
+                                          "location": "Iisalmi"})
+
+        # Query args named like a url_for argument or option
+        for args in ("endpoint=x", "_method=POST", "_anchor=zz",
+                     "_external=1"):
+            r = client.get('/api/search/?q=ii&' + args)
+            assert r.status_code == 200
+            href = json.loads(r.data)["@controls"]["self"]["href"]
+            assert href.startswith('/api/search/?')
+            assert args in href
+            assert "#" not in href
+            r = client.get(href)
+            assert r.status_code == 200
+
+
+class TestWriteRetry(object):
+    def test_locked(self, caplog):
+        db_fd, db_fname = tempfile.mkstemp()
+        app = create_app({
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+            "SQLALCHEMY_ENGINE_OPTIONS": {"connect_args": {"timeout": 0}},
+            "TESTING": True,
+            "WRITE_RETRY_DEADLINE": 0.05,
+        })
+        with app.app_context():
+            db.create_all()
+        client = app.test_client()
+
+        locker = sqlite3.connect(db_fname, check_same_thread=False)
+        locker.execute("BEGIN IMMEDIATE")
+        r = client.post('/api/mokkis/', json=get_mokki(1))
+        assert r.status_code == 503
+
+        # The lock is released while the request is waiting for a retry
+        app.config["WRITE_RETRY_DEADLINE"] = 5
+        app.config["SERVER_TIMING_LOG"] = True
+        retries = get_counters(process=True).get("write_retries", 0)
+        threading.Timer(0.1, locker.rollback).start()
+        with caplog.at_level(logging.INFO):
+            r = client.post('/api/mokkis/', json=get_mokki(1))
+        assert r.status_code == 201
+        assert get_counters(process=True)["write_retries"] > retries
+        record = json.loads(caplog.records[-1].getMessage().split(" ", 1)[1])
+        assert record["write_retries"] > 0
+
+        # A visit committed while a bulk POST waits for the lock is seen by
+        # its overlap check
+        locker.execute("BEGIN IMMEDIATE")
+        locker.execute(
+            "INSERT INTO visit (visit_name, mokki_id, time_start, time_end, "
+            "time_start_epoch, time_end_epoch) VALUES ('other', 1, "
+            "'2020-02-10 12:00:00.000000', '2020-02-12 12:00:00.000000', "
+            "1581336000000000, 1581508800000000)"
+        )
+        threading.Timer(0.1, locker.commit).start()
+        visit = get_visit(1)
+        visit["mokki_name"] = "mokki-1"
+        visit["participants"] = []
+        visit["time_start"] = "2020-02-11T12:00:00Z"
+        visit["time_end"] = "2020-02-13T12:00:00Z"
+        r = client.post('/api/visits/', json=[visit])
+        assert json.loads(r.data)["items"][0]["status"] == "conflict"
+
+        locker.close()
+        with app.app_context():
+            db.get_engine().dispose()
+        os.close(db_fd)
+        os.unlink(db_fname)
+
+
+class TestGroupCommit(object):
+    def test_concurrent_posts(self, client):
+        app = client.application
+        app.config["GROUP_COMMIT"] = True
+        app.config["GROUP_COMMIT_WINDOW"] = 0.05
+        before = get_counters(process=True)
+        client.post('/api/mokkis/', json=get_mokki(1))
+
+        statuses = {}
+
+        def post(num):
+            # Every name is posted twice, one of the two must conflict
+            r = app.test_client().post('/api/participants/',
+                                       json=get_participant(num // 2))
+            statuses[num] = r.status_code
+
+        threads = [threading.Thread(target=post, args=(i,))
+                   for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert sorted(statuses.values()) == [201] * 10 + [409] * 10
+
+        visit = get_visit(1)
+        visit["participants"] = ["part1", "part2"]
+        visit["time_end"] = "2020-02-03T12:00:00+10:00"
+        r = client.post('/api/visits/', json=visit)
+        assert r.status_code == 201
+        r = client.post('/api/visits/', json=visit)
+        assert r.status_code == 409
+        visit["visit_name"] = "overlapping"
+        r = client.post('/api/visits/', json=visit)
+        assert r.status_code == 409
+        r = client.get('/api/visits/visit1/')
+        assert sorted(json.loads(r.data)["participants"]) == [
+            "part1", "part2"]
+
+        after = get_counters(process=True)
+        batches = after["group_commit_batches"] - \
+            before.get("group_commit_batches", 0)
+        writes = after["group_commit_writes"] - \
+            before.get("group_commit_writes", 0)
+        assert writes == 24
+        assert batches < writes
+
+    def test_stopped_committer(self, client, monkeypatch):
+        app = client.application
+        app.config["GROUP_COMMIT"] = True
+        app.config["GROUP_COMMIT_TIMEOUT"] = 0.1
+        r = client.post('/api/mokkis/', json=get_mokki(1))
+        assert r.status_code == 201
+        committer = get_committer(app)
+
+        # Nothing takes the writes from the queue
+        with monkeypatch.context() as m:
+            m.setattr(committer, "_get_queue", queue.Queue)
+            r = client.post('/api/mokkis/', json=get_mokki(2))
+            assert r.status_code == 503
+
+        # A stopped thread is replaced at the next write
+        stopped = threading.Thread(target=lambda: None)
+        stopped.start()
+        stopped.join()
+        committer._thread = stopped
+        r = client.post('/api/mokkis/', json=get_mokki(2))
+        assert r.status_code == 201
+        assert committer._thread is not stopped
+
+
+class TestAsgi(object):
+    def _request(self, app, method, path, body=b"", query=b""):
+        return asyncio.run(self._send(app, method, path, body, query))
+
+    async def _send(self, app, method, path, body=b"", query=b""):
+        messages = [{"type": "http.request", "body": body[:3],
+                     "more_body": True},
+                    {"type": "http.request", "body": body[3:]}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {
+            "type": "http",
+            "http_version": "1.1",
+            "method": method,
+            "scheme": "http",
+            "path": path,
+            "root_path": "",
+            "query_string": query,
+            "headers": [(b"host", b"localhost"),
+                        (b"content-type", b"application/json")],
+            "server": ("localhost", 80),
+            "client": ("127.0.0.1", 1234),
+        }
+        await app(scope, receive, send)
+        assert sent[0]["type"] == "http.response.start"
+        assert not sent[-1].get("more_body", False)
+        body = b"".join(message["body"] for message in sent[1:])
+        return sent[0]["status"], dict(sent[0]["headers"]), body
+
+    def test_asgi(self, client):
+        app = AsgiAdapter(client.application, 2)
+        status, headers, body = self._request(
+                app, "POST", "/api/mokkis/",
+                json.dumps(get_mokki(1)).encode("utf-8")
+        )
+        assert status == 201
+        assert headers[b"location"].endswith(b"/api/mokkis/mokki-1/")
+
+        status, headers, body = self._request(app, "GET", "/api/mokkis/",
+                                              query=b"stream=true")
+        assert status == 200
+        assert json.loads(body)["items"][0]["name"] == "mokki-1"
+
+        status, headers, body = self._request(app, "DELETE",
+                                              "/api/mokkis/mokki-1/")
+        assert status == 204
+        assert body == b""
+        app.executor.shutdown()
+
+    def test_asgi_stream(self, client):
+        count = STREAM_CHUNK_ITEMS * 2 + 10
+        client.post('/api/mokkis/', json=[get_mokki(i)
+                                          for i in range(1, count + 1)])
+        app = AsgiAdapter(client.application, 2)
+        query = "stream=true&limit={}".format(count).encode("ascii")
+
+        async def concurrent():
+            return await asyncio.gather(*[
+                self._send(app, "GET", "/api/mokkis/", query=query)
+                for i in range(4)
+            ])
+
+        for status, headers, body in asyncio.run(concurrent()):
+            assert status == 200
+            assert len(json.loads(body)["items"]) == count
+        app.executor.shutdown()
+
+
+class TestValidation(object):
+    DOCS = [
+        None, [], "mokki", {},
+        {"name": "x"},
+        {"name": "x", "location": "y"},
+        {"name": 1, "location": "y"},
+        {"name": "x", "amount": "2"},
+        {"name": "x", "amount": None},
+        {"name": "x", "allergies": "nuts", "visits": ["a", "b"]},
+        {"name": "x", "visits": ["a", 2]},
+        {"name": "x", "visits": "a"},
+        {"visit_name": "v", "mokki_name": "m",
+         "time_start": "2022-01-01T10:00:00+02:00",
+         "time_end": "2022-01-02T10:00:00+02:00"},
+        {"visit_name": "v", "mokki_name": "m",
+         "time_start": "2022-01-01T10:00:00+02:00",
+         "time_end": 5, "participants": ["p"]},
+        {"visit_name": "v", "mokki_name": "m", "time_start": "",
+         "time_end": "", "participants": [None]},
+    ]
+
+    def test_fast_path(self, client):
+        with client.application.app_context():
+            for model in (Mokki, Item, Participant, Visit):
+                validator = get_validator(model, check_formats=True)
+                assert validator.fast_check is not None
+                for doc in self.DOCS:
+                    assert validator.is_valid(doc) == \
+                        validator.is_valid(doc, fast=False)
+
+                    try:
+                        validate(doc, model.json_schema())
+                        expected = None
+                    except ValidationError as e:
+                        expected = str(e)
+                    assert validation_error(doc, model) == expected
+
+
+class TestServerTiming(object):
+    def _timings(self, resp):
+        parts = [part.split(";dur=")
+                 for part in resp.headers["Server-Timing"].split(", ")]
+        return {name: float(dur) for name, dur in parts}
+
+    def test_header(self, client, caplog):
+        r = client.post('/api/mokkis/', json=get_mokki(1))
+        timings = self._timings(r)
+        assert {"validate", "db", "app", "total"} <= set(timings)
+        assert sum(timings.values()) - timings["total"] <= \
+            timings["total"] + 0.01
+
+        r = client.get('/api/mokkis/mokki-1/')
+        assert {"convert", "db", "mason", "encode"} <= \
+            set(self._timings(r))
+        r = client.get('/api/mokkis/')
+        assert {"db", "mason", "encode"} <= set(self._timings(r))
+        assert "Server-Timing" not in client.get(LINK_RELATIONS_URL).headers
+
+        client.application.config["SERVER_TIMING_LOG"] = True
+        with caplog.at_level(logging.INFO):
+            client.get('/api/mokkis/')
+        record = json.loads(caplog.records[-1].getMessage().split(" ", 1)[1])
+        assert record["path"] == "/api/mokkis/"
+        assert record["queries"] >= 1
+        assert "db_ms" in record
+
+    def test_disabled(self, client):
+        client.application.config["SERVER_TIMING"] = False
+        client.post('/api/mokkis/', json=get_mokki(1))
+        r = client.get('/api/mokkis/')
+        assert r.status_code == 200
+        assert "Server-Timing" not in r.headers